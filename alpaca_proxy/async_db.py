@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+# Run the database in its own threads, so a commit or a lock wait doesn't stop the event loop.
+
+# Author: twitter.com/alpacatunnel
+
+
+import queue
+import asyncio
+import threading
+
+from .log import print_log
+from .db import DB, BILL_KEYS
+
+
+# most writes committed in one transaction
+MAX_BATCH = 1000
+
+
+def _set_future(future, result, exception):
+    if future.cancelled():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+class DBThread():
+    """
+    A thread with its own connection, which runs the commands of its queue in order.
+    A command is (future, method name of DB, args), None stops the thread.
+
+    With `batch`, the commands queued together run in one transaction, each in
+    a savepoint, so a failed command is rolled back alone. Their futures are
+    resolved after the commit.
+    """
+
+    def __init__(self, file_name, loop, batch=False, name='db'):
+        self.file_name = file_name
+        self.loop = loop
+        self.batch = batch
+        self.queue = queue.Queue()
+
+        self.commands = 0
+        self.transactions = 0
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, method, *args):
+        future = self.loop.create_future()
+        self.queue.put((future, method, args))
+        return future
+
+    def stop(self):
+        self.queue.put(None)
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _resolve(self, results):
+        try:
+            for future, result, exception in results:
+                self.loop.call_soon_threadsafe(_set_future, future, result, exception)
+        except RuntimeError:
+            # the loop is closed, nobody waits for the results
+            pass
+
+    def _next_commands(self):
+        commands = [self.queue.get()]
+        while self.batch and commands[-1] is not None and len(commands) < MAX_BATCH:
+            try:
+                commands.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return commands
+
+    def _run(self):
+        db = DB(self.file_name)
+        db.batching = self.batch
+
+        while True:
+            commands = self._next_commands()
+            stop = commands[-1] is None
+            if stop:
+                commands.pop()
+
+            results = []
+            for future, method, args in commands:
+                results.append((future, ) + self._call(db, method, args))
+            self.commands += len(commands)
+
+            if self.batch and commands:
+                try:
+                    db.conn.commit()
+                    self.transactions += 1
+                except Exception as e:
+                    print_log('Error commit {} writes: {}'.format(len(commands), e))
+                    db.conn.rollback()
+                    results = [(future, None, e) for future, _result, _exception in results]
+
+            self._resolve(results)
+            if stop:
+                break
+
+        db.conn.close()
+
+    def _call(self, db, method, args):
+        """
+        Return (result, exception).
+        """
+        if self.batch:
+            db.cursor.execute('SAVEPOINT `command`')
+        try:
+            result = getattr(db, method)(*args)
+        except Exception as e:
+            if self.batch:
+                db.cursor.execute('ROLLBACK TO `command`')
+                db.cursor.execute('RELEASE `command`')
+            return None, e
+
+        if self.batch:
+            db.cursor.execute('RELEASE `command`')
+        return result, None
+
+
+class AsyncDB():
+    """
+    The coroutine version of DB. The writes are queued to one writer thread, and
+    committed in batches, the reads run in a reader thread with a connection of
+    its own. In WAL mode they don't block each other. A read sees the writes
+    awaited before it, not the ones still queued.
+    """
+
+    ROLE_SERVER = DB.ROLE_SERVER
+    ROLE_CLIENT = DB.ROLE_CLIENT
+
+    def __init__(self, file_name, loop=None):
+        self.file_name = file_name
+        loop = loop or asyncio.get_event_loop()
+
+        # create the tables before the threads open the database
+        DB(file_name).conn.close()
+
+        self._writer = DBThread(file_name, loop, batch=True, name='db-writer')
+        self._reader = DBThread(file_name, loop, name='db-reader')
+
+    def _read(self, method, *args):
+        return self._reader.submit(method, *args)
+
+    def _write(self, method, *args):
+        return self._writer.submit(method, *args)
+
+    async def close(self):
+        """
+        Finish the queued writes, then stop the threads.
+        """
+        await self._write('commit')
+        self._writer.stop()
+        self._reader.stop()
+        print_log('database closed after {} writes in {} transactions'.format(
+            self._writer.commands, self._writer.transactions))
+
+    def get_account(self, account):
+        return self._read('get_account', account)
+
+    def get_server_accounts(self):
+        return self._read('get_server_accounts')
+
+    def get_client_accounts(self):
+        return self._read('get_client_accounts')
+
+    def get_block(self, hash):
+        return self._read('get_block', hash)
+
+    def get_receive_blocks(self, server_account, client_account):
+        return self._read('get_receive_blocks', server_account, client_account)
+
+    def get_total_pays(self):
+        return self._read('get_total_pays')
+
+    def get_total_pay(self, client_account):
+        return self._read('get_total_pay', client_account)
+
+    def get_bill(self, account):
+        return self._read('get_bill', account)
+
+    def get_bills(self, accounts):
+        return self._read('get_bills', list(accounts))
+
+    def update_account(self, account, role, frontier=None):
+        return self._write('update_account', account, role, frontier)
+
+    def update_block(self, account, block_dict):
+        return self._write('update_block', account, block_dict)
+
+    def update_bills(self, bills):
+        return self._write('update_bills', bills)
+
+
+def _test_main():
+    import os
+    import time
+    import random
+
+    from . import db as db_module
+
+    # update_account() and update_block() log every call
+    db_module.print_log = lambda *args: None
+
+    file_name = '/tmp/test_async.db'
+    server_account = 'xrb_server'
+    client_accounts = ['xrb_client{}'.format(x) for x in range(1000)]
+
+    def blocks(start, count):
+        return [{
+            'type': 'state', 'subtype': 'receive', 'hash': 'hash{}'.format(x),
+            'account': random.choice(client_accounts), 'amount': str(random.getrandbits(100)),
+        } for x in range(start, start + count)]
+
+    def bills():
+        return {account: {key: str(random.getrandbits(64)) for key in BILL_KEYS} for account in client_accounts}
+
+    async def measure_lag(done):
+        """
+        Return the max delay of a 1ms timer, while the burst runs.
+        """
+        max_lag = 0
+        while not done.is_set():
+            start = time.monotonic()
+            await asyncio.sleep(0.001)
+            max_lag = max(max_lag, time.monotonic() - start - 0.001)
+        return max_lag
+
+    async def burst(update_block, update_bills):
+        """
+        The writes of a sync with Nano and bill flushes, each one on its own, like the server does.
+        """
+        for x in range(10):
+            await asyncio.gather(*[update_block(server_account, block) for block in blocks(x * 200, 200)])
+            await update_bills(bills())
+            for block in blocks(x * 200 + 100000, 50):
+                await update_block(server_account, block)
+
+    async def run(update_block, update_bills):
+        done = asyncio.Event()
+        lag_task = asyncio.ensure_future(measure_lag(done))
+        start = time.monotonic()
+        await burst(update_block, update_bills)
+        elapsed = time.monotonic() - start
+        done.set()
+        return round(elapsed, 2), round(await lag_task * 1000, 1)
+
+    def reset():
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(file_name + suffix):
+                os.remove(file_name + suffix)
+
+    async def sync_db():
+        reset()
+        db = DB(file_name)
+        db.update_account(server_account, DB.ROLE_SERVER)
+
+        async def update_block(account, block):
+            return db.update_block(account, block)
+
+        async def update_bills(bills):
+            return db.update_bills(bills)
+
+        result = await run(update_block, update_bills)
+        db.conn.close()
+        return result
+
+    async def async_db():
+        reset()
+        db = AsyncDB(file_name)
+        await db.update_account(server_account, DB.ROLE_SERVER)
+        result = await run(db.update_block, db.update_bills)
+
+        # the reader sees the writes awaited before
+        clients = await db.get_client_accounts()
+        await db.close()
+        assert clients and clients == DB(file_name).get_client_accounts()
+        return result
+
+    loop = asyncio.new_event_loop()
+    random.seed(1)
+    print('DB: {} s, max event loop lag {} ms'.format(*loop.run_until_complete(sync_db())))
+    random.seed(1)
+    print('AsyncDB: {} s, max event loop lag {} ms'.format(*loop.run_until_complete(async_db())))
+    reset()
+
+
+if __name__ == '__main__':
+    _test_main()
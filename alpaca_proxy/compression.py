@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# Deflate the stream data in the multiplexing records, skip the incompressible streams.
+
+# Author: twitter.com/alpacatunnel
+
+
+import zlib
+
+
+# TLS record types: change_cipher_spec, alert, handshake, application_data
+TLS_CONTENT_TYPES = (20, 21, 22, 23)
+
+# the most a deflated record inflates to, the relays read 8KB chunks
+MAX_RECORD_SIZE = 64 * 1024
+
+
+def looks_like_tls(data):
+    return len(data) >= 3 and data[0] in TLS_CONTENT_TYPES and data[1] == 3 and data[2] <= 4
+
+
+def deflate_conf(conf):
+    """
+    Return (level, window) of `deflate_level` and `deflate_window` in the config,
+    or None if deflate is disabled, which is the default.
+    """
+    level = int(conf.get('deflate_level', 0))
+    window = int(conf.get('deflate_window', 15))
+    if not level:
+        return None
+
+    if not 1 <= level <= 9:
+        raise ValueError('deflate_level must be between 0 and 9')
+    if not 9 <= window <= 15:
+        raise ValueError('deflate_window must be between 9 and 15')
+
+    return level, window
+
+
+class Deflate():
+    """
+    No io involved. One deflate context per direction is shared by all streams
+    of a session, like permessage-deflate with context takeover, so the records
+    must be inflated in the order they were deflated.
+
+    Each stream is sampled on its first `sample_size` bytes. If the sample doesn't
+    shrink below `min_ratio`, or starts with a TLS record, the stream is marked
+    incompressible and its data is sent as it is.
+
+    A record over `max_record` bytes is sent as it is, and a record that inflates
+    to more is an error, so a small message can't inflate to gigabytes.
+    """
+
+    def __init__(self, level=6, window=15, sample_size=16*1024, min_ratio=0.9, max_record=MAX_RECORD_SIZE):
+        self.sample_size = sample_size
+        self.min_ratio = min_ratio
+        self.max_record = max_record
+
+        self._compressobj = zlib.compressobj(level, zlib.DEFLATED, -window)
+        # the max window inflates data deflated with any window
+        self._decompressobj = zlib.decompressobj(-15)
+
+        # stream_id: [bytes_in, bytes_out] while sampling
+        self._samples = {}
+        self._bypass = set()
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.bytes_bypassed = 0
+        self.bytes_received = 0
+        self.bytes_inflated = 0
+
+    def compress(self, stream_id, data):
+        """
+        Return the deflated data, or None if the stream is incompressible.
+        """
+        if stream_id in self._bypass or len(data) > self.max_record:
+            self.bytes_bypassed += len(data)
+            return None
+
+        sample = self._samples.get(stream_id)
+        if sample is None:
+            if looks_like_tls(data):
+                self._bypass.add(stream_id)
+                self.bytes_bypassed += len(data)
+                return None
+            sample = self._samples[stream_id] = [0, 0]
+
+        compressed = self._compressobj.compress(data) + self._compressobj.flush(zlib.Z_SYNC_FLUSH)
+        self.bytes_in += len(data)
+        self.bytes_out += len(compressed)
+
+        sample[0] += len(data)
+        sample[1] += len(compressed)
+        if sample[0] >= self.sample_size:
+            if sample[1] > sample[0] * self.min_ratio:
+                self._bypass.add(stream_id)
+            del self._samples[stream_id]
+
+        return compressed
+
+    def decompress(self, data):
+        """
+        Raise zlib.error if the data inflates to more than max_record bytes,
+        the context of the session can't go on then.
+        """
+        inflated = self._decompressobj.decompress(data, self.max_record + 1)
+        if len(inflated) > self.max_record or self._decompressobj.unconsumed_tail:
+            raise zlib.error('record inflates to more than {} bytes'.format(self.max_record))
+
+        self.bytes_received += len(data)
+        self.bytes_inflated += len(inflated)
+        return inflated
+
+    def forget(self, stream_id):
+        self._samples.pop(stream_id, None)
+        self._bypass.discard(stream_id)
+
+    def stats(self):
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'bytes_bypassed': self.bytes_bypassed,
+            'bytes_received': self.bytes_received,
+            'bytes_inflated': self.bytes_inflated,
+        }
+
+
+def _test_main():
+    sender, receiver = Deflate(), Deflate()
+
+    text = b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n' * 100
+    assert receiver.decompress(sender.compress(1, text)) == text
+    assert sender.compress(3, b'\x16\x03\x01\x02\x00') is None
+    assert receiver.decompress(sender.compress(1, text)) == text
+
+    # a record over the limit isn't deflated
+    assert sender.compress(1, text * 100) is None
+
+    # a bomb of zeros, deflated by a peer without the limit
+    bomb = zlib.compressobj(9, zlib.DEFLATED, -15)
+    bomb = bomb.compress(bytes(10**7)) + bomb.flush(zlib.Z_SYNC_FLUSH)
+    try:
+        Deflate().decompress(bomb)
+        assert False
+    except zlib.error:
+        pass
+    print(len(bomb), sender.stats())
+
+
+if __name__ == '__main__':
+    _test_main()
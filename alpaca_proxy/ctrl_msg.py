@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 
-# Control message over websocks text stream, in json format.
+# Control message over websocks text stream, in json format, or in a compact binary format.
 
 # Author: twitter.com/alpacatunnel
 
 
 import json
+import socket
+import struct
 
 
 class CtrlMsgError(Exception):
@@ -30,16 +32,69 @@ class CtrlMsg():
         'result': result,
     }
 
+    With framing version 4, the message is binary instead, see to_bytes().
     """
 
+    __slots__ = (
+        'msg_type', 'stream_id',
+        'address_type', 'dst_addr', 'dst_port',
+        'result', 'reason',
+        'coin', 'server_account', 'price_kilo_requests', 'price_gigabytes',
+        'client_account', 'timestamped_msg', 'signature',
+        'balance', 'total_pay', 'total_spend', 'total_requests', 'total_bytes',
+        'received',
+        'addresses', 'ttl',
+        'timestamp',
+        'paused',
+        'padding',
+    )
+
     TYPE_REQUEST = 'request'  # socks5 request
     TYPE_RESPONSE = 'response'  # socks5 response
     TYPE_CHARGE = 'cryptocoin'  # crypto pay method and charge
     TYPE_SIGNATURE = 'signature'  # sign a message to prove client_account ownership
     TYPE_BALANCE = 'balance'
+    TYPE_RESUME = 'resume'  # the first message of a resumable session, from server
+    TYPE_ACK = 'ack'  # the number of frames received in a resumable session
+    TYPE_UDP_ASSOCIATE = 'udp_associate'  # socks5 UDP ASSOCIATE, the datagrams go on its stream
+    TYPE_DNS = 'dns'  # resolve dst_addr on the server, for the client's DNS listener
+    TYPE_DNS_ANSWER = 'dns_answer'  # addresses of a dns message, or the reason it failed
+    TYPE_PING = 'ping'  # measures the rtt of the tunnel, needs framing version 4
+    TYPE_PONG = 'pong'  # the answer to a ping, with its timestamp
+    TYPE_FLOW = 'flow'  # pause or resume the data of a stream, from server
 
     REASON_ACCOUNT_NOT_VERIFIED = 'crypto coin client_account not verified'
     REASON_NEGATIVE_BALANCE = 'negative balance'
+    REASON_TOO_MANY_STREAMS = 'too many streams'
+    REASON_DATAGRAM_NOT_SUPPORTED = 'datagrams need framing version 3'
+
+    # 1-byte type code + 4-bytes-stream-id, then the fields of the type
+    BINARY_HEADER = struct.Struct('!BI')
+
+    # msg_type: (type code, struct of the fixed fields, fixed fields, str fields)
+    BINARY_LAYOUTS = {
+        TYPE_REQUEST:       (1, struct.Struct('!BH'), ('address_type', 'dst_port'), ()),
+        TYPE_RESPONSE:      (2, struct.Struct('!?'), ('result',), ('reason',)),
+        TYPE_CHARGE:        (3, struct.Struct('!'), (), ('coin', 'server_account', 'price_kilo_requests', 'price_gigabytes')),
+        TYPE_SIGNATURE:     (4, struct.Struct('!'), (), ('client_account', 'timestamped_msg', 'signature')),
+        TYPE_BALANCE:       (5, struct.Struct('!'), (), ('balance', 'total_pay', 'total_spend', 'total_requests', 'total_bytes')),
+        TYPE_RESUME:        (6, struct.Struct('!?Q'), ('result', 'received'), ()),
+        TYPE_ACK:           (7, struct.Struct('!Q'), ('received',), ()),
+        TYPE_UDP_ASSOCIATE: (8, struct.Struct('!'), (), ()),
+        TYPE_DNS:           (9, struct.Struct('!'), (), ('dst_addr',)),
+        TYPE_DNS_ANSWER:    (10, struct.Struct('!?I'), ('result', 'ttl'), ('reason',)),
+        TYPE_PING:          (11, struct.Struct('!d'), ('timestamp',), ()),
+        TYPE_PONG:          (12, struct.Struct('!d'), ('timestamp',), ()),
+        TYPE_FLOW:          (13, struct.Struct('!?'), ('paused',), ()),
+    }
+    BINARY_TYPES = {layout[0]: msg_type for msg_type, layout in BINARY_LAYOUTS.items()}
+
+    # socks5 address types, the IP of a request is sent as its 4 or 16 bytes
+    ADDRESS_FAMILIES = {1: socket.AF_INET, 4: socket.AF_INET6}
+
+    # the length of a str field, NONE_LENGTH for None
+    STR_LENGTH = struct.Struct('!H')
+    NONE_LENGTH = 0xFFFF
 
     def __init__(self, msg_type=None, stream_id=None,
             address_type=None, dst_addr=None, dst_port=None,
@@ -47,6 +102,10 @@ class CtrlMsg():
             coin=None, server_account=None, price_kilo_requests=None, price_gigabytes=None,
             client_account=None, timestamped_msg=None, signature=None,
             balance=None, total_pay=None, total_spend=None, total_requests=None, total_bytes=None,
+            received=None,
+            addresses=None, ttl=None,
+            timestamp=None,
+            paused=None,
             padding=None):
 
         self.msg_type       = msg_type
@@ -74,6 +133,15 @@ class CtrlMsg():
         self.total_requests     = total_requests
         self.total_bytes        = total_bytes
 
+        self.received   = received  # frames received, for resume and ack
+
+        self.addresses  = addresses  # list of IPv4/IPv6 address strings
+        self.ttl        = ttl  # seconds the answer may be cached
+
+        self.timestamp  = timestamp  # the clock of the pinging side, seconds
+
+        self.paused     = paused  # True to pause the stream, False to resume it
+
         self.padding = padding # may used to change the string length
 
     def __str__(self):
@@ -83,11 +151,10 @@ class CtrlMsg():
         return self.to_str()
 
     def _validate(self):
-        if self.msg_type not in (
-                self.TYPE_REQUEST, self.TYPE_RESPONSE,
-                self.TYPE_CHARGE, self.TYPE_SIGNATURE, self.TYPE_BALANCE):
+        # every type has a binary layout
+        if not isinstance(self.msg_type, str) or self.msg_type not in self.BINARY_LAYOUTS:
             raise CtrlMsgError(
-                'msg_type must be one of request/response/cryptocoin: {}'.format(self.msg_type))
+                'msg_type must be one of {}: {}'.format('/'.join(self.BINARY_LAYOUTS), self.msg_type))
 
         if not isinstance(self.stream_id, int) or self.stream_id < 1:
             raise CtrlMsgError('stream_id must be a positive integer: {}'.format(self.stream_id))
@@ -95,6 +162,11 @@ class CtrlMsg():
         if self.msg_type == self.TYPE_REQUEST:
             if None in (self.address_type, self.dst_addr, self.dst_port):
                 raise CtrlMsgError('request must have address_type/dst_addr/dst_port')
+            if self.address_type not in (1, 3, 4):
+                raise CtrlMsgError('request address_type must be 1, 3 or 4: {}'.format(self.address_type))
+            # port 0 is refused by the connect, not by the codec
+            if not isinstance(self.dst_port, int) or not 0 <= self.dst_port < 65536:
+                raise CtrlMsgError('request dst_port must be between 0 and 65535: {}'.format(self.dst_port))
 
         if self.msg_type == self.TYPE_RESPONSE:
             if self.result not in (True, False):
@@ -114,6 +186,41 @@ class CtrlMsg():
                     self.total_spend, self.total_requests, self.total_bytes):
                 raise CtrlMsgError('balance message must have balance')
 
+        if self.msg_type in (self.TYPE_RESUME, self.TYPE_ACK):
+            if not isinstance(self.received, int) or self.received < 0:
+                raise CtrlMsgError('{} must have the number of frames received'.format(self.msg_type))
+            if self.msg_type == self.TYPE_RESUME and self.result not in (True, False):
+                raise CtrlMsgError('resume must have a result of True or False')
+
+        if self.msg_type == self.TYPE_DNS:
+            if not self.dst_addr:
+                raise CtrlMsgError('dns must have dst_addr')
+
+        if self.msg_type == self.TYPE_DNS_ANSWER:
+            if self.result not in (True, False) or not isinstance(self.ttl, int):
+                raise CtrlMsgError('dns_answer must have a result of True or False, and a ttl')
+            if self.result and not isinstance(self.addresses, list):
+                raise CtrlMsgError('dns_answer must have addresses')
+
+        if self.msg_type in (self.TYPE_PING, self.TYPE_PONG):
+            if not isinstance(self.timestamp, (int, float)):
+                raise CtrlMsgError('{} must have a timestamp'.format(self.msg_type))
+
+        if self.msg_type == self.TYPE_FLOW:
+            if self.paused not in (True, False):
+                raise CtrlMsgError('flow must have paused of True or False')
+
+    def validate(self):
+        """
+        Raise CtrlMsgError if the message can't be sent, check it before it's queued.
+        """
+        self._validate()
+        if self.msg_type == self.TYPE_REQUEST and self.address_type in self.ADDRESS_FAMILIES:
+            try:
+                socket.inet_pton(self.ADDRESS_FAMILIES[self.address_type], self.dst_addr)
+            except (OSError, TypeError) as e:
+                raise CtrlMsgError('request dst_addr is not an IP of address_type {}: {}'.format(self.address_type, e))
+
     def to_str(self):
         self._validate()
 
@@ -154,14 +261,154 @@ class CtrlMsg():
                 'total_bytes'       : self.total_bytes,
             }
 
+        elif self.msg_type == self.TYPE_RESUME:
+            ctrl_dict = {
+                'result'    : self.result,
+                'received'  : self.received,
+            }
+
+        elif self.msg_type == self.TYPE_ACK:
+            ctrl_dict = {
+                'received'  : self.received,
+            }
+
+        elif self.msg_type == self.TYPE_UDP_ASSOCIATE:
+            ctrl_dict = {}
+
+        elif self.msg_type == self.TYPE_DNS:
+            ctrl_dict = {
+                'dst_addr'  : self.dst_addr,
+            }
+
+        elif self.msg_type == self.TYPE_DNS_ANSWER:
+            ctrl_dict = {
+                'result'    : self.result,
+                'reason'    : self.reason,
+                'addresses' : self.addresses,
+                'ttl'       : self.ttl,
+            }
+
+        elif self.msg_type in (self.TYPE_PING, self.TYPE_PONG):
+            ctrl_dict = {
+                'timestamp' : self.timestamp,
+            }
+
+        elif self.msg_type == self.TYPE_FLOW:
+            ctrl_dict = {
+                'paused'    : self.paused,
+            }
+
         ctrl_dict['msg_type']   = self.msg_type
         ctrl_dict['stream_id']  = self.stream_id
         ctrl_dict['padding']    = self.padding
 
         return json.dumps(ctrl_dict)
 
+    def to_bytes(self):
+        """
+        The binary format: BINARY_HEADER, the fixed fields of the type, then for a
+        request the IP bytes, or the domain as a str field, then the str fields,
+        each a 2-bytes length + utf-8, then for a dns_answer the number of
+        addresses and each one as 1-byte length + IP bytes. The padding is the
+        rest of the message.
+        """
+        self._validate()
+        code, fixed, fixed_fields, str_fields = self.BINARY_LAYOUTS[self.msg_type]
+
+        chunks = [self.BINARY_HEADER.pack(code, self.stream_id)]
+        try:
+            chunks.append(fixed.pack(*[getattr(self, name) for name in fixed_fields]))
+
+            if self.msg_type == self.TYPE_REQUEST:
+                family = self.ADDRESS_FAMILIES.get(self.address_type)
+                if family:
+                    chunks.append(socket.inet_pton(family, self.dst_addr))
+                else:
+                    chunks.append(self._pack_str(self.dst_addr))
+
+            for name in str_fields:
+                chunks.append(self._pack_str(getattr(self, name)))
+
+            if self.msg_type == self.TYPE_DNS_ANSWER:
+                addresses = self.addresses
+                if addresses is None:
+                    chunks.append(self.STR_LENGTH.pack(self.NONE_LENGTH))
+                else:
+                    chunks.append(self.STR_LENGTH.pack(len(addresses)))
+                    for address in addresses:
+                        # the scope of a link-local IPv6, e.g. fe80::1%eth0, is of no use to the peer
+                        address = address.partition('%')[0]
+                        packed = socket.inet_pton(socket.AF_INET6 if ':' in address else socket.AF_INET, address)
+                        chunks.append(bytes((len(packed),)) + packed)
+
+        except (struct.error, OSError, TypeError) as e:
+            raise CtrlMsgError('can not encode {}: {}'.format(self.msg_type, e))
+
+        if self.padding:
+            chunks.append(self.padding.encode())
+        return b''.join(chunks)
+
+    def _pack_str(self, value):
+        if value is None:
+            return self.STR_LENGTH.pack(self.NONE_LENGTH)
+        data = str(value).encode()
+        return self.STR_LENGTH.pack(len(data)) + data
+
+    def _unpack_str(self, data, offset):
+        length, = self.STR_LENGTH.unpack_from(data, offset)
+        offset += self.STR_LENGTH.size
+        if length == self.NONE_LENGTH:
+            return None, offset
+        if offset + length > len(data):
+            raise ValueError('truncated str field')
+        return bytes(data[offset:offset+length]).decode(), offset + length
+
+    def from_bytes(self, data):
+        """
+        Parse a message of to_bytes(), the fields not in its layout are left as they are.
+        """
+        try:
+            code, self.stream_id = self.BINARY_HEADER.unpack_from(data)
+            self.msg_type = self.BINARY_TYPES[code]
+            _code, fixed, fixed_fields, str_fields = self.BINARY_LAYOUTS[self.msg_type]
+
+            offset = self.BINARY_HEADER.size
+            for name, value in zip(fixed_fields, fixed.unpack_from(data, offset)):
+                setattr(self, name, value)
+            offset += fixed.size
+
+            if self.msg_type == self.TYPE_REQUEST:
+                family = self.ADDRESS_FAMILIES.get(self.address_type)
+                if family:
+                    size = 4 if family == socket.AF_INET else 16
+                    self.dst_addr = socket.inet_ntop(family, bytes(data[offset:offset+size]))
+                    offset += size
+                else:
+                    self.dst_addr, offset = self._unpack_str(data, offset)
+
+            for name in str_fields:
+                value, offset = self._unpack_str(data, offset)
+                setattr(self, name, value)
+
+            if self.msg_type == self.TYPE_DNS_ANSWER:
+                count, = self.STR_LENGTH.unpack_from(data, offset)
+                offset += self.STR_LENGTH.size
+                self.addresses = None if count == self.NONE_LENGTH else []
+                for _x in range(count if self.addresses is not None else 0):
+                    size = data[offset]
+                    family = socket.AF_INET if size == 4 else socket.AF_INET6
+                    self.addresses.append(socket.inet_ntop(family, bytes(data[offset+1:offset+1+size])))
+                    offset += 1 + size
+
+        except (struct.error, KeyError, IndexError, ValueError) as e:
+            raise CtrlMsgError('bad binary control message: {}'.format(e))
+
+        self._validate()
+
     def from_str(self, ctrl_str):
         ctrl_dict = json.loads(ctrl_str)
+        if not isinstance(ctrl_dict, dict):
+            raise CtrlMsgError('control message must be a json object: {}'.format(ctrl_str[:100]))
 
         self.msg_type       = ctrl_dict.get('msg_type')
         self.stream_id      = ctrl_dict.get('stream_id')
@@ -188,4 +435,102 @@ class CtrlMsg():
         self.total_requests     = ctrl_dict.get('total_requests')
         self.total_bytes        = ctrl_dict.get('total_bytes')
 
+        self.received   = ctrl_dict.get('received')
+
+        self.addresses  = ctrl_dict.get('addresses')
+        self.ttl        = ctrl_dict.get('ttl')
+
+        self.timestamp  = ctrl_dict.get('timestamp')
+
+        self.paused     = ctrl_dict.get('paused')
+
         self._validate()
+
+
+def _test_main():
+    import timeit
+
+    messages = [
+        CtrlMsg(msg_type=CtrlMsg.TYPE_REQUEST, stream_id=1, address_type=3, dst_addr='example.com', dst_port=443),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_REQUEST, stream_id=3, address_type=1, dst_addr='93.184.216.34', dst_port=80),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_REQUEST, stream_id=5, address_type=4, dst_addr='2001:db8::1', dst_port=80),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_RESPONSE, stream_id=1, result=False, reason=CtrlMsg.REASON_NEGATIVE_BALANCE),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_RESPONSE, stream_id=3, result=True),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_CHARGE, stream_id=2, coin='nano', server_account='xrb_1',
+                price_kilo_requests='0.01', price_gigabytes='0.1'),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_SIGNATURE, stream_id=7, client_account='xrb_3',
+                timestamped_msg='1-message-to-sign', signature='ab' * 64),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_BALANCE, stream_id=4, balance='1', total_pay='2',
+                total_spend='1', total_requests='10', total_bytes='1000'),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_RESUME, stream_id=6, result=True, received=2**40),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_ACK, stream_id=9, received=0),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_UDP_ASSOCIATE, stream_id=11),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_DNS, stream_id=13, dst_addr='example.com'),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_DNS_ANSWER, stream_id=13, result=True, ttl=60,
+                addresses=['93.184.216.34', '2606:2800:220:1:248:1893:25c8:1946']),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_PING, stream_id=17, timestamp=12345.678),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_PONG, stream_id=17, timestamp=12345.678),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_FLOW, stream_id=19, paused=True),
+        CtrlMsg(msg_type=CtrlMsg.TYPE_DNS_ANSWER, stream_id=15, result=False, ttl=0, reason='timeout'),
+    ]
+
+    for ctrl in messages:
+        from_bytes = CtrlMsg()
+        from_bytes.from_bytes(ctrl.to_bytes())
+        assert from_bytes.to_str() == ctrl.to_str(), (from_bytes, ctrl)
+
+    scoped = CtrlMsg(msg_type=CtrlMsg.TYPE_DNS_ANSWER, stream_id=13, result=True, ttl=60, addresses=['fe80::1%eth0', '10.0.0.1'])
+    from_bytes = CtrlMsg()
+    from_bytes.from_bytes(scoped.to_bytes())
+    assert from_bytes.addresses == ['fe80::1', '10.0.0.1'], from_bytes.addresses
+
+    for ctrl_str in ('{"msg_type": "x", "stream_id": 1}', '{"msg_type": ["request"], "stream_id": 1}'):
+        try:
+            CtrlMsg().from_str(ctrl_str)
+            assert False, ctrl_str
+        except CtrlMsgError as e:
+            assert 'request/response/cryptocoin/' in str(e), e
+
+    for data in (b'', b'\x01\x00\x00\x00\x01\x01', b'\x63\x00\x00\x00\x01', b'\x02\x00\x00\x00\x00\x01\xff\xff'):
+        try:
+            CtrlMsg().from_bytes(data)
+            assert False, data
+        except CtrlMsgError:
+            pass
+
+    # checked before queued, instead of failing in the sender task
+    for bad in (
+            CtrlMsg(msg_type=CtrlMsg.TYPE_REQUEST, stream_id=1, address_type=3, dst_addr='example.com', dst_port=99999),
+            CtrlMsg(msg_type=CtrlMsg.TYPE_REQUEST, stream_id=1, address_type=1, dst_addr='example.com', dst_port=80),
+            CtrlMsg(msg_type=CtrlMsg.TYPE_REQUEST, stream_id=1, address_type=2, dst_addr='example.com', dst_port=80)):
+        for check in (bad.validate, bad.to_bytes):
+            try:
+                check()
+                assert False, bad.dst_port
+            except CtrlMsgError:
+                pass
+
+    # the messages of a new stream, a request and its response
+    request, response = messages[0], messages[4]
+    request_str, response_str = request.to_str(), response.to_str()
+    request_bytes, response_bytes = request.to_bytes(), response.to_bytes()
+
+    def json_round_trip():
+        CtrlMsg().from_str(request.to_str())
+        CtrlMsg().from_str(response.to_str())
+
+    def binary_round_trip():
+        CtrlMsg().from_bytes(request.to_bytes())
+        CtrlMsg().from_bytes(response.to_bytes())
+
+    number = 20000
+    for name, func, sizes in (
+            ('json', json_round_trip, (len(request_str), len(response_str))),
+            ('binary', binary_round_trip, (len(request_bytes), len(response_bytes)))):
+        seconds = min(timeit.repeat(func, number=number, repeat=5))
+        print('{:6} {:.2f} us per request/response, {} + {} bytes'.format(
+            name, seconds / number * 1e6, *sizes))
+
+
+if __name__ == '__main__':
+    _test_main()
@@ -9,16 +9,130 @@ import sqlite3
 from .log import print_log
 
 
+# prepared statements kept by the connection, more than the statements below
+STATEMENT_CACHE_SIZE = 128
+# KB of pages cached by the connection
+PAGE_CACHE_KB = 16 * 1024
+# milliseconds to wait for the lock of another connection
+BUSY_TIMEOUT = 5000
+
+BILL_KEYS = ('total_pay', 'total_spend', 'balance', 'total_bytes', 'total_requests')
+
+# The statements are constants, so sqlite3 prepares each one once and reuses it.
+
+SELECT_ACCOUNT = 'SELECT * from `nano_account` WHERE `account` = ?'
+
+SELECT_ROLE_ACCOUNTS = 'SELECT `account` from `nano_account` WHERE `role` = ?'
+
+INSERT_ACCOUNT = '''
+    INSERT OR IGNORE INTO `nano_account`
+    (`account`, `role`, `frontier`)
+    VALUES (?, ?, ?)'''
+
+UPDATE_ACCOUNT = '''
+    UPDATE `nano_account`
+    SET `frontier` = ?, `role` = ?
+    WHERE `account` = ?'''
+
+# whoever sent money to the server is a client, except the servers, which may send to each other
+SELECT_CLIENT_ACCOUNTS = '''
+    SELECT DISTINCT `account` from `block_chain`
+    WHERE `subtype` = 'receive'
+    AND `account` NOT IN (SELECT `account` from `nano_account` WHERE `role` = ?)'''
+
+SELECT_BLOCK = 'SELECT * from `block_chain` WHERE `hash` = ?'
+
+SELECT_RECEIVE_BLOCKS = '''
+    SELECT `block_chain`.* from `block_chain`
+    JOIN `nano_account` ON `block_chain`.`owner_account` = `nano_account`.`id`
+    WHERE `block_chain`.`subtype` = 'receive' AND `nano_account`.`account` = ? AND `block_chain`.`account` = ?'''
+
+INSERT_BLOCK = '''
+    INSERT OR IGNORE INTO `block_chain`
+    (`owner_account`, `account`, `hash`, `previous`, `type`, `subtype`, `amount`, `balance`,
+    `link`, `representative`, `signature`, `work`, `source`, `destination`, `next`)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+UPDATE_BLOCK = '''
+    UPDATE `block_chain`
+    SET `owner_account` = ?, `account` = ?, `previous` = ?, `type` = ?, `subtype` = ?,
+    `amount` = ?, `balance` = ?, `link` = ?, `representative` = ?, `signature` = ?,
+    `work` = ?, `source` = ?, `destination` = ?, `next` = ?
+    WHERE `hash` = ?'''
+
+# the pay of clients is summed with big_sum(), the amounts in raw overflow the int64 of SUM()
+SELECT_TOTAL_PAYS = '''
+    SELECT `block_chain`.`account`, big_sum(`block_chain`.`amount`) AS `total_pay` from `block_chain`
+    JOIN `nano_account` ON `block_chain`.`owner_account` = `nano_account`.`id`
+    WHERE `block_chain`.`subtype` = 'receive' AND `nano_account`.`role` = ?
+    AND `block_chain`.`account` NOT IN (SELECT `account` from `nano_account` WHERE `role` = ?)
+    GROUP BY `block_chain`.`account`'''
+
+SELECT_TOTAL_PAY = '''
+    SELECT big_sum(`block_chain`.`amount`) AS `total_pay` from `block_chain`
+    JOIN `nano_account` ON `block_chain`.`owner_account` = `nano_account`.`id`
+    WHERE `block_chain`.`subtype` = 'receive' AND `nano_account`.`role` = ? AND `block_chain`.`account` = ?'''
+
+SELECT_BILL = '''
+    SELECT `proxy_bill`.* from `proxy_bill`
+    JOIN `nano_account` ON `proxy_bill`.`client_account` = `nano_account`.`id`
+    WHERE `nano_account`.`account` = ?'''
+
+INSERT_BILL = '''
+    INSERT OR IGNORE INTO `proxy_bill`
+    (`client_account`)
+    SELECT `id` from `nano_account` WHERE `account` = ?'''
+
+UPDATE_BILL = '''
+    UPDATE `proxy_bill`
+    SET `total_pay` = ?, `total_spend` = ?, `balance` = ?,
+    `total_bytes` = ?, `total_requests` = ?
+    WHERE `client_account` = (SELECT `id` from `nano_account` WHERE `account` = ?)'''
+
+class BigSum():
+    """
+    The SQL aggregate big_sum() of int numbers stored as text, exact with python ints.
+    The sum is returned as text too.
+    """
+
+    def __init__(self):
+        self.total = 0
+
+    def step(self, value):
+        if value:
+            self.total += int(value)
+
+    def finalize(self):
+        return str(self.total)
+
+
 class DB():
+    """
+    The database is in WAL mode, readers don't wait for the writer, and a commit
+    doesn't sync unless the WAL is checkpointed. A crash of the server keeps the
+    committed transactions, a power loss may lose the last ones.
+    """
+
     ROLE_SERVER = 'server'
     ROLE_CLIENT = 'client'
 
     def __init__(self, file_name):
         self.file_name = file_name
-        self.conn = sqlite3.connect(file_name)
+        # while batching, the writes are committed by the caller of the batch
+        self.batching = False
+        self.conn = sqlite3.connect(file_name, timeout=BUSY_TIMEOUT / 1000, cached_statements=STATEMENT_CACHE_SIZE)
         self.conn.row_factory = sqlite3.Row
+        self.conn.create_aggregate('big_sum', 1, BigSum)
         self.cursor = self.conn.cursor()
+        self._set_pragmas()
         self._create_table()
+        self._create_indexes()
+
+    def _set_pragmas(self):
+        self.cursor.execute('PRAGMA journal_mode = WAL')
+        self.cursor.execute('PRAGMA synchronous = NORMAL')
+        self.cursor.execute('PRAGMA cache_size = -{}'.format(PAGE_CACHE_KB))
+        self.cursor.execute('PRAGMA temp_store = MEMORY')
 
     def _create_table(self):
         """
@@ -92,42 +206,51 @@ class DB():
 
         self.conn.commit()
 
+    def _create_indexes(self):
+        """
+        The receive blocks are looked up by subtype and client account, and summed
+        by server account. The index has all the columns, the table isn't read.
+        """
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS `index_block_receive_1`
+        ON `block_chain` (`subtype`, `account`, `owner_account`, `amount`);
+        ''')
+
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS `index_account_role_1`
+        ON `nano_account` (`role`, `account`);
+        ''')
+
+        self.conn.commit()
+
     def commit(self):
         # Note: call this method after update bill !!!
-        self.conn.commit()
+        if not self.batching:
+            self.conn.commit()
+
+    def rollback(self):
+        if not self.batching:
+            self.conn.rollback()
 
     def get_account(self, account):
-        self.cursor.execute('SELECT * from `nano_account` WHERE `account` = ?', (account, ))
+        self.cursor.execute(SELECT_ACCOUNT, (account, ))
         return self.cursor.fetchone()  # None or dict
 
     def get_server_accounts(self):
-        self.cursor.execute('''SELECT * from `nano_account` WHERE `role` = "{}"'''.format(self.ROLE_SERVER))
-        accounts = []
-        for account in self.cursor.fetchall():
-            accounts.append(account['account'])
-        return accounts
+        self.cursor.execute(SELECT_ROLE_ACCOUNTS, (self.ROLE_SERVER, ))
+        return [row['account'] for row in self.cursor.fetchall()]
 
     def update_account(self, account, role, frontier=None):
         """
         Insert if new, else update.
         """
         # if account not exist, insert; if exist, ignore.
-        self.cursor.execute('''
-            INSERT OR IGNORE INTO `nano_account`
-            (`account`, `role`, `frontier`)
-            VALUES (?, ?, ?)''',
-            (account, role, frontier)
-        )
+        self.cursor.execute(INSERT_ACCOUNT, (account, role, frontier))
 
         # if account exist, update
-        self.cursor.execute('''
-            UPDATE `nano_account`
-            SET `frontier` = ?, `role` = ?
-            WHERE account = ?''',
-            (frontier, role, account)
-        )
+        self.cursor.execute(UPDATE_ACCOUNT, (frontier, role, account))
 
-        self.conn.commit()
+        self.commit()
         print_log('Updated account {}: {} / {}'.format(role, account, frontier))
 
     def get_client_accounts(self):
@@ -135,126 +258,127 @@ class DB():
         Get all accounts with "receive" subtype in the block_chain history.
         Whoever sent money to the server is a client.
         """
-        self.cursor.execute('''
-            SELECT * from `block_chain`
-            WHERE `subtype` = "receive"'''
-        )
-
-        clients = set()
-        for block in self.cursor.fetchall():
-            clients.add(block['account'])
-
-        # exclude server accounts, since servers may send to each other.
-        servers = self.get_server_accounts()
-        return list(clients - set(servers))
+        self.cursor.execute(SELECT_CLIENT_ACCOUNTS, (self.ROLE_SERVER, ))
+        return [row['account'] for row in self.cursor.fetchall()]
 
     def get_block(self, hash):
-        self.cursor.execute('SELECT * from `block_chain` WHERE `hash` = ?', (hash, ))
+        self.cursor.execute(SELECT_BLOCK, (hash, ))
         return self.cursor.fetchone()  # None or dict
 
     def get_receive_blocks(self, server_account, client_account):
         """
         Get all blocks send from client to server.
         """
-        server_id = self.get_account(server_account)['id']
-        self.cursor.execute('''
-            SELECT * from `block_chain`
-            WHERE `subtype` = "receive" AND `owner_account` = ? AND `account` = ?''',
-            (server_id, client_account)
-        )
+        self.cursor.execute(SELECT_RECEIVE_BLOCKS, (server_account, client_account))
         return self.cursor.fetchall()  # list
 
     def update_block(self, account, block_dict):
         """
         Insert if new, else update.
+        Return (client_account, amount) if a new block received the pay of a client, else None.
+        The pay of a block already in the db was counted when it was inserted.
         """
         block_type = block_dict.get('type')
         if block_type != 'state':
             print_log('Warning: none state block in history.')
 
-        owner_account = self.get_account(account)['id']
+        owner = self.get_account(account)
+        owner_account = owner['id']
 
         # if hash not exist, insert; if exist, ignore.
-        self.cursor.execute('''
-            INSERT OR IGNORE INTO `block_chain`
-            (`owner_account`, `account`, `hash`, `previous`, `type`, `subtype`, `amount`, `balance`,
-            `link`, `representative`, `signature`, `work`, `source`, `destination`, `next`)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-            (
-                owner_account,
-                block_dict.get('account'),
-                block_dict.get('hash'),
-                block_dict.get('previous'),
-                block_dict.get('type'),
-                block_dict.get('subtype'),
-                block_dict.get('amount'),
-                block_dict.get('balance'),
-                block_dict.get('link'),
-                block_dict.get('representative'),
-                block_dict.get('signature'),
-                block_dict.get('work'),
-                block_dict.get('source'),
-                block_dict.get('destination'),
-                block_dict.get('next')
-            )
-        )
+        self.cursor.execute(INSERT_BLOCK, (
+            owner_account,
+            block_dict.get('account'),
+            block_dict.get('hash'),
+            block_dict.get('previous'),
+            block_dict.get('type'),
+            block_dict.get('subtype'),
+            block_dict.get('amount'),
+            block_dict.get('balance'),
+            block_dict.get('link'),
+            block_dict.get('representative'),
+            block_dict.get('signature'),
+            block_dict.get('work'),
+            block_dict.get('source'),
+            block_dict.get('destination'),
+            block_dict.get('next'),
+        ))
+        inserted = self.cursor.rowcount == 1
 
         # if hash exist, update
-        self.cursor.execute('''
-            UPDATE `block_chain`
-            SET `owner_account` = ?, `account` = ?, `previous` = ?, `type` = ?, `subtype` = ?,
-            `amount` = ?, `balance` = ?, `link` = ?, `representative` = ?, `signature` = ?,
-            `work` = ?, `source` = ?, `destination` = ?, `next` = ?
-            WHERE `hash` = ?''',
-            (
-                owner_account,
-                block_dict.get('account'),
-                block_dict.get('previous'),
-                block_dict.get('type'),
-                block_dict.get('subtype'),
-                block_dict.get('amount'),
-                block_dict.get('balance'),
-                block_dict.get('link'),
-                block_dict.get('representative'),
-                block_dict.get('signature'),
-                block_dict.get('work'),
-                block_dict.get('source'),
-                block_dict.get('destination'),
-                block_dict.get('next'),
-                block_dict.get('hash'),
-            )
-        )
-
-        self.conn.commit()
+        self.cursor.execute(UPDATE_BLOCK, (
+            owner_account,
+            block_dict.get('account'),
+            block_dict.get('previous'),
+            block_dict.get('type'),
+            block_dict.get('subtype'),
+            block_dict.get('amount'),
+            block_dict.get('balance'),
+            block_dict.get('link'),
+            block_dict.get('representative'),
+            block_dict.get('signature'),
+            block_dict.get('work'),
+            block_dict.get('source'),
+            block_dict.get('destination'),
+            block_dict.get('next'),
+            block_dict.get('hash'),
+        ))
+
+        self.commit()
         print_log('Updated account block: {} / {}'.format(account, block_dict['hash']))
 
-    def _update_bill(self, account, key, value):
-        # Note: to avoid commit too often, will not auto commit here.
-        # call db.commit() after update bill !!!
+        if not inserted or block_dict.get('subtype') != 'receive' or owner['role'] != self.ROLE_SERVER:
+            return None
 
-        client_account = self.get_account(account)['id']
-        # if not exist, insert; if exist, ignore.
-        self.cursor.execute('''
-            INSERT OR IGNORE INTO `proxy_bill`
-            (`client_account`, `{}`)
-            VALUES (?, ?)'''.format(key),
-            (client_account, value)
-        )
+        # the servers may send to each other, that's not a pay
+        client_account = block_dict.get('account')
+        sender = self.get_account(client_account)
+        if sender and sender['role'] == self.ROLE_SERVER:
+            return None
 
-        # if client_account exist, update
-        self.cursor.execute('''
-            UPDATE `proxy_bill`
-            SET `{}` = ?
-            WHERE client_account = ?'''.format(key),
-            (value, client_account)
-        )
+        return client_account, int(block_dict.get('amount') or 0)
+
+    def get_total_pays(self):
+        """
+        Sum the pay of all clients to all server accounts, in one query.
+        Return {client_account: total_pay}.
+        """
+        self.cursor.execute(SELECT_TOTAL_PAYS, (self.ROLE_SERVER, self.ROLE_SERVER))
+        return {row['account']: int(row['total_pay']) for row in self.cursor.fetchall()}
+
+    def get_total_pay(self, client_account):
+        """
+        Sum the pay of one client to all server accounts.
+        """
+        self.cursor.execute(SELECT_TOTAL_PAY, (self.ROLE_SERVER, client_account))
+        # NULL if the client paid nothing, the aggregate isn't run without a row
+        return int(self.cursor.fetchone()['total_pay'] or 0)
 
-        # self.conn.commit()
-        # print_log('Updated client_account {}: {} / {}'.format(key, account, value))
+    def update_bills(self, bills):
+        """
+        Write many bills in one transaction.
+        bills: {account: {'total_pay': '0', 'total_spend': '0', ...}}
+        """
+        try:
+            self.cursor.executemany(INSERT_BILL, [(account, ) for account in bills])
+            self.cursor.executemany(UPDATE_BILL, [
+                (
+                    bill['total_pay'],
+                    bill['total_spend'],
+                    bill['balance'],
+                    bill['total_bytes'],
+                    bill['total_requests'],
+                    account,
+                )
+                for account, bill in bills.items()
+            ])
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
 
     def get_bill(self, account):
-        client_account = self.get_account(account)['id']
-        self.cursor.execute('SELECT * from `proxy_bill` WHERE `client_account` = ?', (client_account, ))
+        self.cursor.execute(SELECT_BILL, (account, ))
         bill = self.cursor.fetchone()  # None or dict
         if not bill:
             return {}
@@ -265,37 +389,93 @@ class DB():
                 bill_dict[key] = bill[key]
         return bill_dict
 
-    def _increase_bill(self, account, key, amount):
-        current = self.get_bill(account)[key]
-        total = str(int(current) + int(amount))
-        self._update_bill(account, key, total)
-
-    def update_total_pay(self, account, total_pay):
-        self._update_bill(account, 'total_pay', total_pay)
-
-    def increase_total_spend(self, account, increase):
-        self._increase_bill(account, 'total_spend', increase)
-
-    def increase_total_bytes(self, account, increase):
-        self._increase_bill(account, 'total_bytes', increase)
-
-    def increase_total_requests(self, account, increase):
-        self._increase_bill(account, 'total_requests', increase)
-
-    def update_bill_balance(self, account):
-        bill = self.get_bill(account)
-        balance = int(bill['total_pay']) - int(bill['total_spend'])
-        self._update_bill(account, 'balance', str(balance))
-
-    def get_bill_balance(self, account):
-        bill = self.get_bill(account)
-        balance = int(bill['balance'])
-        return balance
+    def get_bills(self, accounts):
+        """
+        Return {account: bill} of many accounts.
+        """
+        return {account: self.get_bill(account) for account in accounts}
+
+
+def _bench(db_class, file_name, clients=10000, blocks=100000, servers=2):
+    """
+    Return {operation: per second} of a database with `blocks` receive blocks
+    from `clients` client accounts to `servers` server accounts.
+    """
+    import os
+    import time
+    import random
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(file_name + suffix):
+            os.remove(file_name + suffix)
+
+    db = db_class(file_name)
+    server_accounts = ['xrb_server{}'.format(x) for x in range(servers)]
+    client_accounts = ['xrb_client{}'.format(x) for x in range(clients)]
+    random.seed(1)
+
+    def block(x):
+        return {
+            'type': 'state', 'subtype': 'receive', 'hash': 'hash{}'.format(x),
+            'account': client_accounts[x % clients], 'amount': str(random.getrandbits(100)),
+        }
+
+    results = {}
+
+    def timed(name, count, func):
+        start = time.time()
+        func()
+        results[name] = round(count / (time.time() - start))
+
+    for account in server_accounts:
+        db.update_account(account, DB.ROLE_SERVER)
+
+    # a commit each, like the sync with Nano
+    sample = 2000
+    timed('update_block', sample, lambda: [
+        db.update_block(server_accounts[x % servers], block(x)) for x in range(sample)])
+
+    # the rest of the history in one transaction
+    server_ids = [db.get_account(account)['id'] for account in server_accounts]
+    db.cursor.executemany(INSERT_BLOCK, [
+        (server_ids[x % servers], b['account'], b['hash'], None, b['type'], b['subtype'], b['amount'],
+         None, None, None, None, None, None, None, None)
+        for x, b in ((x, block(x)) for x in range(sample, blocks))
+    ])
+    db.cursor.executemany(INSERT_ACCOUNT, [(account, DB.ROLE_CLIENT, None) for account in client_accounts])
+    db.commit()
+
+    timed('get_client_accounts', 1, db.get_client_accounts)
+    timed('get_total_pays', 1, db.get_total_pays)
+
+    pairs = [(random.choice(server_accounts), random.choice(client_accounts)) for _x in range(2000)]
+    timed('get_receive_blocks', len(pairs), lambda: [db.get_receive_blocks(*pair) for pair in pairs])
+    timed('get_total_pay', len(pairs), lambda: [db.get_total_pay(client) for _server, client in pairs])
+
+    bills = {account: {key: str(random.getrandbits(64)) for key in BILL_KEYS} for account in client_accounts}
+    timed('update_bills', len(bills), lambda: db.update_bills(bills))
+    timed('get_bill', len(pairs), lambda: [db.get_bill(client) for _server, client in pairs])
+
+    total_pays = db.get_total_pays()
+    for client in client_accounts[:100]:
+        pay = sum(int(b['amount']) for server in server_accounts for b in db.get_receive_blocks(server, client))
+        assert total_pays[client] == db.get_total_pay(client) == pay
+
+    # a new pay is counted by the block that brings it, once
+    new_block = block(blocks)
+    pay = db.update_block(server_accounts[0], new_block)
+    assert pay == (new_block['account'], int(new_block['amount']))
+    assert db.update_block(server_accounts[0], new_block) is None
+
+    db.conn.close()
+    return results
 
 
 def test_main():
-    db = DB('/tmp/test.db')
-    db.get_account('xrb_1ipx847tk8o46pwxt5qjdbncjqcbwcc1rrmqnkztrfjy5k7z4imsrata9est')
+    global print_log
+    # update_block() logs every block
+    print_log = lambda *args: None
+    print(_bench(DB, '/tmp/test.db'))
 
 
 if __name__ == '__main__':
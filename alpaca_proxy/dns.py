@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+# A local DNS listener of the proxy client, A/AAAA queries are resolved by the server and cached.
+
+# Author: twitter.com/alpacatunnel
+
+
+import time
+import struct
+import asyncio
+import ipaddress
+from collections import OrderedDict
+
+from .log import print_log
+
+
+DNS_TIMEOUT = 5
+CACHE_SIZE = 4096
+# an entry hit this many times is refreshed when PREFETCH_RATIO of its ttl is left
+PREFETCH_HITS = 3
+PREFETCH_RATIO = 0.1
+# a response over UDP must fit in 512 bytes, over TCP in its 2-byte length
+MAX_UDP_SIZE = 512
+MAX_TCP_SIZE = 65535
+
+TYPE_A = 1
+TYPE_AAAA = 28
+CLASS_IN = 1
+
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+
+HEADER = struct.Struct('!HHHHHH')
+
+
+class DnsError(Exception):
+    pass
+
+
+def parse_query(data):
+    """
+    Return (query_id, flags, name, qtype, question) of a query with one question.
+    """
+    if len(data) < HEADER.size:
+        raise DnsError('dns message too short')
+
+    query_id, flags, qdcount, _ancount, _nscount, _arcount = HEADER.unpack_from(data)
+    if flags & FLAG_QR or qdcount != 1:
+        raise DnsError('not a query with one question')
+
+    labels = []
+    offset = HEADER.size
+    while True:
+        if offset >= len(data):
+            raise DnsError('truncated question')
+        length = data[offset]
+        if length == 0:
+            offset += 1
+            break
+        if length & 0xC0:
+            raise DnsError('compressed name in question')
+        labels.append(bytes(data[offset+1:offset+1+length]))
+        offset += 1 + length
+
+    if offset + 4 > len(data):
+        raise DnsError('truncated question')
+    qtype, _qclass = struct.unpack_from('!HH', data, offset)
+
+    name = b'.'.join(labels).decode(errors='replace').lower()
+    return query_id, flags, name, qtype, bytes(data[HEADER.size:offset+4])
+
+
+def build_response(query_id, flags, question, qtype, addresses, ttl, rcode=RCODE_NOERROR, max_size=MAX_UDP_SIZE):
+    """
+    Answer the question with the addresses of its type, other types get no answer.
+    The answers that don't fit in max_size are dropped and TC is set, so the
+    client asks again over TCP.
+    """
+    flags = FLAG_QR | FLAG_RA | (flags & FLAG_RD) | rcode
+    answers = []
+    size = HEADER.size + len(question)
+    for address in addresses or ():
+        ip = ipaddress.ip_address(address)
+        if (qtype, ip.version) not in ((TYPE_A, 4), (TYPE_AAAA, 6)):
+            continue
+        rdata = ip.packed
+        # the name is a pointer to the question
+        answer = b'\xc0\x0c' + struct.pack('!HHIH', qtype, CLASS_IN, ttl, len(rdata)) + rdata
+        if size + len(answer) > max_size:
+            flags |= FLAG_TC
+            break
+        answers.append(answer)
+        size += len(answer)
+
+    return HEADER.pack(query_id, flags, 1, len(answers), 0, 0) + question + b''.join(answers)
+
+
+class DnsCache():
+    """
+    No io involved. A LRU cache of name: addresses, each entry expires after
+    its ttl. addresses is None for a name that doesn't exist.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        # name: [expire_time, ttl, addresses, hits]
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name):
+        """
+        Return (addresses, ttl left, prefetch), or None if not cached. prefetch is
+        True for a popular entry about to expire.
+        """
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+
+        expire_time, ttl, addresses, hits = entry
+        left = expire_time - time.time()
+        if left <= 0:
+            del self._entries[name]
+            return None
+
+        self._entries.move_to_end(name)
+        entry[3] = hits + 1
+        prefetch = entry[3] >= PREFETCH_HITS and left <= ttl * PREFETCH_RATIO
+        return addresses, int(left), prefetch
+
+    def set(self, name, addresses, ttl):
+        if ttl <= 0:
+            return
+        self._entries[name] = [time.time() + ttl, ttl, addresses, 0]
+        self._entries.move_to_end(name)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class DnsForwarder():
+    """
+    `lookup` is a coroutine function, lookup(name) returns (addresses, ttl), with
+    addresses None if the name doesn't exist, and raises if the lookup failed.
+
+    Concurrent queries of a name share one lookup, and popular names are looked up
+    again before they expire. Failed lookups are answered with SERVFAIL, not cached.
+    """
+
+    def __init__(self, lookup, cache_size=CACHE_SIZE, timeout=DNS_TIMEOUT):
+        self.lookup = lookup
+        self.cache = DnsCache(cache_size)
+        self.timeout = timeout
+        self._pending = {}
+
+        self.queries = 0
+        self.hits = 0
+        self.lookups = 0
+        self.prefetches = 0
+
+    def _fetch(self, name):
+        future = self._pending.get(name)
+        if future is None:
+            future = self._pending[name] = asyncio.ensure_future(self._lookup(name))
+            future.add_done_callback(lambda _f: self._pending.pop(name, None))
+        return future
+
+    async def _lookup(self, name):
+        self.lookups += 1
+        addresses, ttl = await asyncio.wait_for(self.lookup(name), self.timeout)
+        self.cache.set(name, addresses, ttl)
+        return addresses, ttl
+
+    async def resolve(self, name):
+        """
+        Return (addresses, ttl), addresses is None if the name doesn't exist.
+        """
+        self.queries += 1
+        cached = self.cache.get(name)
+        if cached is not None:
+            self.hits += 1
+            addresses, ttl, prefetch = cached
+            if prefetch and name not in self._pending:
+                self.prefetches += 1
+                # nobody waits for it, a failure only means no refresh
+                self._fetch(name).add_done_callback(lambda f: f.cancelled() or f.exception())
+            return addresses, ttl
+
+        # one waiter cancelled should not cancel the shared lookup
+        return await asyncio.shield(self._fetch(name))
+
+    async def answer(self, data, max_size=MAX_UDP_SIZE):
+        """
+        Return the response to a query, or None if it's not a query.
+        """
+        try:
+            query_id, flags, name, qtype, question = parse_query(data)
+        except DnsError as e:
+            print_log('dns query dropped: {}'.format(e))
+            return None
+
+        try:
+            addresses, ttl = await self.resolve(name)
+        except Exception as e:
+            print_log('dns lookup failed for {}: {!r}'.format(name, e))
+            return build_response(query_id, flags, question, qtype, None, 0, RCODE_SERVFAIL)
+
+        rcode = RCODE_NOERROR if addresses is not None else RCODE_NXDOMAIN
+        return build_response(query_id, flags, question, qtype, addresses, ttl, rcode, max_size)
+
+    def stats(self):
+        return {
+            'queries': self.queries,
+            'hits': self.hits,
+            'lookups': self.lookups,
+            'prefetches': self.prefetches,
+            'cached': len(self.cache),
+        }
+
+
+class DnsUdpProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, forwarder):
+        self.forwarder = forwarder
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        asyncio.ensure_future(self._reply(data, addr))
+
+    async def _reply(self, data, addr):
+        response = await self.forwarder.answer(data)
+        if response and not self.transport.is_closing():
+            self.transport.sendto(response, addr)
+
+
+async def dns_tcp_handler(forwarder, reader, writer):
+    """
+    Over TCP, each message is prefixed with its 2-byte length.
+    """
+    try:
+        while True:
+            length = struct.unpack('!H', await reader.readexactly(2))[0]
+            response = await forwarder.answer(await reader.readexactly(length), MAX_TCP_SIZE)
+            if response is None:
+                break
+            writer.write(struct.pack('!H', len(response)) + response)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_dns_server(forwarder, host, port):
+    loop = asyncio.get_event_loop()
+    await loop.create_datagram_endpoint(lambda: DnsUdpProtocol(forwarder), local_addr=(host, port))
+    await asyncio.start_server(lambda r, w: dns_tcp_handler(forwarder, r, w), host, port)
+    print_log('dns server listening on {}:{}'.format(host, port))
+
+
+def _test_main():
+    lookups = []
+
+    async def lookup(name):
+        lookups.append(name)
+        await asyncio.sleep(0.01)
+        if name == 'nx.example':
+            return None, 30
+        return ['93.184.216.34', '2606:2800:220:1:248:1893:25c8:1946'], 1
+
+    def query(name, qtype, query_id=0x1234):
+        question = b''.join(bytes([len(label)]) + label.encode() for label in name.split('.')) + b'\x00'
+        return HEADER.pack(query_id, FLAG_RD, 1, 0, 0, 0) + question + struct.pack('!HH', qtype, CLASS_IN)
+
+    async def main():
+        forwarder = DnsForwarder(lookup)
+
+        # concurrent queries share one lookup
+        responses = await asyncio.gather(*[forwarder.answer(query('example.com', TYPE_A)) for _x in range(10)])
+        assert lookups == ['example.com']
+        _id, flags, _qd, ancount, _ns, _ar = HEADER.unpack_from(responses[0])
+        assert flags & 0xF == RCODE_NOERROR and ancount == 1
+        assert responses[0].endswith(bytes([93, 184, 216, 34]))
+
+        response = await forwarder.answer(query('example.com', TYPE_AAAA))
+        assert HEADER.unpack_from(response)[3] == 1 and len(lookups) == 1
+
+        response = await forwarder.answer(query('nx.example', TYPE_A))
+        assert HEADER.unpack_from(response)[1] & 0xF == RCODE_NXDOMAIN
+
+        # a popular name is looked up again before it expires
+        await forwarder.answer(query('example.com', TYPE_A))
+        await asyncio.sleep(0.95)
+        await forwarder.answer(query('example.com', TYPE_A))
+        await asyncio.sleep(0.05)
+        assert lookups.count('example.com') == 2, lookups
+
+        # over UDP the answers that don't fit in 512 bytes are dropped, with TC
+        addresses = ['10.0.{}.{}'.format(x // 256, x % 256) for x in range(100)]
+        response = build_response(0x1234, FLAG_RD, query('example.com', TYPE_A)[HEADER.size:], TYPE_A, addresses, 60)
+        _id, flags, _qd, ancount, _ns, _ar = HEADER.unpack_from(response)
+        assert len(response) <= MAX_UDP_SIZE and flags & FLAG_TC and 0 < ancount < 100
+        response = build_response(0x1234, FLAG_RD, query('example.com', TYPE_A)[HEADER.size:], TYPE_A, addresses, 60, max_size=MAX_TCP_SIZE)
+        _id, flags, _qd, ancount, _ns, _ar = HEADER.unpack_from(response)
+        assert not flags & FLAG_TC and ancount == 100
+        print(forwarder.stats())
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+if __name__ == '__main__':
+    _test_main()
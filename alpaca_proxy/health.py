@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+# Round-trip time, jitter and stalls of a tunnel, measured with timestamped ping/pong messages.
+
+# Author: twitter.com/alpacatunnel
+
+
+import time
+
+from .ctrl_msg import CtrlMsg
+from .ws_helper import ws_send_ctrl
+
+
+# seconds between the pings of a tunnel
+PING_INTERVAL = 0.5
+# a ping not answered in srtt + 4 * jitter, within these bounds, is lost
+PING_MIN_TIMEOUT = 0.2
+PING_MAX_TIMEOUT = 1.0
+# seconds without anything received before the tunnel is stalled, and reconnected
+STALL_TIMEOUT = 3
+
+
+class TunnelHealth():
+    """
+    No io involved. `srtt` and `jitter` (rttvar) are smoothed like TCP's, RFC 6298.
+    A lost ping marks the tunnel unhealthy until the next pong. A tunnel is stalled
+    when nothing was received for `stall_timeout` seconds, pongs or data, 0 never stalls.
+    """
+
+    def __init__(self, stall_timeout=STALL_TIMEOUT):
+        self.stall_timeout = stall_timeout
+
+        self.srtt = None
+        self.jitter = None
+        self.min_rtt = None
+
+        self.healthy = True
+        self.last_pong = 0
+        self.last_heard = time.monotonic()
+
+        self.pongs = 0
+        self.lost = 0
+        self.stalls = 0
+
+    def reset(self):
+        """
+        A new websocket, the rtt of the old one is a good guess until the first pong.
+        """
+        self.healthy = True
+        self.last_heard = time.monotonic()
+
+    def heard(self):
+        self.last_heard = time.monotonic()
+
+    def pong(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.jitter = rtt, rtt / 2
+        else:
+            self.jitter = self.jitter * 3 / 4 + abs(self.srtt - rtt) / 4
+            self.srtt = self.srtt * 7 / 8 + rtt / 8
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+
+        self.healthy = True
+        self.last_pong = self.last_heard = time.monotonic()
+        self.pongs += 1
+
+    def ping_timeout(self):
+        if self.srtt is None:
+            return PING_MAX_TIMEOUT
+        return min(max(self.srtt + 4 * self.jitter, PING_MIN_TIMEOUT), PING_MAX_TIMEOUT)
+
+    def ping_lost(self):
+        """
+        Return True if the tunnel was healthy before.
+        """
+        was_healthy, self.healthy = self.healthy, False
+        self.lost += 1
+        return was_healthy
+
+    def stalled(self):
+        if not self.stall_timeout or time.monotonic() - self.last_heard < self.stall_timeout:
+            return False
+        self.stalls += 1
+        return True
+
+    def stats(self):
+        def ms(seconds):
+            return seconds and round(seconds * 1000, 1)
+
+        return {
+            'rtt_ms': ms(self.srtt),
+            'jitter_ms': ms(self.jitter),
+            'min_rtt_ms': ms(self.min_rtt),
+            'healthy': self.healthy,
+            'pongs': self.pongs,
+            'lost': self.lost,
+            'stalls': self.stalls,
+            'idle_s': round(time.monotonic() - self.last_heard, 1),
+        }
+
+
+async def ws_send_ping(ws, mp_session, timestamp):
+    """
+    Sent right away, not queued nor kept for replay, like the acks.
+    """
+    ctrl = CtrlMsg(msg_type=CtrlMsg.TYPE_PING, stream_id=mp_session.new_stream(), timestamp=timestamp)
+    mp_session.del_stream(ctrl.stream_id)
+    await ws_send_ctrl(ws, mp_session, ctrl)
+
+
+async def ws_send_pong(ws, mp_session, ping):
+    """
+    The pong carries the timestamp of the ping, only the pinging side reads its clock.
+    """
+    ctrl = CtrlMsg(msg_type=CtrlMsg.TYPE_PONG, stream_id=ping.stream_id, timestamp=ping.timestamp)
+    await ws_send_ctrl(ws, mp_session, ctrl)
+
+
+def _test_main():
+    health = TunnelHealth(stall_timeout=0.1)
+    for rtt in (0.100, 0.100, 0.100, 0.100):
+        health.pong(rtt)
+    steady_jitter = health.jitter
+
+    for rtt in (0.050, 0.200, 0.080, 0.300):
+        health.pong(rtt)
+    assert health.jitter > steady_jitter and health.min_rtt == 0.050
+    assert PING_MIN_TIMEOUT <= health.ping_timeout() <= PING_MAX_TIMEOUT
+
+    assert health.ping_lost() and not health.ping_lost() and not health.healthy
+    health.pong(0.1)
+    assert health.healthy
+
+    assert not health.stalled()
+    time.sleep(0.15)
+    assert health.stalled()
+    health.heard()
+    assert not health.stalled()
+    print(health.stats())
+
+
+if __name__ == '__main__':
+    _test_main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+# Parse the requests of HTTP proxy clients, CONNECT and plain HTTP with absolute URIs.
+
+# Author: twitter.com/alpacatunnel
+
+
+import ipaddress
+from urllib.parse import urlsplit
+
+from .socks5 import Socks5Parser
+
+
+# request heads larger than this are refused
+MAX_HEAD_SIZE = 64 * 1024
+
+# hop-by-hop headers meant for the proxy, not sent to the origin server
+PROXY_HEADERS = (b'proxy-connection', b'proxy-authorization', b'keep-alive')
+
+
+class HttpProxyError(Exception):
+    """
+    `reply` is sent to the client before closing, if not empty.
+    """
+
+    def __init__(self, msg, reply=b''):
+        super().__init__(msg)
+        self.reply = reply
+
+
+def http_response(status, reason):
+    return 'HTTP/1.1 {} {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.format(status, reason).encode()
+
+
+def split_host_port(authority, default_port):
+    """
+    Return (host, port) of b'host:port', b'[IPv6]:port' or b'host'.
+    """
+    authority = authority.decode('latin-1')
+    if authority.startswith('['):
+        host, _bracket, port = authority[1:].partition(']')
+        port = port[1:]
+    elif authority.count(':') == 1:
+        host, _colon, port = authority.partition(':')
+    else:
+        host, port = authority, ''
+
+    if not host:
+        raise ValueError('no host in {}'.format(authority))
+    if not port:
+        return host, default_port
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError('bad port in {}'.format(authority))
+    return host, int(port)
+
+
+def address_type_of(host):
+    try:
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        return Socks5Parser.ADDRESS_TYPE_DOMAIN
+    return Socks5Parser.ADDRESS_TYPE_IPV4 if ip.version == 4 else Socks5Parser.ADDRESS_TYPE_IPV6
+
+
+class HttpRequestParser():
+    """
+    No io involved. Like Socks5Parser, feed() it with whatever was read from the client.
+
+    For CONNECT, `connect` is set to (host, port), and the data after the head is
+    left in the buffer for the tunnel.
+
+    Plain HTTP requests are rewritten to origin-form, without the proxy headers.
+    feed() returns a list of ((host, port), data), so a keep-alive connection
+    sends the requests to the same host on one stream. The body is passed through
+    by its Content-Length. A chunked body isn't parsed, the rest of the connection
+    is passed through to the same host.
+    """
+
+    def __init__(self):
+        self._buffer = b''
+        self._remaining = 0
+        self._raw = False
+
+        self.connect = None
+        self.target = None
+        self.requests = 0
+
+    def take_buffer(self):
+        data, self._buffer = self._buffer, b''
+        return data
+
+    def send_success_response(self):
+        if self.connect:
+            return b'HTTP/1.1 200 Connection established\r\n\r\n'
+        # the origin server sends the response
+        return b''
+
+    def send_failed_response(self, reply=1):
+        if reply == Socks5Parser.REPLY_NOT_ALLOWED:
+            return http_response(403, 'Forbidden')
+        return http_response(502, 'Bad Gateway')
+
+    def feed(self, data):
+        segments = []
+        self._buffer += data
+
+        while self._buffer and not self.connect:
+            if self._raw or self._remaining:
+                size = len(self._buffer) if self._raw else min(self._remaining, len(self._buffer))
+                self._append(segments, self._buffer[:size])
+                self._buffer = self._buffer[size:]
+                if not self._raw:
+                    self._remaining -= size
+                continue
+
+            end = self._buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self._buffer) > MAX_HEAD_SIZE:
+                    raise HttpProxyError('request head too large', http_response(431, 'Request Header Fields Too Large'))
+                break
+
+            head, self._buffer = self._buffer[:end], self._buffer[end+4:]
+            head = self._parse_head(head)
+            self.requests += 1
+            if head is not None:
+                self._append(segments, head)
+
+        return segments
+
+    def _append(self, segments, data):
+        if segments and segments[-1][0] == self.target:
+            segments[-1] = (self.target, segments[-1][1] + data)
+        else:
+            segments.append((self.target, data))
+
+    def _parse_head(self, head):
+        """
+        Return the head rewritten for the origin server, None for CONNECT.
+        """
+        lines = head.split(b'\r\n')
+        try:
+            method, uri, version = lines[0].split(b' ')
+            headers = [line.split(b':', 1) for line in lines[1:]]
+            headers = [(name.strip(), value.strip()) for name, value in headers]
+        except ValueError:
+            raise HttpProxyError('bad request: {}'.format(lines[0][:100]), http_response(400, 'Bad Request'))
+
+        if method == b'CONNECT':
+            self.connect = self._host_port(uri, 443)
+            return None
+
+        if uri.startswith(b'http://'):
+            parts = urlsplit(uri)
+            self.target = self._host_port(parts.netloc, 80)
+            path = parts.path or b'/'
+            if parts.query:
+                path += b'?' + parts.query
+        else:
+            # origin-form, the client thinks it's talking to the origin server
+            host = [value for name, value in headers if name.lower() == b'host']
+            if not uri.startswith(b'/') or not host:
+                raise HttpProxyError('unsupported request uri: {}'.format(uri[:100]), http_response(400, 'Bad Request'))
+            self.target = self._host_port(host[0], 80)
+            path = uri
+
+        lines = [b' '.join((method, path, version))]
+        has_host = False
+        for name, value in headers:
+            lower_name = name.lower()
+            if lower_name in PROXY_HEADERS:
+                continue
+            if lower_name == b'host':
+                has_host = True
+            elif lower_name == b'content-length':
+                if not value.isdigit():
+                    raise HttpProxyError('bad content-length: {}'.format(value[:20]), http_response(400, 'Bad Request'))
+                self._remaining = int(value)
+            elif lower_name == b'transfer-encoding' and b'chunked' in value.lower():
+                self._raw = True
+            lines.append(name + b': ' + value)
+
+        if not has_host:
+            lines.insert(1, b'Host: ' + (parts.netloc if uri.startswith(b'http://') else b''))
+
+        return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+    def _host_port(self, authority, default_port):
+        try:
+            return split_host_port(authority, default_port)
+        except ValueError as e:
+            raise HttpProxyError('bad host: {}'.format(e), http_response(400, 'Bad Request'))
+
+
+def _test_main():
+    parser = HttpRequestParser()
+    request = b'GET http://example.com/a?b=1 HTTP/1.1\r\nHost: example.com\r\nProxy-Connection: keep-alive\r\n\r\n'
+    segments = parser.feed(request[:10])
+    assert segments == []
+    segments = parser.feed(request[10:])
+    assert segments == [(('example.com', 80), b'GET /a?b=1 HTTP/1.1\r\nHost: example.com\r\n\r\n')], segments
+
+    # a body, then a request to another host
+    post = b'POST http://example.com:8080/ HTTP/1.1\r\nHost: example.com:8080\r\nContent-Length: 4\r\n\r\nbody'
+    other = b'GET http://[::1]/ HTTP/1.1\r\nHost: [::1]\r\n\r\n'
+    segments = parser.feed(post + other)
+    assert [target for target, _data in segments] == [('example.com', 8080), ('::1', 80)]
+    assert segments[0][1].endswith(b'\r\n\r\nbody')
+
+    parser = HttpRequestParser()
+    assert parser.feed(b'CONNECT example.com:443 HTTP/1.1\r\nHost: example.com:443\r\n\r\n\x16\x03') == []
+    assert parser.connect == ('example.com', 443)
+    assert parser.take_buffer() == b'\x16\x03'
+
+    for request in (
+            b'GET https://example.com/ HTTP/1.1\r\n\r\n',
+            b'CONNECT example.com:99999 HTTP/1.1\r\n\r\n',
+            b'CONNECT example.com:0 HTTP/1.1\r\n\r\n',
+            b'CONNECT example.com:-1 HTTP/1.1\r\n\r\n',
+            b'GET http://[::1]:65536/ HTTP/1.1\r\n\r\n'):
+        try:
+            HttpRequestParser().feed(request)
+            assert False, request
+        except HttpProxyError as e:
+            assert e.reply.startswith(b'HTTP/1.1 400'), request
+    assert split_host_port(b'example.com:65535', 80) == ('example.com', 65535)
+    print('ok')
+
+
+if __name__ == '__main__':
+    _test_main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Keep the proxy bills in memory, and flush them to the database in batch.
+
+# Author: twitter.com/alpacatunnel
+
+
+import asyncio
+import time
+
+from .log import print_log
+
+
+BILL_KEYS = ('total_pay', 'total_spend', 'balance', 'total_bytes', 'total_requests')
+
+
+class Ledger():
+    """
+    Per-account bills as python ints. Charging only changes the ints,
+    the dirty bills are written to `proxy_bill` in one transaction
+    every `flush_interval` seconds or every `flush_bytes` bytes.
+
+    The ledger must be the only writer of `proxy_bill`, since it writes the
+    whole bill, not the delta. If the server crashes, the charges since the
+    last flush are lost, but every flushed bill is consistent:
+    balance = total_pay - total_spend.
+
+    `db` is an AsyncDB, the flush only queues the write. A bill is read from the
+    database by load_bills(), before the account is charged or paid.
+    """
+
+    def __init__(self, db, flush_interval=10, flush_bytes=10*1024*1024):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+
+        self._bills = {}
+        self._dirty = set()
+        self._pending_bytes = 0
+        self._last_flush = time.time()
+        # the last write queued, the writes are done in order
+        self._flushing = None
+        # held while new pays are written and counted, so each one is counted once
+        self.pay_lock = asyncio.Lock()
+
+    async def load_bills(self, accounts):
+        accounts = [account for account in accounts if account not in self._bills]
+        if not accounts:
+            return
+
+        for account, db_bill in (await self.db.get_bills(accounts)).items():
+            # loaded by another coroutine while this one waited
+            if account in self._bills:
+                continue
+
+            bill = {key: 0 for key in BILL_KEYS}
+            for key, value in db_bill.items():
+                if key in bill:
+                    bill[key] = int(value)
+
+            # The balance is derived, recompute it in case the last run crashed.
+            bill['balance'] = bill['total_pay'] - bill['total_spend']
+            self._bills[account] = bill
+
+    def get_bill(self, account):
+        return self._bills[account]
+
+    def get_balance(self, account):
+        return self.get_bill(account)['balance']
+
+    def charge(self, account, spend, size=0, requests=0):
+        """
+        Return the balance before this charge.
+        """
+        bill = self.get_bill(account)
+        balance = bill['balance']
+
+        bill['total_spend'] += spend
+        bill['total_bytes'] += size
+        bill['total_requests'] += requests
+        bill['balance'] = balance - spend
+        self._dirty.add(account)
+
+        self._pending_bytes += size
+        if self._pending_bytes >= self.flush_bytes:
+            self.flush()
+
+        return balance
+
+    def update_total_pay(self, account, total_pay):
+        bill = self.get_bill(account)
+        total_pay = int(total_pay)
+        if bill['total_pay'] == total_pay:
+            return
+
+        bill['total_pay'] = total_pay
+        bill['balance'] = total_pay - bill['total_spend']
+        self._dirty.add(account)
+
+    def add_pay(self, account, amount):
+        """
+        A new pay of the client, counted once by the block bringing it.
+        """
+        bill = self.get_bill(account)
+        bill['total_pay'] += amount
+        bill['balance'] += amount
+        self._dirty.add(account)
+
+    def flush(self):
+        self._pending_bytes = 0
+        self._last_flush = time.time()
+        if not self._dirty:
+            return
+
+        bills = {}
+        for account in self._dirty:
+            bills[account] = {key: str(value) for key, value in self._bills[account].items()}
+
+        self._dirty.clear()
+        self._flushing = self.db.update_bills(bills)
+        self._flushing.add_done_callback(lambda future: self._flushed(future, bills))
+
+    def _flushed(self, future, bills):
+        if future.cancelled() or future.exception() is None:
+            return
+        print_log('Error flush bills: {}'.format(future.exception()))
+        # written again with the next flush
+        self._dirty.update(bills)
+
+    async def close(self):
+        """
+        Flush the bills, and wait until they are written.
+        """
+        self.flush()
+        if self._flushing:
+            await asyncio.wait([self._flushing])
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval - (time.time() - self._last_flush))
+            if time.time() - self._last_flush < self.flush_interval:
+                continue
+
+            try:
+                self.flush()
+            except Exception as e:
+                print_log('Error flush bills: {}'.format(e))
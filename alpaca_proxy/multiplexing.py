@@ -5,6 +5,16 @@
 # Author: twitter.com/alpacatunnel
 
 
+import zlib
+import struct
+
+from .compression import Deflate
+from .ctrl_msg import CtrlMsg, CtrlMsgError
+
+
+MAX_STREAM_ID = 2**32 - 1
+
+
 def byte2int(b):
     return int.from_bytes(b, byteorder='big')
 
@@ -13,6 +23,46 @@ def int2byte(i):
     return i.to_bytes(4, 'big')
 
 
+class Datagram():
+    """
+    The data of a datagram record. It's delivered whole or not at all, and never deflated.
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __eq__(self, other):
+        return isinstance(other, Datagram) and bytes(self.data) == bytes(other.data)
+
+    def __repr__(self):
+        return 'Datagram({!r})'.format(bytes(self.data))
+
+
+class CtrlRecord():
+    """
+    A control message already encoded by CtrlMsg.to_bytes(), sent as a FLAG_CTRL record.
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+
+class FramingError(ValueError):
+    """
+    A websocks message that can't be unpacked, the session can't go on.
+    """
+
+
 class Multiplexing():
     """
     No io involved. Only parse binary data.
@@ -21,24 +71,114 @@ class Multiplexing():
     Only insert 4 bytes stream ID. Format is: 4-bytes-stream-id + data.
 
     Like HTTP2, client-initiated streams have odd-numbered stream IDs.
+
+    Framing version 2 packs several streams into one websocks message, each record
+    is: 4-bytes-stream-id + 4-bytes-length + data. It's negotiated by the
+    websocket subprotocol PROTOCOL_V2, old peers without it use version 1.
+
+    Framing version 3 adds 1-byte flags after the stream ID:
+    4-bytes-stream-id + 1-byte-flags + 4-bytes-length + data.
+
+    An empty data (FIN) means the sender won't send more on the stream, but it
+    still receives. None (RST) aborts the stream in both directions. Before
+    version 3 there is no RST, it's sent as FIN.
+
+    With the subprotocol PROTOCOL_V3_DEFLATE, the data of compressible streams
+    is deflated, and these records have FLAG_DEFLATE.
+
+    A Datagram (socks5 UDP ASSOCIATE) is sent as a record with FLAG_DATAGRAM on the
+    stream of its association, only with version 3 or later.
+
+    Framing version 4 is version 3, plus the control messages are records with
+    FLAG_CTRL, in the binary format of CtrlMsg, instead of json TEXT messages. So a
+    request goes in the same websocks message as the first data of its stream.
+    Negotiated by PROTOCOL_V4 and PROTOCOL_V4_DEFLATE.
     """
 
-    def __init__(self, role='client'):
+    VERSION_1 = 1
+    VERSION_2 = 2
+    VERSION_3 = 3
+    VERSION_4 = 4
+
+    PROTOCOL_V2 = 'alpaca-mux-v2'
+    PROTOCOL_V3 = 'alpaca-mux-v3'
+    PROTOCOL_V3_DEFLATE = 'alpaca-mux-v3-deflate'
+    PROTOCOL_V4 = 'alpaca-mux-v4'
+    PROTOCOL_V4_DEFLATE = 'alpaca-mux-v4-deflate'
+
+    # websocket subprotocols, preferred first
+    PROTOCOLS = (PROTOCOL_V4, PROTOCOL_V3, PROTOCOL_V2)
+    PROTOCOLS_DEFLATE = (PROTOCOL_V4_DEFLATE, PROTOCOL_V3_DEFLATE, PROTOCOL_V4, PROTOCOL_V3, PROTOCOL_V2)
+
+    FIN = b''
+    RST = None
+
+    FLAG_FIN = 0x01
+    FLAG_RST = 0x02
+    FLAG_DEFLATE = 0x04
+    FLAG_DATAGRAM = 0x08
+    FLAG_CTRL = 0x10
+
+    RECORD_HEADER = struct.Struct('!II')
+    RECORD_HEADER_V3 = struct.Struct('!IBI')
+
+    def __init__(self, role='client', version=VERSION_1):
+        self.version = version
+        self.deflate = None
         if role == 'client':
-            self._max_id = 1
+            self._first_id = 1
         else:
-            self._max_id = 2
+            self._first_id = 2
+        self._max_id = self._first_id
         self._alive_ids = set()
 
     def new_stream(self):
-        # TODO: recycle id when reach max 4 bytes
-        new_id = self._max_id
+        """
+        IDs are allocated in order and wrap around at MAX_STREAM_ID, skipping the
+        alive ones. So a closed ID is not reused until all the others were used,
+        and late frames of a closed stream won't go to a new one.
+        """
+        if len(self._alive_ids) >= MAX_STREAM_ID // 2:
+            raise OverflowError('no stream ID left')
+
+        while True:
+            new_id = self._max_id
+            self._max_id += 2
+            if self._max_id > MAX_STREAM_ID:
+                self._max_id = self._first_id
+            if new_id not in self._alive_ids:
+                break
+
         self._alive_ids.add(new_id)
-        self._max_id += 2
         return new_id
 
     def del_stream(self, stream_id):
         self._alive_ids.discard(stream_id)
+        if self.deflate:
+            self.deflate.forget(stream_id)
+
+    @classmethod
+    def version_of(cls, protocol):
+        """
+        Return the framing version of the negotiated websocket subprotocol.
+        """
+        if protocol in (cls.PROTOCOL_V4, cls.PROTOCOL_V4_DEFLATE):
+            return cls.VERSION_4
+        if protocol in (cls.PROTOCOL_V3, cls.PROTOCOL_V3_DEFLATE):
+            return cls.VERSION_3
+        if protocol == cls.PROTOCOL_V2:
+            return cls.VERSION_2
+        return cls.VERSION_1
+
+    def set_protocol(self, protocol, deflate_level=6, deflate_window=15):
+        """
+        Set the framing of a new websocket, the deflate context starts over.
+        """
+        self.version = self.version_of(protocol)
+        if protocol in (self.PROTOCOL_V3_DEFLATE, self.PROTOCOL_V4_DEFLATE):
+            self.deflate = Deflate(deflate_level, deflate_window)
+        else:
+            self.deflate = None
 
     def send(self, stream_id, data):
         if not data:
@@ -48,11 +188,152 @@ class Multiplexing():
 
     def receive(self, data):
         stream_id = byte2int(data[0:4])
-        return stream_id, data[4:]
+        return stream_id, memoryview(data)[4:]
+
+    def pack(self, records):
+        """
+        Pack a list of (stream_id, data) into a list of websocks messages.
+        The data of a record may be a CtrlMsg with version 4.
+        """
+        if self.version < self.VERSION_3 and any(isinstance(data, Datagram) for _stream_id, data in records):
+            raise ValueError('datagrams need framing version 3')
+
+        if self.version == self.VERSION_1:
+            return [self.send(stream_id, data) for stream_id, data in records]
+
+        chunks = []
+        for stream_id, data in records:
+            if self.version == self.VERSION_2:
+                data = data or b''
+                chunks.append(self.RECORD_HEADER.pack(stream_id, len(data)))
+            elif data is self.RST:
+                data = b''
+                chunks.append(self.RECORD_HEADER_V3.pack(stream_id, self.FLAG_RST, 0))
+            elif isinstance(data, Datagram):
+                data = data.data
+                chunks.append(self.RECORD_HEADER_V3.pack(stream_id, self.FLAG_DATAGRAM, len(data)))
+            elif isinstance(data, (CtrlMsg, CtrlRecord)):
+                if self.version < self.VERSION_4:
+                    raise ValueError('control records need framing version 4')
+                data = data.data if isinstance(data, CtrlRecord) else data.to_bytes()
+                chunks.append(self.RECORD_HEADER_V3.pack(stream_id, self.FLAG_CTRL, len(data)))
+            elif not data:
+                chunks.append(self.RECORD_HEADER_V3.pack(stream_id, self.FLAG_FIN, 0))
+            else:
+                flags = 0
+                if self.deflate:
+                    compressed = self.deflate.compress(stream_id, data)
+                    if compressed is not None:
+                        data = compressed
+                        flags = self.FLAG_DEFLATE
+                chunks.append(self.RECORD_HEADER_V3.pack(stream_id, flags, len(data)))
+            chunks.append(data)
+        return [b''.join(chunks)]
+
+    def unpack(self, data):
+        """
+        Return a list of (stream_id, data) in a websocks message.
+        The data are memoryviews of the message, not copies, or CtrlMsg.
+        Raise FramingError if the message is malformed.
+        """
+        try:
+            return self._unpack(data)
+        except (struct.error, zlib.error, CtrlMsgError) as e:
+            raise FramingError('bad message: {}'.format(e))
+
+    def _unpack(self, data):
+        if len(data) < 4:
+            raise FramingError('message too short: {}'.format(len(data)))
+
+        if self.version == self.VERSION_1:
+            return [self.receive(data)]
+
+        view = memoryview(data)
+        records = []
+        offset = 0
+        flags = 0
+        while offset < len(data):
+            if self.version == self.VERSION_2:
+                stream_id, length = self.RECORD_HEADER.unpack_from(data, offset)
+                offset += self.RECORD_HEADER.size
+            else:
+                stream_id, flags, length = self.RECORD_HEADER_V3.unpack_from(data, offset)
+                offset += self.RECORD_HEADER_V3.size
+
+            if offset + length > len(data):
+                raise FramingError('truncated record of stream_id: {}'.format(stream_id))
+
+            if flags & self.FLAG_RST:
+                records.append((stream_id, self.RST))
+            elif flags & self.FLAG_DATAGRAM:
+                records.append((stream_id, Datagram(view[offset:offset+length])))
+            elif flags & self.FLAG_CTRL:
+                ctrl = CtrlMsg()
+                ctrl.from_bytes(view[offset:offset+length])
+                records.append((stream_id, ctrl))
+            elif flags & self.FLAG_DEFLATE:
+                if not self.deflate:
+                    raise FramingError('deflated record without deflate negotiated')
+                records.append((stream_id, self.deflate.decompress(view[offset:offset+length])))
+            else:
+                records.append((stream_id, view[offset:offset+length]))
+            offset += length
+        return records
 
 
 def _test_main():
-    pass
+    mp_session = Multiplexing(version=Multiplexing.VERSION_2)
+    records = [(1, b'hello'), (3, b''), (5, b'world')]
+    ws_data, = mp_session.pack(records)
+    assert mp_session.unpack(ws_data) == records
+
+    mp_session.version = Multiplexing.VERSION_3
+    records = [(1, b'hello'), (3, Multiplexing.FIN), (5, Multiplexing.RST), (7, Datagram(b'\x01dns'))]
+    ws_data, = mp_session.pack(records)
+    assert mp_session.unpack(ws_data) == records
+
+    mp_session.set_protocol(Multiplexing.PROTOCOL_V4)
+    request = CtrlMsg(msg_type=CtrlMsg.TYPE_REQUEST, stream_id=9, address_type=3, dst_addr='example.com', dst_port=80)
+    ws_data, = mp_session.pack([(9, request), (9, b'GET / HTTP/1.1\r\n\r\n')])
+    (_stream_id, ctrl), record = mp_session.unpack(ws_data)
+    assert ctrl.to_str() == request.to_str() and record == (9, b'GET / HTTP/1.1\r\n\r\n')
+
+    # a malformed message raises FramingError, whatever is wrong in it
+    for bad in (ws_data[:-3], ws_data[:5], b'\x00\x00\x00\x09\x10\x00\x00\x00\x01\xff'):
+        try:
+            mp_session.unpack(bad)
+            assert False, bad
+        except FramingError:
+            pass
+
+    mp_session.set_protocol(Multiplexing.PROTOCOL_V3_DEFLATE)
+    records = [(1, b'hello' * 100), (3, Multiplexing.FIN)]
+    ws_data, = mp_session.pack(records)
+    assert len(ws_data) < 100
+    assert mp_session.unpack(ws_data) == records
+
+    # a record that inflates over the limit ends the session
+    bomb = zlib.compressobj(9, zlib.DEFLATED, -15)
+    bomb = bomb.compress(bytes(10**6)) + bomb.flush(zlib.Z_SYNC_FLUSH)
+    try:
+        mp_session.unpack(mp_session.RECORD_HEADER_V3.pack(1, mp_session.FLAG_DEFLATE, len(bomb)) + bomb)
+        assert False
+    except FramingError:
+        pass
+
+    mp_session._max_id = MAX_STREAM_ID
+    assert mp_session.new_stream() == MAX_STREAM_ID
+    assert mp_session.new_stream() == 1
+
+    # the records are views of the message, not copies
+    import tracemalloc
+    mp_session = Multiplexing(version=Multiplexing.VERSION_3)
+    ws_data, = mp_session.pack([(1, b'x' * 8192)] * 8)
+    tracemalloc.start()
+    records = mp_session.unpack(ws_data)
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('unpacked {} records of {} bytes, allocated {} bytes'.format(len(records), len(ws_data), allocated))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+# A pool of websocket connections to the server, each one a multiplexing session of its own.
+
+# Author: twitter.com/alpacatunnel
+
+
+import zlib
+import random
+import asyncio
+
+from .log import print_log
+from .multiplexing import Multiplexing
+from .streams import StreamRegistry, MAX_STREAMS
+from .scheduler import SendScheduler, STREAM_BUDGET, TOTAL_BUDGET
+from .resume import ReplayBuffer, new_token, REPLAY_SIZE
+from .health import TunnelHealth, STALL_TIMEOUT
+
+
+POLICY_LEAST_LOADED = 'least_loaded'
+POLICY_HASH = 'hash'
+POLICIES = (POLICY_LEAST_LOADED, POLICY_HASH)
+
+# servers within this ratio, plus LATENCY_SLACK seconds, of the fastest one share the new streams
+LATENCY_MARGIN = 0.3
+LATENCY_SLACK = 0.005
+
+
+class Connection():
+    """
+    No io involved. The state of one websocket connection, kept across reconnects.
+    A stream stays on the connection it was opened on, and is closed with it.
+
+    With a replay buffer the session is resumable, the streams are kept for a
+    grace period after the connection is lost, the token identifies the session.
+
+    The pings of the connection keep its rtt and jitter in `health`.
+    """
+
+    def __init__(self, index, max_streams=MAX_STREAMS, stream_budget=STREAM_BUDGET, total_budget=TOTAL_BUDGET, replay=None, url=None, stall_timeout=STALL_TIMEOUT):
+        self.index = index
+        self.url = url
+        self.mp_session = Multiplexing(role='client')
+        self.streams = StreamRegistry(self.mp_session, max_streams)
+        self.send_q = SendScheduler(stream_budget=stream_budget, total_budget=total_budget)
+        self.connected = False
+
+        self.replay = replay
+        self.token = new_token()
+        self._timer = None
+
+        self.health = TunnelHealth(stall_timeout)
+
+    def detach(self, grace):
+        """
+        Keep the streams for `grace` seconds, for the session to be resumed.
+        """
+        if self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(grace, self._expire, grace)
+
+    def attach(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _expire(self, grace):
+        print_log('{} not resumed in {} seconds'.format(self, grace))
+        self._timer = None
+        # the server may still have the old session, start a new one
+        self.token = new_token()
+        self.reset()
+
+    def reset(self):
+        """
+        Close the streams and drop the frames of the session.
+        """
+        self.attach()
+        self.streams.close_all(abort=True)
+        self.send_q.clear()
+        if self.replay:
+            self.replay.reset()
+
+    def __repr__(self):
+        return 'connection {}'.format(self.index)
+
+
+class ConnectionPool():
+    """
+    `size` connections to each of the `urls`.
+
+    A new stream goes to the fastest server by rtt, or is spread over the servers
+    close to it, weighted by 1/rtt. On the server, with POLICY_LEAST_LOADED it
+    goes to the connection with the fewest live streams, with POLICY_HASH to the
+    connection picked by the hash of the destination, so the streams to one
+    destination share a connection.
+
+    Connections being reconnected, or unhealthy, are skipped, unless all of them are.
+    """
+
+    def __init__(self, size=1, max_streams=MAX_STREAMS, policy=POLICY_LEAST_LOADED, stream_budget=STREAM_BUDGET, total_budget=TOTAL_BUDGET, replay_size=None, urls=(None,), stall_timeout=STALL_TIMEOUT):
+        if size < 1:
+            raise ValueError('pool size must be at least 1')
+        if policy not in POLICIES:
+            raise ValueError('pool policy must be one of {}'.format(POLICIES))
+
+        self.policy = policy
+        self.urls = list(urls)
+        # with replay_size, the sessions are resumable
+        self.connections = [
+            Connection(index, max_streams, stream_budget, total_budget, replay_size and ReplayBuffer(replay_size), url, stall_timeout)
+            for index, url in enumerate(url for url in self.urls for _x in range(size))
+        ]
+
+    def __iter__(self):
+        return iter(self.connections)
+
+    def __len__(self):
+        return len(self.connections)
+
+    def pick(self, dst_addr=None, dst_port=None):
+        connected = [c for c in self.connections if c.connected]
+        candidates = [c for c in connected if c.health.healthy] or connected or self.connections
+
+        # crc32 is stable across processes, unlike hash()
+        key = zlib.crc32('{}:{}'.format(dst_addr, dst_port).encode())
+        candidates = self._fastest(candidates, key)
+
+        if self.policy == POLICY_HASH:
+            return candidates[key % len(candidates)]
+
+        return min(candidates, key=lambda c: len(c.streams))
+
+    def server_rtts(self, connections=None):
+        """
+        Return {url: rtt}, the best srtt of the connections to each server, None if not probed.
+        """
+        rtts = {}
+        for c in connections or self.connections:
+            rtt = rtts.get(c.url)
+            srtt = c.health.srtt
+            if srtt is not None and (rtt is None or srtt < rtt):
+                rtts[c.url] = srtt
+            else:
+                rtts.setdefault(c.url, rtt)
+        return rtts
+
+    def _fastest(self, candidates, key):
+        """
+        Return the candidates of the server picked for a new stream.
+        """
+        rtts = self.server_rtts(candidates)
+        if len(rtts) == 1:
+            return candidates
+
+        known = {url: rtt for url, rtt in rtts.items() if rtt is not None}
+        if not known:
+            return candidates
+
+        best = min(known.values())
+        urls = [url for url, rtt in known.items() if rtt <= best * (1 + LATENCY_MARGIN) + LATENCY_SLACK]
+        if self.policy == POLICY_HASH:
+            url = urls[key % len(urls)]
+        else:
+            url = random.choices(urls, [1 / max(known[url], 0.001) for url in urls])[0]
+        return [c for c in candidates if c.url == url]
+
+    def stats(self):
+        return {
+            str(c): dict(c.streams.stats(), url=c.url, connected=c.connected, health=c.health.stats(), send_q=c.send_q.stats())
+            for c in self.connections
+        }
+
+    def status(self):
+        """
+        The rtt and health of each server, and the fastest healthy one, new streams go there first.
+        """
+        servers = {}
+        for url in self.urls:
+            connections = [c for c in self.connections if c.url == url]
+            rtt = self.server_rtts(connections)[url]
+            servers[url] = {
+                'rtt_ms': rtt and round(rtt * 1000, 1),
+                'connected': sum(c.connected for c in connections),
+                'healthy': sum(c.connected and c.health.healthy for c in connections),
+                'streams': sum(len(c.streams) for c in connections),
+                'pings_lost': sum(c.health.lost for c in connections),
+                'stalls': sum(c.health.stalls for c in connections),
+            }
+
+        healthy = {url: server['rtt_ms'] for url, server in servers.items() if server['healthy'] and server['rtt_ms'] is not None}
+        return {
+            'servers': servers,
+            'fastest': min(healthy, key=healthy.get) if healthy else None,
+            'connections': self.stats(),
+        }
+
+
+def _test_main():
+    pool = ConnectionPool(size=3)
+    for connection in pool:
+        connection.connected = True
+
+    first = pool.pick('example.com', 443)
+    first.streams.new_stream()
+    assert pool.pick('example.com', 443) is not first
+
+    pool.connections[1].connected = False
+    assert all(pool.pick('example.com', 443) is not pool.connections[1] for _x in range(10))
+
+    pool = ConnectionPool(size=3, policy=POLICY_HASH)
+    assert pool.pick('example.com', 443) is pool.pick('example.com', 443)
+
+    # the slow server gets no new streams, the close ones share them
+    pool = ConnectionPool(size=2, urls=('ws://a', 'ws://b', 'ws://c'))
+    for connection, rtt in zip(pool, (0.050, 0.050, 0.055, 0.055, 0.200, 0.200)):
+        connection.connected = True
+        connection.health.pong(rtt)
+    urls = [pool.pick('example.com', 443).url for _x in range(200)]
+    assert set(urls) == {'ws://a', 'ws://b'}, set(urls)
+
+    # failover, a lost ping takes the server out right away
+    for connection in pool.connections[:4]:
+        connection.health.ping_lost()
+    assert pool.pick().url == 'ws://c'
+    print(pool.status())
+
+
+if __name__ == '__main__':
+    _test_main()
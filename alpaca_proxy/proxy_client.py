@@ -1,43 +1,63 @@
 #!/usr/bin/env python3
 
 import asyncio
+import signal
 import socket
 import struct
 import time
+from aiohttp import web
 from aiohttp import WSMsgType
 
 from .log import print_log
-from .socks5 import Socks5Parser
-from .multiplexing import Multiplexing
-from .ws_helper import ws_connect, ws_recv, ws_send
-from .ctrl_msg import CtrlMsg
+from .socks5 import Socks5Parser, Socks5Error
+from .multiplexing import Multiplexing, Datagram
+from .ws_helper import ws_connect, ws_recv, ws_decode, ws_send_frames
+from .ctrl_msg import CtrlMsg, CtrlMsgError
+from .streams import MAX_STREAMS, FLOW_HEADER
+from .pool import ConnectionPool, POLICY_LEAST_LOADED
+from .health import ws_send_ping, PING_INTERVAL, STALL_TIMEOUT
+from .scheduler import STREAM_BUDGET, TOTAL_BUDGET
+from .resume import ws_send_ack, ws_replay, new_token
+from .resume import SESSION_HEADER, RECEIVED_HEADER, RESUME_GRACE, REPLAY_SIZE, CTRL_SIZE
+from .compression import deflate_conf
+from .relay import start_relay_server, open_relay_connection
+from .router import Router, ROUTE_TUNNEL, ROUTE_DIRECT, ROUTE_REJECT
+from .udp import ClientUdpRelay
+from .dns import DnsForwarder, start_dns_server, CACHE_SIZE
+from .http_proxy import HttpRequestParser, HttpProxyError, address_type_of
 from .nano_account import Account
 
 
-async def s5_prepare(s5_conn, s5_reader, s5_writer):
+# a socks5 greeting/auth/request is less than 1KB
+MAX_HANDSHAKE_SIZE = 2048
+
 
+async def s5_prepare(s5_conn, s5_reader, s5_writer):
+    """
+    Return address_type, dst_addr, dst_port, and the data the client sent after the request.
+    """
     s5_buffer = b''
-    for _x in range(20):
-        s5_buffer += await s5_reader.readexactly(1)
-        greeting = s5_conn.receive_greeting(s5_buffer)
-        if greeting == Socks5Parser.PARSE_DONE:
-            break
-    else:
-        raise Exception('wrong socks5 greeting message')
+    while s5_conn.state != Socks5Parser.STATE_DONE:
+        s5_data = await s5_reader.read(MAX_HANDSHAKE_SIZE)
+        if not s5_data:
+            raise Socks5Error('socks5 client closed in handshake')
 
-    greeting_reply = s5_conn.send_greeting()
-    s5_writer.write(greeting_reply)
+        s5_buffer += s5_data
+        try:
+            consumed, reply = s5_conn.feed(s5_buffer)
+        except Socks5Error as e:
+            if e.reply:
+                s5_writer.write(e.reply)
+            raise
 
-    s5_buffer = b''
-    for _x in range(100):
-        s5_buffer += await s5_reader.readexactly(1)
-        request = s5_conn.receive_request(s5_buffer)
-        if request == Socks5Parser.PARSE_DONE:
-            break
-    else:
-        raise Exception('wrong socks5 request message')
+        s5_buffer = s5_buffer[consumed:]
+        if reply:
+            s5_writer.write(reply)
+
+        if len(s5_buffer) > MAX_HANDSHAKE_SIZE:
+            raise Socks5Error('wrong socks5 handshake message')
 
-    # after s5_conn.receive_request(), should save the addr/port in s5_conn
+    # after the request is parsed, the addr/port are saved in s5_conn
     address_type, dst_addr, dst_port = s5_conn.address_type[0], s5_conn.dst_addr, s5_conn.dst_port
 
     if address_type == Socks5Parser.ADDRESS_TYPE_IPV4:
@@ -48,18 +68,285 @@ async def s5_prepare(s5_conn, s5_reader, s5_writer):
         dst_addr = dst_addr.decode()
     dst_port = struct.unpack('!H', dst_port)[0]
 
-    return address_type, dst_addr, dst_port
+    return address_type, dst_addr, dst_port, s5_buffer
+
+
+async def s5_server(s5_reader, s5_writer, pool, s5_auth=(None, None), optimistic=False, router=None):
+
+    s5_conn = Socks5Parser(*s5_auth)
+
+    try:
+        address_type, dst_addr, dst_port, early_data = await s5_prepare(s5_conn, s5_reader, s5_writer)
+    except Exception as e:
+        print_log('socks5 handshake failed: {}'.format(e))
+        s5_writer.close()
+        return
+
+    if s5_conn.cmd == Socks5Parser.CMD_UDP_ASSOCIATE:
+        await udp_associate(s5_conn, s5_reader, s5_writer, pool)
+        return
 
+    await route_stream(s5_conn, s5_reader, s5_writer, pool, router, address_type, dst_addr, dst_port, early_data, optimistic)
 
-async def s5_server(s5_reader, s5_writer, send_q, mp_session, s5_dict):
 
-    s5_conn = Socks5Parser()
+async def udp_associate(s5_conn, s5_reader, s5_writer, pool):
+    """
+    Relay the datagrams of a UDP ASSOCIATE on a stream, while the socks5 connection is open.
+    """
+    connection = pool.pick()
+    send_q, streams = connection.send_q, connection.streams
 
-    address_type, dst_addr, dst_port = await s5_prepare(s5_conn, s5_reader, s5_writer)
+    if not connection.connected or connection.mp_session.version < Multiplexing.VERSION_3:
+        print_log('no connection to server with datagram support, refused udp associate')
+        s5_writer.write(s5_conn.send_failed_response(Socks5Parser.REPLY_COMMAND_NOT_SUPPORTED))
+        s5_writer.close()
+        return
 
-    stream_id = mp_session.new_stream()
     s5_q = asyncio.Queue()
-    s5_dict[stream_id] = s5_q
+    stream_id = streams.new_stream(s5_q, writer=s5_writer)
+    if stream_id is None:
+        s5_writer.write(s5_conn.send_failed_response(1))
+        s5_writer.close()
+        return
+
+    streams.add_task(stream_id, asyncio.current_task())
+    transport = None
+    try:
+        ctrl = CtrlMsg(msg_type=CtrlMsg.TYPE_UDP_ASSOCIATE, stream_id=stream_id)
+        send_q.put_nowait((WSMsgType.TEXT, ctrl))
+        print_log(ctrl)
+
+        response = await s5_q.get()
+        if not isinstance(response, CtrlMsg) or not response.result:
+            print_log('udp associate failed, reason: {}'.format(getattr(response, 'reason', None)))
+            s5_writer.write(s5_conn.send_failed_response(1))
+            return
+
+        # the relay listens on the address the socks5 client connected to
+        loop = asyncio.get_event_loop()
+        client_host = s5_writer.get_extra_info('peername')[0]
+        transport, relay = await loop.create_datagram_endpoint(
+            lambda: ClientUdpRelay(stream_id, send_q, client_host),
+            local_addr=(s5_writer.get_extra_info('sockname')[0], 0))
+        s5_writer.write(s5_conn.send_success_response(transport.get_extra_info('sockname')[:2]))
+
+        task = asyncio.ensure_future(ws_to_udp(stream_id, s5_q, relay, streams))
+        streams.add_task(stream_id, task)
+
+        # the association ends when the socks5 client closes the connection
+        while await s5_reader.read(8192):
+            pass
+        send_q.put_nowait((WSMsgType.BINARY, (stream_id, Multiplexing.RST)))
+
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        print_log('stream_id:', stream_id, e)
+        send_q.put_nowait((WSMsgType.BINARY, (stream_id, Multiplexing.RST)))
+    finally:
+        if transport:
+            transport.close()
+        streams.close(stream_id)
+
+
+async def ws_to_udp(stream_id, s5_q, relay, streams):
+    while True:
+        s5_data = await s5_q.get()
+        if isinstance(s5_data, Datagram):
+            relay.reply(s5_data)
+        elif not s5_data:
+            # the server ended the association
+            streams.close(stream_id)
+            break
+
+
+async def http_server(s5_reader, s5_writer, pool, optimistic=False, router=None):
+    """
+    The HTTP proxy frontend, a CONNECT tunnel is relayed like a socks5 stream.
+    The plain HTTP requests of a keep-alive connection are relayed on one stream
+    while they go to the same host, a request to another host opens a new stream.
+    """
+
+    parser = HttpRequestParser()
+    try:
+        segments = []
+        while not segments and not parser.connect:
+            s5_data = await s5_reader.read(8192)
+            if not s5_data:
+                return
+            try:
+                segments = parser.feed(s5_data)
+            except HttpProxyError as e:
+                print_log('http proxy request failed: {}'.format(e))
+                s5_writer.write(e.reply)
+                return
+
+        if parser.connect:
+            dst_addr, dst_port = parser.connect
+            await route_stream(parser, s5_reader, s5_writer, pool, router, address_type_of(dst_addr), dst_addr, dst_port,
+                               parser.take_buffer(), optimistic)
+            return
+
+        while segments:
+            dst_addr, dst_port = segments[0][0]
+            segments = await route_stream(parser, s5_reader, s5_writer, pool, router, address_type_of(dst_addr), dst_addr, dst_port,
+                                          b'', optimistic, segments=segments, parser=parser, owns_writer=False)
+    finally:
+        s5_writer.close()
+
+
+async def route_stream(s5_conn, s5_reader, s5_writer, pool, router, address_type, dst_addr, dst_port, early_data=b'', optimistic=False, segments=None, parser=None, owns_writer=True):
+    """
+    Relay the client connection through the tunnel, or directly, or reject it, as the router says.
+    """
+    route = router.route(dst_addr) if router else ROUTE_TUNNEL
+
+    if route == ROUTE_REJECT:
+        print_log('rejected by route rules: {}:{}'.format(dst_addr, dst_port))
+        s5_writer.write(s5_conn.send_failed_response(Socks5Parser.REPLY_NOT_ALLOWED))
+        s5_writer.close()
+        return None
+
+    if route == ROUTE_DIRECT:
+        return await direct_stream(s5_conn, s5_reader, s5_writer, dst_addr, dst_port, early_data, segments, parser, owns_writer)
+
+    return await tunnel_stream(s5_conn, s5_reader, s5_writer, pool, address_type, dst_addr, dst_port, early_data, optimistic, segments, parser, owns_writer)
+
+
+async def direct_stream(s5_conn, s5_reader, s5_writer, dst_addr, dst_port, early_data=b'', segments=None, parser=None, owns_writer=True):
+    """
+    Relay the client connection to dst_addr:dst_port without the tunnel.
+    Return the segments left for another host, like s5_relay().
+    """
+    try:
+        dst_reader, dst_writer = await asyncio.wait_for(open_relay_connection(dst_addr, dst_port), timeout=10)
+    except Exception as e:
+        print_log('error direct connect to', dst_addr, dst_port, str(e))
+        s5_writer.write(s5_conn.send_failed_response(1))
+        s5_writer.close()
+        return None
+
+    s5_writer.write(s5_conn.send_success_response())
+    task = asyncio.ensure_future(direct_pipe(dst_reader, s5_writer))
+    target = (dst_addr, dst_port)
+    try:
+        if early_data:
+            dst_writer.write(early_data)
+        if segments:
+            segments = await write_segments(dst_writer, target, segments)
+
+        while not segments:
+            s5_data = await s5_reader.read(8192)
+            if parser and s5_data:
+                segments = await write_segments(dst_writer, target, parser.feed(s5_data))
+                continue
+
+            if not s5_data:
+                # half-closed, the destination may still be sending the response
+                if dst_writer.can_write_eof():
+                    dst_writer.write_eof()
+                await task
+                return None
+
+            dst_writer.write(s5_data)
+            await dst_writer.drain()
+
+        # the next request goes to another host
+        return segments
+
+    except Exception as e:
+        print_log('direct to {}:{}: {}'.format(dst_addr, dst_port, e))
+        return None
+
+    finally:
+        task.cancel()
+        dst_writer.close()
+        if owns_writer:
+            s5_writer.close()
+
+
+async def direct_pipe(reader, writer):
+    while True:
+        data = await reader.read(8192)
+        if not data:
+            if writer.can_write_eof():
+                writer.write_eof()
+            return
+        writer.write(data)
+        await writer.drain()
+
+
+async def write_segments(writer, target, segments):
+    """
+    Write the segments to target, return the ones from the first to another host, or None.
+    """
+    for index, (segment_target, data) in enumerate(segments):
+        if segment_target != target:
+            return segments[index:]
+        writer.write(data)
+        await writer.drain()
+    return None
+
+
+async def tunnel_stream(s5_conn, s5_reader, s5_writer, pool, address_type, dst_addr, dst_port, early_data=b'', optimistic=False, segments=None, parser=None, owns_writer=True):
+    """
+    Open a stream to dst_addr:dst_port and relay the client connection on it.
+    Return the segments left for another host, see s5_relay().
+
+    Without owns_writer, the client connection is kept open after the stream is closed.
+    """
+
+    # the stream stays on this connection until closed
+    connection = pool.pick(dst_addr, dst_port)
+    send_q, streams = connection.send_q, connection.streams
+
+    # fail fast instead of queueing while no ws session is connected
+    if not connection.connected:
+        print_log('no connection to server, refused {}:{}'.format(dst_addr, dst_port))
+        s5_writer.write(s5_conn.send_failed_response(1))
+        s5_writer.close()
+        return None
+
+    s5_q = asyncio.Queue()
+    stream_id = streams.new_stream(s5_q, writer=s5_writer if owns_writer else None)
+    if stream_id is None:
+        s5_writer.write(s5_conn.send_failed_response(1))
+        s5_writer.close()
+        return None
+
+    # closing the stream cancels this task, on reconnect for example
+    streams.add_task(stream_id, asyncio.current_task())
+    try:
+        return await s5_relay(s5_conn, s5_reader, s5_writer, send_q, stream_id, s5_q, streams,
+                              address_type, dst_addr, dst_port, early_data, optimistic, segments, parser)
+    except asyncio.CancelledError:
+        # the stream was reset, the handler task ends here
+        return None
+    finally:
+        streams.close(stream_id)
+
+
+async def send_segments(send_q, stream_id, target, segments):
+    """
+    Queue the segments to target, return the ones from the first to another host, or None.
+    """
+    for index, (segment_target, data) in enumerate(segments):
+        if segment_target != target:
+            return segments[index:]
+        await send_q.put((WSMsgType.BINARY, (stream_id, data)))
+    return None
+
+
+async def s5_relay(s5_conn, s5_reader, s5_writer, send_q, stream_id, s5_q, streams, address_type, dst_addr, dst_port, early_data=b'', optimistic=False, segments=None, parser=None):
+    """
+    With optimistic, reply success to the socks5 client and relay its data without
+    waiting for the server's response, which saves one round trip per connection.
+    The server buffers the data until connected, a failed connect resets the stream.
+
+    With a parser, the client data is fed to it and sent as the segments it returns.
+    When a segment goes to another host, the stream is ended with a FIN, and after
+    the response of the previous host, the segments from that one on are returned.
+    """
 
     ctrl = CtrlMsg(
         msg_type=CtrlMsg.TYPE_REQUEST,
@@ -69,61 +356,140 @@ async def s5_server(s5_reader, s5_writer, send_q, mp_session, s5_dict):
         dst_port=dst_port
     )
 
-    ctrl_str = ctrl.to_str()
-    send_q.put_nowait((WSMsgType.TEXT, ctrl_str))
-    print_log(ctrl_str)
+    try:
+        ctrl.validate()
+    except CtrlMsgError as e:
+        print_log('bad request, refused: {}'.format(e))
+        s5_writer.write(s5_conn.send_failed_response(1))
+        return None
+
+    send_q.put_nowait((WSMsgType.TEXT, ctrl))
+    print_log(ctrl)
+
+    if optimistic:
+        # the response is handled by ws_to_s5()
+        s5_writer.write(s5_conn.send_success_response())
+    else:
+        # first msg is socks5 response
+        response = await s5_q.get()
+        # print_log(response)
+
+        if response and response.result:
+            server_data = s5_conn.send_success_response()
+            s5_writer.write(server_data)
+        else:
+            print_log('request failed, reason: {}'.format(getattr(response, 'reason', None)))
+            server_data = s5_conn.send_failed_response(1)
+            s5_writer.write(server_data)
+            return None
 
-    # first msg is socks5 response
-    response = await s5_q.get()
-    # print_log(response)
+    # set when the next request goes to another host, the client connection stays open
+    switched = asyncio.Event()
+    task = asyncio.ensure_future(ws_to_s5(stream_id, s5_q, s5_writer, send_q, streams, switched))
+    streams.add_task(stream_id, task)
 
-    if response.result:
-        server_data = s5_conn.send_success_response()
-        s5_writer.write(server_data)
-    else:
-        print_log('request failed, reason: {}'.format(response.reason))
-        server_data = s5_conn.send_failed_response(1)
-        s5_writer.write(server_data)
-        s5_writer.close()
-        return
+    # sent by the client right after the request, without waiting for the reply
+    if early_data:
+        await send_q.put((WSMsgType.BINARY, (stream_id, early_data)))
 
-    task = asyncio.ensure_future(ws_to_s5(stream_id, s5_q, s5_writer))
+    target = (dst_addr, dst_port)
+    if segments:
+        segments = await send_segments(send_q, stream_id, target, segments)
 
     # s5_to_ws
-    while True:
+    while not segments:
         try:
             s5_data = await s5_reader.read(8192)
+            if parser and s5_data:
+                segments = parser.feed(s5_data)
         except Exception as e:
             print_log('stream_id:', stream_id, e)
-            task.cancel()
-            break
+            send_q.put_nowait((WSMsgType.BINARY, (stream_id, Multiplexing.RST)))
+            streams.close(stream_id, abort=True)
+            return None
 
-        ws_data = mp_session.send(stream_id, s5_data)
-        send_q.put_nowait((WSMsgType.BINARY, ws_data))
+        if parser and s5_data:
+            segments = await send_segments(send_q, stream_id, target, segments)
+            continue
 
-        # EOF
+        # waits while too much data of the stream, or of the session, is queued
+        await send_q.put((WSMsgType.BINARY, (stream_id, s5_data)))
+
+        # FIN
         if not s5_data:
             break
 
+    if segments:
+        # the next request goes to another host, a pipelined response of this one
+        # is still to come
+        switched.set()
+        await send_q.put((WSMsgType.BINARY, (stream_id, b'')))
+
+    # half-closed, the server may still be sending the response
+    await task
+    return segments
 
-async def ws_to_s5(stream_id, s5_q, s5_writer):
+
+async def ws_to_s5(stream_id, s5_q, s5_writer, send_q, streams, switched=None):
+    """
+    The FIN of the server is passed on to the client, unless `switched` is set.
+    """
     while True:
         s5_data = await s5_q.get()
 
+        # response of an optimistic open
+        if isinstance(s5_data, CtrlMsg):
+            if s5_data.result:
+                continue
+            print_log('request failed, reason: {}'.format(s5_data.reason))
+            streams.close(stream_id, abort=True)
+            break
+
         try:
-            s5_writer.write(s5_data)
+            if s5_data:
+                s5_writer.write(s5_data)
+            elif not (switched and switched.is_set()) and s5_writer.can_write_eof():
+                s5_writer.write_eof()
         except Exception as e:
             print_log('stream_id:', stream_id, e)
+            send_q.put_nowait((WSMsgType.BINARY, (stream_id, Multiplexing.RST)))
+            streams.close(stream_id, abort=True)
             break
 
-        # EOF
+        # FIN, the socks5 client may still send data
         if not s5_data:
             break
 
+
+async def ws_dns_lookup(pool, name):
+    """
+    Resolve name on the server, return (addresses, ttl), addresses is None if the
+    name doesn't exist. The answer comes back on a stream of its own.
+    """
+    connection = pool.pick(name)
+    send_q, streams = connection.send_q, connection.streams
+    if not connection.connected:
+        raise ConnectionError('no connection to server')
+
+    s5_q = asyncio.Queue()
+    stream_id = streams.new_stream(s5_q)
+    if stream_id is None:
+        raise ConnectionError('too many streams')
+
     try:
-        s5_writer.close()
-    except Exception as _e:
-        pass
+        ctrl = CtrlMsg(msg_type=CtrlMsg.TYPE_DNS, stream_id=stream_id, dst_addr=name)
+        send_q.put_nowait((WSMsgType.TEXT, ctrl))
+        answer = await s5_q.get()
+    finally:
+        streams.close(stream_id)
+
+    if not isinstance(answer, CtrlMsg):
+        raise ConnectionError('stream reset')
+    if answer.result:
+        return answer.addresses, answer.ttl
+    if not answer.ttl:
+        raise ConnectionError(answer.reason)
+    return None, answer.ttl
 
 
 async def ws_send_signature(send_q, mp_session, account):
@@ -139,112 +505,345 @@ async def ws_send_signature(send_q, mp_session, account):
     )
     print_log(sign_msg)
 
-    ctrl_str = sign_msg.to_str()
-    send_q.put_nowait((WSMsgType.TEXT, ctrl_str))
+    mp_session.del_stream(sign_msg.stream_id)
+    send_q.put_nowait((WSMsgType.TEXT, sign_msg))
 
 
-async def ws_multiplexing_decode(ws, mp_session, s5_dict, send_q, nano_seed):
+async def ws_multiplexing_decode(ws, mp_session, streams, send_q, nano_seed, replay=None, on_pong=None, health=None):
+    """
+    The only receiver of the ws session. However it ends, the ws is closed, and
+    ws_client_handler() reconnects.
+    """
     account = Account(seed=nano_seed)
-    while True:
-        ws_msg = await ws_recv(ws)
-        if not ws_msg:
-            break
-
-        if ws_msg.type == WSMsgType.TEXT:
-            ctrl = CtrlMsg()
-            ctrl.from_str(ws_msg.data)
+    try:
+        while True:
+            ws_msg = await ws_recv(ws, on_pong)
+            if not ws_msg:
+                break
+
+            if health:
+                health.heard()
+
+            try:
+                records = ws_decode(mp_session, ws_msg)
+            except (ValueError, CtrlMsgError) as e:
+                # the records after a bad one can't be found, start over with a new ws
+                print_log('bad message from server, reconnect: {}'.format(e))
+                break
+
+            for stream_id, s5_data in records:
+                if isinstance(s5_data, CtrlMsg):
+                    ctrl = s5_data
+                    if ctrl.msg_type == CtrlMsg.TYPE_ACK:
+                        if replay:
+                            replay.ack(ctrl.received)
+                        continue
+
+                    # not numbered for resume, like the acks
+                    if ctrl.msg_type == CtrlMsg.TYPE_PONG:
+                        if health:
+                            health.pong(time.monotonic() - ctrl.timestamp)
+                        continue
+
+                    if replay and replay.received(CTRL_SIZE):
+                        await ws_send_ack(ws, mp_session, replay)
+
+                    if ctrl.msg_type == CtrlMsg.TYPE_CHARGE:
+                        print_log(ctrl)
+                        if not nano_seed:
+                            print_log('nano_seed is null, skip sign.')
+                            continue
+
+                        await ws_send_signature(send_q, mp_session, account)
+                        continue
+
+                    elif ctrl.msg_type == CtrlMsg.TYPE_FLOW:
+                        # a resume may come after the stream was closed here
+                        if not ctrl.paused:
+                            send_q.resume(stream_id)
+                        elif stream_id in streams:
+                            send_q.pause(stream_id)
+                        continue
+
+                    elif ctrl.msg_type == CtrlMsg.TYPE_BALANCE:
+                        print_log(ctrl)
+                        print_log('======>>> Warning: balance is {}'.format(ctrl.balance))
+                        continue
+
+                    elif ctrl.msg_type not in (CtrlMsg.TYPE_RESPONSE, CtrlMsg.TYPE_DNS_ANSWER):
+                        continue
+
+                elif replay and replay.received(len(s5_data or b'')):
+                    await ws_send_ack(ws, mp_session, replay)
+
+                if s5_data is Multiplexing.RST:
+                    # the queued data of the stream, paused or not, is dropped
+                    send_q.forget(stream_id)
+
+                s5_q = streams.get(stream_id)
+                if s5_q is None:
+                    # the server's FIN/RST of a stream already closed here is expected
+                    if s5_data:
+                        print_log('got unkown stream_id', stream_id)
+                    continue
 
-            if ctrl.msg_type == CtrlMsg.TYPE_CHARGE:
-                print_log(ctrl)
-                if not nano_seed:
-                    print_log('nano_seed is null, skip sign.')
+                if s5_data is Multiplexing.RST:
+                    streams.close(stream_id, abort=True)
                     continue
 
-                await ws_send_signature(send_q, mp_session, account)
-                continue
+                # the stream is closed by s5_server() after both sides sent FIN
+                s5_q.put_nowait(s5_data)
 
-            elif ctrl.msg_type == CtrlMsg.TYPE_BALANCE:
-                print_log(ctrl)
-                print_log('======>>> Warning: balance is {}'.format(ctrl.balance))
-                continue
+    except Exception as e:
+        print_log('Error decode ws message: {}'.format(e))
 
-            elif ctrl.msg_type == CtrlMsg.TYPE_RESPONSE:
-                stream_id, s5_data = ctrl.stream_id, ctrl
+    finally:
+        if not ws.closed:
+            await ws.close()
 
-        elif ws_msg.type == WSMsgType.BINARY:
-            stream_id, s5_data = mp_session.receive(ws_msg.data)
 
-        if stream_id not in s5_dict:
-            print_log('got unkown stream_id', stream_id)
-            continue
+async def ws_send_from_q(send_q, ws, mp_session, replay=None):
+    """
+    Use a q to receive and send to ws, because ws may be interrupted and re-connect.
+    """
+    await ws_send_frames(send_q, ws, mp_session, replay=replay)
 
-        s5_q = s5_dict[stream_id]
-        s5_q.put_nowait(s5_data)
 
-        if not s5_data:
-            s5_dict.pop(stream_id)
+async def ws_resume(ws, connection):
+    """
+    The server's first message tells if the session was resumed, and how many frames
+    it received, the frames after those are sent again.
+    Return False if the ws can't be used, and should be reconnected.
+    """
+    replay = connection.replay
+    try:
+        ws_msg = await asyncio.wait_for(ws_recv(ws), timeout=10)
+        ctrl = CtrlMsg()
+        ctrl.from_str(ws_msg.data)
+        if ctrl.msg_type != CtrlMsg.TYPE_RESUME:
+            raise ValueError('unexpected message: {}'.format(ctrl.msg_type))
+    except Exception as e:
+        print_log('{} server does not support resume, disabled: {}'.format(connection, e))
+        connection.reset()
+        connection.replay = None
+        return False
+
+    print_log(ctrl)
+    if not ctrl.result:
+        # a new session on the server
+        connection.reset()
+        return True
+
+    items = replay.replay_from(ctrl.received)
+    if items is None:
+        print_log('{} can not resume, frames were dropped: {}'.format(connection, replay.stats()))
+        connection.token = new_token()
+        connection.reset()
+        return False
+
+    connection.attach()
+    await ws_replay(ws, connection.mp_session, items)
+    print_log('{} resumed, streams: {}'.format(connection, connection.streams.stats()))
+    return True
+
+
+async def ws_probe(ws, connection, interval=PING_INTERVAL):
+    """
+    Ping the server every interval seconds, the pong carries the time the ping was
+    sent. A ping not answered in time marks the connection unhealthy, and new
+    streams go to the other connections. A stalled connection is closed, to be
+    reconnected, or resumed, right away.
+
+    Servers without framing version 4 don't know the ping message, the websocket
+    ping frames carry the timestamp instead.
+    """
+    health = connection.health
+    mp_session = connection.mp_session
+    while not ws.closed:
+        sent_at = time.monotonic()
+        if mp_session.version >= Multiplexing.VERSION_4:
+            ping = ws_send_ping(ws, mp_session, sent_at)
+        else:
+            ping = ws.ping(struct.pack('!d', sent_at))
+        # not awaited, the send of a stalled ws may block
+        asyncio.ensure_future(ping).add_done_callback(lambda f: f.cancelled() or f.exception())
+
+        await asyncio.sleep(health.ping_timeout())
+        if health.last_pong < sent_at and health.ping_lost():
+            print_log('{} ping lost, unhealthy'.format(connection))
+
+        if health.stalled():
+            print_log('{} nothing received in {} seconds, reconnect'.format(connection, health.stall_timeout))
+            try:
+                await asyncio.wait_for(ws.close(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+            break
 
+        await asyncio.sleep(max(interval - (time.monotonic() - sent_at), 0))
 
-async def ws_send_from_q(send_q, ws):
+
+def probe_pong(connection, data):
     """
-    Use a q to receive and send to ws, because ws may be interrupted and re-connect.
+    The pong frame of a websocket ping.
     """
-    while True:
-        msg_type, ws_data = await send_q.get()
-        await ws_send(ws, ws_data, msg_type)
+    try:
+        timestamp, = struct.unpack('!d', data)
+    except struct.error:
+        return
+    connection.health.pong(time.monotonic() - timestamp)
 
 
-async def ws_client_handler(mp_session, s5_dict, send_q, url, username, password, verify_ssl, nano_seed):
+async def ws_client_handler(connection, url, username, password, verify_ssl, nano_seed, deflate, resume_grace=RESUME_GRACE):
+    mp_session, streams, send_q = connection.mp_session, connection.streams, connection.send_q
 
-    ws, session = await ws_connect(url, username, password, verify_ssl)
+    if deflate:
+        protocols = Multiplexing.PROTOCOLS_DEFLATE
+    else:
+        protocols = Multiplexing.PROTOCOLS
+
+    # the streams are paused by the server, instead of waited for
+    headers = {FLOW_HEADER: '1'}
+    if connection.replay:
+        headers.update({
+            SESSION_HEADER: connection.token,
+            RECEIVED_HEADER: str(connection.replay.received_count),
+        })
+
+    # the pongs of the rtt probe are handled by ws_recv()
+    ws, session = await ws_connect(url, username, password, verify_ssl, headers=headers, protocols=protocols, autoping=False)
     if not ws:
         return
 
-    task_recv = asyncio.ensure_future(ws_multiplexing_decode(ws, mp_session, s5_dict, send_q, nano_seed))
-    task_send = asyncio.ensure_future(ws_send_from_q(send_q, ws))
-    print_log('started task: ws_recv/ws_send')
+    # the framing may change if reconnected to another version of server
+    mp_session.set_protocol(ws.protocol, *(deflate or ()))
+    print_log('{} multiplexing framing version: {}'.format(connection, mp_session.version))
+
+    if connection.replay and not await ws_resume(ws, connection):
+        await session.close()
+        await ws.close()
+        return
+
+    replay = connection.replay
+    connection.health.reset()
+    connection.connected = True
+
+    on_pong = lambda data: probe_pong(connection, data)
+    task_recv = asyncio.ensure_future(ws_multiplexing_decode(ws, mp_session, streams, send_q, nano_seed, replay, on_pong, connection.health))
+    task_send = asyncio.ensure_future(ws_send_from_q(send_q, ws, mp_session, replay))
+    task_probe = asyncio.ensure_future(ws_probe(ws, connection))
+    print_log('started task: ws_recv/ws_send/probe')
 
     while True:
         if ws.closed:
+            connection.connected = False
             await session.close()
             await ws.close()
             print_log('closed session to {}'.format(url))
             task_recv.cancel()
             task_send.cancel()
-            print_log('stopped task: ws_recv/ws_send')
+            task_probe.cancel()
+            print_log('stopped task: ws_recv/ws_send/probe')
+            print_log('session health: {}'.format(connection.health.stats()))
+
+            if replay:
+                # the streams wait for the session to be resumed
+                connection.detach(resume_grace)
+                print_log('{} lost, streams: {}, replay: {}'.format(connection, streams.stats(), replay.stats()))
+            else:
+                # the server closed all the streams of this session, other connections are not affected
+                connection.reset()
+                print_log('closed all streams of {}: {}'.format(connection, streams.stats()))
+            if mp_session.deflate:
+                print_log('session deflate: {}'.format(mp_session.deflate.stats()))
             break
         else:
-            await asyncio.sleep(1)
+            await asyncio.sleep(0.1)
 
 
-async def ws_client_auto_connect(mp_session, s5_dict, send_q, url, username=None, password=None, verify_ssl=True, nano_seed=None):
+async def ws_client_auto_connect(connection, url, username=None, password=None, verify_ssl=True, nano_seed=None, deflate=None, resume_grace=RESUME_GRACE):
     while True:
-        await ws_client_handler(mp_session, s5_dict, send_q, url, username, password, verify_ssl, nano_seed)
+        await ws_client_handler(connection, url, username, password, verify_ssl, nano_seed, deflate, resume_grace)
 
 
-def start_proxy_client(conf):
-    send_q = asyncio.Queue()
-    s5_dict = {'stream_id': 's5_q'}
+async def status_handler(request):
+    return web.json_response(request.app['pool'].status())
+
+
+async def start_status_server(pool, host, port):
+    """
+    GET /status returns the rtt and health of the servers, and the connections.
+    """
+    app = web.Application()
+    app['pool'] = pool
+    app.router.add_get('/status', status_handler)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
 
-    mp_session = Multiplexing(role='client')
+
+def start_proxy_client(conf):
+    # server_urls are the servers to pick from, server_url is the only one
+    urls = conf.get('server_urls') or [conf['server_url']]
+
+    pool = ConnectionPool(
+        size=int(conf.get('connections', 1)),
+        max_streams=int(conf.get('max_streams', MAX_STREAMS)),
+        policy=conf.get('pool_policy', POLICY_LEAST_LOADED),
+        stream_budget=int(conf.get('stream_send_buffer', STREAM_BUDGET)),
+        total_budget=int(conf.get('send_buffer', TOTAL_BUDGET)),
+        replay_size=int(conf.get('resume_buffer', REPLAY_SIZE)) if conf.get('resume') else None,
+        urls=urls,
+        stall_timeout=float(conf.get('stall_timeout', STALL_TIMEOUT)),
+    )
+    resume_grace = float(conf.get('resume_grace', RESUME_GRACE))
 
     verify_ssl = conf.get('verify_ssl', True)
     nano_seed = conf.get('nano_seed')
+    deflate = deflate_conf(conf)
+    s5_auth = (conf.get('socks5_username'), conf.get('socks5_password'))
+    optimistic = conf.get('optimistic_open', False)
+
+    router = None
+    if conf.get('route_rules') or conf.get('local_routes') or conf.get('route_default'):
+        router = Router(conf.get('route_rules'), conf.get('local_routes', ()), conf.get('route_default', ROUTE_TUNNEL))
 
     loop = asyncio.get_event_loop()
     # loop.set_debug(True)
 
-    asyncio.ensure_future(
-        ws_client_auto_connect(mp_session, s5_dict, send_q, conf['server_url'], conf['username'], conf['password'], verify_ssl, nano_seed)
-    )
+    if router:
+        # reload the rules without a restart
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(router.reload()))
 
-    s5_task = asyncio.start_server(
-        lambda r, w: s5_server(r, w, send_q, mp_session, s5_dict),
+    for connection in pool:
+        asyncio.ensure_future(
+            ws_client_auto_connect(connection, connection.url, conf['username'], conf['password'], verify_ssl, nano_seed, deflate, resume_grace)
+        )
+
+    s5_task = start_relay_server(
+        lambda r, w: s5_server(r, w, pool, s5_auth, optimistic, router),
         conf['socks5_address'],
         conf['socks5_port'],
     )
 
     asyncio.ensure_future(s5_task)
+
+    if conf.get('status_port'):
+        asyncio.ensure_future(start_status_server(pool, conf.get('status_address', '127.0.0.1'), conf['status_port']))
+
+    if conf.get('dns_port'):
+        forwarder = DnsForwarder(lambda name: ws_dns_lookup(pool, name), int(conf.get('dns_cache_size', CACHE_SIZE)))
+        asyncio.ensure_future(start_dns_server(forwarder, conf.get('dns_address', '127.0.0.1'), conf['dns_port']))
+
+    if conf.get('http_port'):
+        http_task = start_relay_server(
+            lambda r, w: http_server(r, w, pool, optimistic, router),
+            conf.get('http_address', '127.0.0.1'),
+            conf['http_port'],
+        )
+        asyncio.ensure_future(http_task)
+
     loop.run_forever()
 
 
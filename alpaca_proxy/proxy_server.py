@@ -1,18 +1,31 @@
 #!/usr/bin/env python3
 
 import traceback
+import signal
 import asyncio
 from aiohttp import web
 from aiohttp import WSMsgType
 
 from .log import print_log
 from .socks5 import Socks5Parser
-from .multiplexing import Multiplexing
-from .ws_helper import ws_recv, ws_send
-from .ctrl_msg import CtrlMsg
+from .multiplexing import Multiplexing, Datagram
+from .ws_helper import ws_recv, ws_decode, ws_send_frames
+from .ctrl_msg import CtrlMsg, CtrlMsgError
 from .nano_account import Account
 from .nano_client import NanoLightClient, EMPTY_PREVIOUS, to_raw
-from .db import DB
+from .async_db import AsyncDB
+from .ledger import Ledger
+from .resolver import Resolver, is_name_error, is_nodata
+from .relay import open_relay_connection
+from .udp import UdpAssociation, UDP_TIMEOUT
+from .streams import StreamRegistry, PendingStream, StreamWriter, WriteBudget
+from .streams import MAX_STREAMS, WRITE_BUFFER, WRITE_TIMEOUT, PENDING_BUFFER, FLOW_HEADER
+from .compression import deflate_conf
+from .resume import ReplayBuffer, SessionTable, ws_send_ack, ws_send_resume, ws_replay
+from .resume import SESSION_HEADER, RECEIVED_HEADER, RESUME_GRACE, REPLAY_SIZE, CTRL_SIZE
+from .health import ws_send_pong
+from .workers import RemoteLedger, Aggregator, fork_workers, watch_workers, stop_workers
+from .workers import create_reuse_port_socket, create_unix_socket
 
 # cost unit is dollar
 NANO_PRICE_USD = 2.718281828
@@ -25,24 +38,57 @@ RAW_PER_BYTE = to_raw(COST_PER_BYTE * NANO_PRICE_USD)
 # warn on last 100 requests or 10,000 bytes
 BALANCE_WARN_THRESHOLD = RAW_PER_REQUEST * 100 + RAW_PER_BYTE * 10**4
 
+# Write buffer watermarks of the websocket and the destination sockets.
+# Above the high-water mark, the reader of the other side is paused,
+# and resumed when the buffer drains to the low-water mark.
+BUFFER_HIGH_WATER = 256 * 1024
+BUFFER_LOW_WATER = 64 * 1024
 
-async def send_s5_response(ws, stream_id, result=False, reason=None):
+# max concurrent connects to destinations per session
+MAX_CONNECTING = 64
+
+
+async def send_s5_response(send_q, stream_id, result=False, reason=None):
     ctrl = CtrlMsg(
         msg_type=CtrlMsg.TYPE_RESPONSE,
         stream_id=stream_id,
         result=result,
         reason=reason
         )
-    ctrl_str = ctrl.to_str()
+    # in the order of the data frames, and kept for replay if the session is resumable
+    await send_q.put((WSMsgType.TEXT, ctrl))
+
 
-    await ws_send(ws, ctrl_str, WSMsgType.TEXT)
+async def send_flow(send_q, stream_id, paused):
+    """
+    Pause the data of the stream on the client, or resume it.
+    """
+    ctrl = CtrlMsg(msg_type=CtrlMsg.TYPE_FLOW, stream_id=stream_id, paused=paused)
+    await send_q.put((WSMsgType.TEXT, ctrl))
 
 
-async def s5_connect(dst_addr, dst_port):
+async def refuse_stream(send_q, stream_id, reason=None):
+    """
+    With optimistic open, the client relays data before the response,
+    the RST tells it to drop the stream.
+    """
+    await send_s5_response(send_q, stream_id, False, reason)
+    await send_q.put((WSMsgType.BINARY, (stream_id, Multiplexing.RST)))
+
+
+async def s5_connect(dst_addr, dst_port, water_marks=None, resolver=None):
     try:
-        future = asyncio.open_connection(dst_addr, dst_port)
+        if resolver:
+            future = resolver.open_connection(dst_addr, dst_port)
+        else:
+            future = open_relay_connection(dst_addr, dst_port)
         s5_reader, s5_writer = await asyncio.wait_for(future, timeout=10)
         print_log('connect success to', dst_addr, dst_port)
+
+        if water_marks:
+            high_water, low_water = water_marks
+            s5_writer.transport.set_write_buffer_limits(high=high_water, low=low_water)
+
         return s5_reader, s5_writer
 
     # except (asyncio.TimeoutError, ConnectionRefusedError) as e:
@@ -51,200 +97,527 @@ async def s5_connect(dst_addr, dst_port):
         return None, None
 
 
-def charge_bytes(db, xrb_account, size):
+def charge_bytes(ledger, xrb_account, size):
     # return balance
     if not xrb_account:
         return 1
 
-    balance = db.get_bill_balance(xrb_account)
+    return ledger.charge(xrb_account, RAW_PER_BYTE * size, size=size)
 
-    spend = RAW_PER_BYTE * size
-    db.increase_total_bytes(xrb_account, size)
-    db.increase_total_spend(xrb_account, spend)
-    db.update_bill_balance(xrb_account)
 
-    return balance
-
-
-def charge_requests(db, xrb_account):
+def charge_requests(ledger, xrb_account):
     # return balance
     if not xrb_account:
         return 1
 
-    balance = db.get_bill_balance(xrb_account)
-
-    db.increase_total_requests(xrb_account, 1)
-    db.increase_total_spend(xrb_account, RAW_PER_REQUEST)
-    db.update_bill_balance(xrb_account)
+    return ledger.charge(xrb_account, RAW_PER_REQUEST, requests=1)
 
-    return balance
 
+async def s5_to_ws(send_q, stream_id, s5_reader, ledger, xrb_account):
+    """
+    Read from the destination only after the previous chunk was accepted by send_q.
+    send_q is bounded, and its sender waits while the ws transport is above its
+    high-water mark, so a slow client pauses the reading of the destination socket.
 
-async def s5_to_ws(ws, mp_session, stream_id, s5_reader, db, xrb_account):
+    Return True if the destination sent EOF, which is sent to the client as FIN.
+    On errors the client gets a RST.
+    """
     while True:
         try:
             s5_data = await s5_reader.read(8192)
         except Exception as e:
             print_log('stream_id:', stream_id, e)
-            break
+            await send_q.put((WSMsgType.BINARY, (stream_id, Multiplexing.RST)))
+            return False
 
-        balance = charge_bytes(db, xrb_account, len(s5_data))
+        balance = charge_bytes(ledger, xrb_account, len(s5_data))
         if balance < 0:
-            s5_data = b''
+            await send_q.put((WSMsgType.BINARY, (stream_id, Multiplexing.RST)))
+            return False
 
-        ws_data = mp_session.send(stream_id, s5_data)
-        await ws_send(ws, ws_data, WSMsgType.BINARY)
+        await send_q.put((WSMsgType.BINARY, (stream_id, s5_data)))
 
         # EOF
         if not s5_data:
-            break
+            return True
 
 
-async def ws_signature_handler(ctrl, db):
+async def ws_to_s5(send_q, streams, stream_id, stream_writer):
+    """
+    Write the data of the client to the destination until FIN. On errors, or if the
+    destination stalls, the client gets a RST.
+    """
+    try:
+        await stream_writer.run()
+    except Exception as e:
+        print_log('stream_id: {}, error write to the destination: {!r}'.format(stream_id, e))
+        streams.close(stream_id, abort=True)
+        await send_q.put((WSMsgType.BINARY, (stream_id, Multiplexing.RST)))
+        return
+
+    streams.shutdown(stream_id, received=True)
+
+
+async def ws_signature_handler(ctrl, db, ledger):
     client_account = Account(xrb_account=ctrl.client_account)
     is_valid = client_account.verify(bytes(ctrl.timestamped_msg, 'utf-8'), ctrl.signature)
     if not is_valid:
         print_log('signature not valid for account: {}'.format(ctrl.client_account))
         return False
 
-    db.update_account(ctrl.client_account, DB.ROLE_CLIENT)
-    await update_db_bill(db)
+    await register_client(db, ledger, ctrl.client_account)
     print_log('added account to database: {}'.format(ctrl.client_account))
 
     return True
 
 
-async def ws_request_handler(ws, mp_session, s5_dict, ctrl, db, xrb_account, account_verified):
+async def ws_request_handler(send_q, streams, ctrl, ledger, xrb_account, account_verified, water_marks, resolver, connect_sem, write_budget, flow):
+    """
+    Connect to the destination, return the reader if the stream is open.
+    """
     stream_id = ctrl.stream_id
 
-    if stream_id in s5_dict:
-        print_log('conflict stream_id: {}'.format(stream_id))
-        return
-
     if not account_verified:
-        await send_s5_response(ws, ctrl.stream_id, False, CtrlMsg.REASON_ACCOUNT_NOT_VERIFIED)
+        await refuse_stream(send_q, stream_id, CtrlMsg.REASON_ACCOUNT_NOT_VERIFIED)
         return
 
-    balance = charge_requests(db, xrb_account)
+    balance = charge_requests(ledger, xrb_account)
     if balance < 0:
-        await send_s5_response(ws, ctrl.stream_id, False, CtrlMsg.REASON_NEGATIVE_BALANCE)
+        await refuse_stream(send_q, stream_id, CtrlMsg.REASON_NEGATIVE_BALANCE)
         return
 
-    s5_reader, s5_writer = await s5_connect(ctrl.dst_addr, ctrl.dst_port)
+    async with connect_sem:
+        s5_reader, s5_writer = await s5_connect(ctrl.dst_addr, ctrl.dst_port, water_marks, resolver)
     if not s5_reader or not s5_writer:
-        await send_s5_response(ws, stream_id, False)
+        await refuse_stream(send_q, stream_id)
         return
 
-    await send_s5_response(ws, stream_id, True)
+    # reset by the client, or for too much data, while connecting
+    pending = streams.get(stream_id)
+    if not isinstance(pending, PendingStream):
+        s5_writer.transport.abort()
+        return
+
+    # No await until the writer is in streams and the pending frames are written,
+    # so they are written in order, and the writer is closed with the stream,
+    # even if this task is cancelled.
+    if flow:
+        flow = lambda paused: send_flow(send_q, stream_id, paused)
+    stream_writer = StreamWriter(s5_writer, write_budget, flow or None)
+    streams.set(stream_id, stream_writer, writer=s5_writer)
+    streams.add_task(stream_id, asyncio.ensure_future(ws_to_s5(send_q, streams, stream_id, stream_writer)))
+    try:
+        for s5_data in pending.chunks:
+            stream_writer.write(s5_data)
+    except Exception as e:
+        print_log('stream_id:', stream_id, e)
+        await send_q.put((WSMsgType.BINARY, (stream_id, Multiplexing.RST)))
+        return
+
+    await send_s5_response(send_q, stream_id, True)
+    return s5_reader
+
+
+async def ws_request_task(mp_session, send_q, streams, ctrl, ledger, session, water_marks, resolver):
+    """
+    Each request runs in its own task, so a slow connect doesn't stop the frames of other streams.
+    The task then relays the destination to ws, until EOF or the stream is closed.
+    """
+    xrb_account = session.xrb_account
+    eof_sent = False
+    try:
+        s5_reader = await ws_request_handler(send_q, streams, ctrl, ledger, xrb_account, session.account_verified, water_marks, resolver, session.connect_sem,
+                                            session.write_budget, session.flow)
+
+        if xrb_account and ledger.get_balance(xrb_account) < BALANCE_WARN_THRESHOLD:
+            await ws_send_bill(send_q, mp_session, ledger, xrb_account)
 
-    asyncio.ensure_future(s5_to_ws(ws, mp_session, stream_id, s5_reader, db, xrb_account))
-    s5_dict[stream_id] = s5_writer
+        if s5_reader:
+            eof_sent = await s5_to_ws(send_q, ctrl.stream_id, s5_reader, ledger, xrb_account)
 
+    except Exception as e:
+        print_log('stream_id:', ctrl.stream_id, e)
+
+    finally:
+        # after a FIN, the client may still send data
+        if eof_sent:
+            streams.shutdown(ctrl.stream_id, sent=True)
+        else:
+            streams.close(ctrl.stream_id, abort=True)
+
+
+async def ws_udp_task(send_q, streams, ctrl, ledger, session, resolver, udp_timeout):
+    """
+    Serve a UDP ASSOCIATE until the client closes its stream.
+    """
+    stream_id = ctrl.stream_id
+    xrb_account = session.xrb_account
+    association = None
+    try:
+        if not session.account_verified:
+            await refuse_stream(send_q, stream_id, CtrlMsg.REASON_ACCOUNT_NOT_VERIFIED)
+            return
+
+        if charge_requests(ledger, xrb_account) < 0:
+            await refuse_stream(send_q, stream_id, CtrlMsg.REASON_NEGATIVE_BALANCE)
+            return
+
+        association = UdpAssociation(stream_id, send_q, resolver, udp_timeout,
+                                     charge=lambda size: charge_bytes(ledger, xrb_account, size))
+        streams.set(stream_id, association)
+        await send_s5_response(send_q, stream_id, True)
+        await association.run()
+
+    except Exception as e:
+        print_log('stream_id:', stream_id, e)
+
+    finally:
+        if association:
+            print_log('stream_id: {}, udp association closed: {}'.format(stream_id, association.stats()))
+        streams.close(stream_id, abort=True)
+
+
+async def ws_dns_task(send_q, ctrl, session, resolver):
+    """
+    Resolve a name for the DNS listener of the client, with the cache of the destinations.
+    """
+    answer = CtrlMsg(msg_type=CtrlMsg.TYPE_DNS_ANSWER, stream_id=ctrl.stream_id, result=False, ttl=0)
+
+    if not session.account_verified:
+        answer.reason = CtrlMsg.REASON_ACCOUNT_NOT_VERIFIED
+    elif resolver is None:
+        answer.reason = 'no resolver'
+    else:
+        # a failure with ttl 0 is temporary, SERVFAIL for the client
+        try:
+            addrs = await asyncio.wait_for(resolver.resolve(ctrl.dst_addr), timeout=10)
+            answer.result = True
+            answer.addresses = [address for _family, address in addrs]
+            answer.ttl = resolver.ttl_of(ctrl.dst_addr)
+        except asyncio.TimeoutError:
+            answer.reason = 'timeout'
+        except (OSError, UnicodeError) as e:
+            answer.reason = str(e)
+            if is_nodata(e):
+                # NODATA, the name exists
+                answer.result = True
+                answer.addresses = []
+            if is_name_error(e):
+                # cached as long as by the resolver
+                answer.ttl = max(resolver.ttl_of(ctrl.dst_addr), 1)
+
+    await send_q.put((WSMsgType.TEXT, answer))
+
+
+async def ws_stream_handler(streams, send_q, stream_id, s5_data, ledger, xrb_account):
+    if stream_id not in streams:
+        # the client's FIN/RST of a stream already closed here is expected
+        if s5_data:
+            print_log('unkown stream_id: {}'.format(stream_id))
+        return
 
-async def ws_binary_handler(mp_session, s5_dict, ws_data, db, xrb_account):
-    stream_id, s5_data = mp_session.receive(ws_data)
-    if stream_id not in s5_dict:
-        print_log('unkown stream_id: {}'.format(stream_id))
+    if s5_data is Multiplexing.RST:
+        streams.close(stream_id, abort=True)
         return
 
-    balance = charge_bytes(db, xrb_account, len(s5_data))
+    balance = charge_bytes(ledger, xrb_account, len(s5_data))
     if balance < 0:
-        s5_data = b''
+        streams.close(stream_id, abort=True)
+        await send_q.put((WSMsgType.BINARY, (stream_id, Multiplexing.RST)))
+        return
+
+    s5_writer = streams.get(stream_id)
+    if isinstance(s5_writer, UdpAssociation) or isinstance(s5_data, Datagram):
+        if isinstance(s5_writer, UdpAssociation) and isinstance(s5_data, Datagram):
+            s5_writer.send(s5_data.data)
+        elif not s5_data:
+            # the client ended the association
+            streams.close(stream_id, abort=True)
+        else:
+            print_log('stream_id: {}, datagram on a stream, or data on an association'.format(stream_id))
+        return
 
-    # ws_to_s5
-    s5_writer = s5_dict[stream_id]
+    # ws_to_s5() waits for the destination to take the data, and the stream is paused
+    # on the client meanwhile, so this loop doesn't stop the other streams. The frames
+    # sent before the pause are buffered, up to the budget of the session.
     try:
-        s5_writer.write(s5_data)
+        if isinstance(s5_writer, PendingStream):
+            if s5_writer.append(s5_data):
+                return
+            print_log('stream_id:', stream_id, 'too much data before connected')
+
+        elif s5_writer.write(s5_data):
+            return
+        elif not s5_writer.budget.exceeded():
+            # an older client can't pause the stream, its frames are buffered meanwhile
+            await s5_writer.pause()
+            return
+        else:
+            print_log('stream_id:', stream_id, 'too much data buffered for the destinations')
+
     except Exception as e:
         print_log('stream_id:', stream_id, e)
-        s5_dict.pop(stream_id)
-        return
 
-    # EOF
-    if not s5_data:
-        s5_dict.pop(stream_id)
+    streams.close(stream_id, abort=True)
+    await send_q.put((WSMsgType.BINARY, (stream_id, Multiplexing.RST)))
 
 
-async def ws_send_bill(ws, mp_session, db, xrb_account):
-    bill = db.get_bill(xrb_account)
+async def ws_send_bill(send_q, mp_session, ledger, xrb_account):
+    bill = ledger.get_bill(xrb_account)
 
     ctrl = CtrlMsg(
         msg_type=CtrlMsg.TYPE_BALANCE,
         stream_id=mp_session.new_stream(),
-        balance=bill.get('balance'),
-        total_pay=bill.get('total_pay'),
-        total_spend=bill.get('total_spend'),
-        total_requests=bill.get('total_requests'),
-        total_bytes=bill.get('total_bytes'),
+        balance=str(bill['balance']),
+        total_pay=str(bill['total_pay']),
+        total_spend=str(bill['total_spend']),
+        total_requests=str(bill['total_requests']),
+        total_bytes=str(bill['total_bytes']),
     )
-    ctrl_str = ctrl.to_str()
-    print_log(ctrl_str)
-    await ws_send(ws, ctrl_str, WSMsgType.TEXT)
+    mp_session.del_stream(ctrl.stream_id)
+    print_log(ctrl)
+    await send_q.put((WSMsgType.TEXT, ctrl))
 
 
-async def ws_server(ws, db, cryptocoin):
-    mp_session = Multiplexing(role='server')
-    s5_dict = {'stream_id': 's5_writer'}
+class ProxySession():
+    """
+    The state of a client session. A resumable session outlives its websocket,
+    the streams and their tasks go on while the client reconnects.
+    """
 
-    if cryptocoin:
-        ctrl = CtrlMsg(
-            msg_type=CtrlMsg.TYPE_CHARGE,
-            stream_id=mp_session.new_stream(),
-            coin=cryptocoin.get('coin'),
-            server_account=cryptocoin.get('server_account'),
-            price_kilo_requests=cryptocoin.get('price_kilo_requests'),
-            price_gigabytes=cryptocoin.get('price_gigabytes'),
-        )
-        ctrl_str = ctrl.to_str()
-        await ws_send(ws, ctrl_str, WSMsgType.TEXT)
+    def __init__(self, max_streams, queue_size, max_connecting, replay=None, write_limits=None):
+        self.mp_session = Multiplexing(role='server')
+        self.streams = StreamRegistry(self.mp_session, max_streams)
+        # binary frames of all streams go through one sender task
+        self.send_q = asyncio.Queue(maxsize=queue_size)
+        self.connect_sem = asyncio.Semaphore(max_connecting)
+        self.replay = replay
+        self.write_budget = WriteBudget(*(write_limits or ()))
+        # the client pauses its streams on the flow messages, set by each ws
+        self.flow = False
 
-        account_verified = False
+        self.xrb_account = None
+        self.account_verified = False
 
-    else:
-        account_verified = True
+    def close(self):
+        self.streams.close_all(abort=True)
+        print_log('session closed, streams: {}'.format(self.streams.stats()))
+        if self.replay:
+            print_log('session replay: {}'.format(self.replay.stats()))
 
-    xrb_account = None
 
-    while True:
-        ws_msg = await ws_recv(ws)
-        if not ws_msg:
-            break
+async def ws_session(sessions, token, received):
+    """
+    Return the detached session of the token if it can be resumed, or None.
+    """
+    session = await sessions.take_over(token)
+    if session is None:
+        return None
+
+    items = session.replay.replay_from(received)
+    if items is None:
+        print_log('session can not be resumed, frames were dropped: {}'.format(session.replay.stats()))
+        session.close()
+        return None
+
+    return session, items
+
+
+async def ws_records_handler(ws, records, session, db, ledger, water_marks, resolver, udp_timeout):
+    """
+    Handle the (stream_id, data) records of a message, the data is a CtrlMsg for a control message.
+    Return False if the session must be closed.
+    """
+    mp_session, streams, send_q = session.mp_session, session.streams, session.send_q
+
+    for stream_id, s5_data in records:
+        if not isinstance(s5_data, CtrlMsg):
+            if session.replay and session.replay.received(len(s5_data or b'')):
+                await ws_send_ack(ws, mp_session, session.replay)
+            await ws_stream_handler(streams, send_q, stream_id, s5_data, ledger, session.xrb_account)
+            continue
 
-        if ws_msg.type == WSMsgType.TEXT:
-            ctrl = CtrlMsg()
-            ctrl.from_str(ws_msg.data)
+        ctrl = s5_data
+        if ctrl.msg_type == CtrlMsg.TYPE_ACK:
+            if session.replay:
+                session.replay.ack(ctrl.received)
+            continue
 
-            if ctrl.msg_type == CtrlMsg.TYPE_SIGNATURE:
-                account_verified = await ws_signature_handler(ctrl, db)
-                if not account_verified:
-                    break
+        # answered right away, not numbered for resume, like the acks
+        if ctrl.msg_type == CtrlMsg.TYPE_PING:
+            await ws_send_pong(ws, mp_session, ctrl)
+            continue
 
-                xrb_account = ctrl.client_account
-                await ws_send_bill(ws, mp_session, db, xrb_account)
+        if session.replay and session.replay.received(CTRL_SIZE):
+            await ws_send_ack(ws, mp_session, session.replay)
 
-            if ctrl.msg_type == CtrlMsg.TYPE_REQUEST:
-                await ws_request_handler(ws, mp_session, s5_dict, ctrl, db, xrb_account, account_verified)
+        if ctrl.msg_type == CtrlMsg.TYPE_SIGNATURE:
+            session.account_verified = await ws_signature_handler(ctrl, db, ledger)
+            if not session.account_verified:
+                return False
 
-                if xrb_account and db.get_bill_balance(xrb_account) < BALANCE_WARN_THRESHOLD:
-                    await ws_send_bill(ws, mp_session, db, xrb_account)
+            session.xrb_account = ctrl.client_account
+            await ws_send_bill(send_q, mp_session, ledger, session.xrb_account)
 
-        elif ws_msg.type == WSMsgType.BINARY:
-            await ws_binary_handler(mp_session, s5_dict, ws_msg.data, db, xrb_account)
+        if ctrl.msg_type == CtrlMsg.TYPE_REQUEST:
+            if ctrl.stream_id in streams:
+                print_log('conflict stream_id: {}'.format(ctrl.stream_id))
+                continue
+
+            if not streams.add(ctrl.stream_id, PendingStream(PENDING_BUFFER)):
+                await send_s5_response(send_q, ctrl.stream_id, False, CtrlMsg.REASON_TOO_MANY_STREAMS)
+                continue
+
+            task = asyncio.ensure_future(ws_request_task(mp_session, send_q, streams, ctrl, ledger, session, water_marks, resolver))
+            streams.add_task(ctrl.stream_id, task)
+
+        if ctrl.msg_type == CtrlMsg.TYPE_DNS:
+            asyncio.ensure_future(ws_dns_task(send_q, ctrl, session, resolver))
+
+        if ctrl.msg_type == CtrlMsg.TYPE_UDP_ASSOCIATE:
+            if ctrl.stream_id in streams:
+                print_log('conflict stream_id: {}'.format(ctrl.stream_id))
+                continue
+
+            if mp_session.version < Multiplexing.VERSION_3:
+                await send_s5_response(send_q, ctrl.stream_id, False, CtrlMsg.REASON_DATAGRAM_NOT_SUPPORTED)
+                continue
+
+            if not streams.add(ctrl.stream_id):
+                await send_s5_response(send_q, ctrl.stream_id, False, CtrlMsg.REASON_TOO_MANY_STREAMS)
+                continue
+
+            task = asyncio.ensure_future(ws_udp_task(send_q, streams, ctrl, ledger, session, resolver, udp_timeout))
+            streams.add_task(ctrl.stream_id, task)
+
+    return True
+
+
+async def ws_server(ws, db, ledger, cryptocoin, water_marks=None, resolver=None, max_connecting=MAX_CONNECTING, max_streams=MAX_STREAMS, deflate=None, sessions=None, token=None, received=0, udp_timeout=UDP_TIMEOUT, write_limits=None, flow=False):
+    high_water = water_marks[0] if water_marks else BUFFER_HIGH_WATER
+    resumable = bool(sessions is not None and token)
+
+    resumed = await ws_session(sessions, token, received) if resumable else None
+    if resumed:
+        session, items = resumed
+    else:
+        replay = ReplayBuffer(sessions.replay_size) if resumable else None
+        session = ProxySession(max_streams, max(high_water // 8192, 1), max_connecting, replay, write_limits)
+
+    session.flow = flow
+    mp_session, streams, send_q = session.mp_session, session.streams, session.send_q
+    mp_session.set_protocol(ws.ws_protocol, *(deflate or ()))
+
+    # a session broken by a bad message is closed, not kept to be resumed
+    broken = False
+    send_task = None
+    # whatever ends the loop, an error included, the session is reclaimed
+    try:
+        if resumable:
+            sessions.serve(token, ws)
+            await ws_send_resume(ws, mp_session, session.replay, bool(resumed))
+            if resumed:
+                await ws_replay(ws, mp_session, items)
+                print_log('session resumed, streams: {}'.format(streams.stats()))
+
+        send_task = asyncio.ensure_future(ws_send_frames(send_q, ws, mp_session, replay=session.replay))
+
+        if resumed:
+            # the account was verified on the old ws
+            pass
+
+        elif cryptocoin:
+            ctrl = CtrlMsg(
+                msg_type=CtrlMsg.TYPE_CHARGE,
+                stream_id=mp_session.new_stream(),
+                coin=cryptocoin.get('coin'),
+                server_account=cryptocoin.get('server_account'),
+                price_kilo_requests=cryptocoin.get('price_kilo_requests'),
+                price_gigabytes=cryptocoin.get('price_gigabytes'),
+            )
+            mp_session.del_stream(ctrl.stream_id)
+            await send_q.put((WSMsgType.TEXT, ctrl))
+
+            session.account_verified = False
+
+        else:
+            session.account_verified = True
+
+        while True:
+            ws_msg = await ws_recv(ws)
+            if not ws_msg:
+                break
+
+            try:
+                records = ws_decode(mp_session, ws_msg)
+            except (ValueError, CtrlMsgError) as e:
+                # the same message would be sent again if resumed
+                print_log('bad message from client, close the session: {}'.format(e))
+                broken = True
+                break
+
+            if not await ws_records_handler(ws, records, session, db, ledger, water_marks, resolver, udp_timeout):
+                break
+
+    finally:
+        if send_task:
+            send_task.cancel()
+        if mp_session.deflate:
+            print_log('session deflate: {}'.format(mp_session.deflate.stats()))
+
+        if resumable:
+            sessions.unserve(token, ws)
+
+        if resumable and session.account_verified and not broken:
+            sessions.detach(token, session)
+            print_log('session detached, streams: {}'.format(streams.stats()))
+        else:
+            session.close()
+
+        # last, it may raise if the connection is lost
+        await ws.close()
 
-    await ws.close()
-    print_log('session closed')
     return ws
 
 
 async def http_server_handler(request):
     try:
-        ws = web.WebSocketResponse(heartbeat=30)
+        deflate = request.app['deflate']
+        if deflate:
+            protocols = Multiplexing.PROTOCOLS_DEFLATE
+        else:
+            protocols = Multiplexing.PROTOCOLS
+
+        # a client asking for a resumable session sends its token, and the frames it received
+        token = request.headers.get(SESSION_HEADER)
+        try:
+            received = int(request.headers.get(RECEIVED_HEADER, 0))
+            if received < 0:
+                raise ValueError('negative')
+        except ValueError as e:
+            print_log('bad {} header from {}, refused: {}'.format(RECEIVED_HEADER, request.remote, e))
+            return web.Response(status=400, text='bad {} header'.format(RECEIVED_HEADER))
+
+        ws = web.WebSocketResponse(heartbeat=30, protocols=protocols)
         await ws.prepare(request)
         print_log('new session connected from {}'.format(request.protocol))
 
+        high_water, low_water = water_marks = request.app['water_marks']
+        request.transport.set_write_buffer_limits(high=high_water, low=low_water)
+
         db = request.app['db']
+        ledger = request.app['ledger']
         cryptocoin = request.app['cryptocoin']
-        await ws_server(ws, db, cryptocoin)
+        resolver = request.app['resolver']
+        max_connecting = request.app['max_connecting']
+        max_streams = request.app['max_streams']
+        sessions = request.app['sessions']
+        udp_timeout = request.app['udp_timeout']
+        write_limits = request.app['write_limits']
+
+        flow = request.headers.get(FLOW_HEADER) == '1'
+        await ws_server(ws, db, ledger, cryptocoin, water_marks, resolver, max_connecting, max_streams, deflate, sessions, token, received, udp_timeout,
+                        write_limits, flow)
 
     except Exception as e:
         error_trace = traceback.format_exc()
@@ -253,7 +626,8 @@ async def http_server_handler(request):
 
 async def update_db_history(db, account):
     """
-    Update block_chain history of a account from network, order blocks by block chain.
+    Get block_chain history of a account from network, up to a block in the db.
+    Return the blocks ordered by block chain.
     """
     client = NanoLightClient(account)
     await client.connect()
@@ -287,7 +661,7 @@ async def update_db_history(db, account):
         count = 20
 
         # found one in the db
-        if db.get_block(head):
+        if await db.get_block(head):
             break
 
         # legacy open block
@@ -299,63 +673,244 @@ async def update_db_history(db, account):
             break
 
     history_blocks.reverse()
-    for block in history_blocks:
-        db.update_block(account.xrb_account, block)
+    return history_blocks
 
 
-async def update_db_bill(db):
+async def update_db_blocks(db, account, blocks):
     """
-    Get all client accounts and their pay to all server accounts.
+    Return the list of (client_account, amount) of the new pays.
     """
-    for client_account in db.get_client_accounts():
-        total_pay = 0
-        for server_account in db.get_server_accounts():
-            for block in db.get_receive_blocks(server_account, client_account):
-                total_pay += int(block['amount'])
-        db.update_total_pay(client_account, str(total_pay))
+    # queued together, the blocks are written in one transaction
+    pays = await asyncio.gather(*[db.update_block(account.xrb_account, block) for block in blocks])
+    return [pay for pay in pays if pay]
+
 
+async def repair_db_bill(db, ledger):
+    """
+    Sum the pay of all clients to all server accounts again, with one query.
+    The pay is merged into the live balance in the ledger.
+    """
+    total_pays = await db.get_total_pays()
+    await ledger.load_bills(total_pays)
+    for client_account, total_pay in total_pays.items():
+        ledger.update_total_pay(client_account, total_pay)
+    await asyncio.gather(*[db.update_account(client_account, AsyncDB.ROLE_CLIENT) for client_account in total_pays])
 
-async def update_db(db, account):
+
+async def update_db(db, ledger, account, repair=False):
+    """
+    A new pay is added to the bill of its client only. With `repair`, all the
+    bills are summed again, for the pays of a crash or a failed update.
+    """
     # create or update the server account in db
-    db.update_account(account.xrb_account, DB.ROLE_SERVER)
+    await db.update_account(account.xrb_account, AsyncDB.ROLE_SERVER)
 
-    await update_db_history(db, account)
+    history_blocks = await update_db_history(db, account)
 
-    # create or update all the client accounts in db.
-    for client in db.get_client_accounts():
-        db.update_account(client, DB.ROLE_CLIENT)
+    async with ledger.pay_lock:
+        pays = await update_db_blocks(db, account, history_blocks)
+        if repair:
+            await repair_db_bill(db, ledger)
+            return
 
-    await update_db_bill(db)
+        await ledger.load_bills(client_account for client_account, _amount in pays)
+        for client_account, amount in pays:
+            ledger.add_pay(client_account, amount)
 
+    await asyncio.gather(*[db.update_account(client_account, AsyncDB.ROLE_CLIENT) for client_account, _amount in pays])
 
-async def update_db_periodically(db, account):
+
+async def update_db_periodically(db, ledger, account):
+    # the ledger may have missed the pays before the last crash
+    repair = True
     while True:
         try:
-            await update_db(db, account)
+            await update_db(db, ledger, account, repair)
+            repair = False
         except Exception as e:
             print_log('Error update_db: {}'.format(e))
-        db.commit()
+            # the pays of the blocks inserted before the error are not counted yet
+            repair = True
         print_log('Sleep 60s and update the database.')
         await asyncio.sleep(60)
 
 
-def start_proxy_server(conf):
-    print_log(conf)
+async def close_ledger(ledger, db):
+    await ledger.close()
+    print_log('flushed bills to the database')
+    await db.close()
+
+
+def get_prices():
+    return {
+        'raw_per_request': RAW_PER_REQUEST,
+        'raw_per_byte': RAW_PER_BYTE,
+    }
+
+
+def set_prices(prices):
+    """
+    Worker processes get the prices from the master, which syncs with Nano.
+    """
+    global RAW_PER_REQUEST, RAW_PER_BYTE, BALANCE_WARN_THRESHOLD
+    RAW_PER_REQUEST = prices['raw_per_request']
+    RAW_PER_BYTE = prices['raw_per_byte']
+    BALANCE_WARN_THRESHOLD = RAW_PER_REQUEST * 100 + RAW_PER_BYTE * 10**4
+
+
+async def register_client(db, ledger, client_account):
+    if db is None:
+        # in a worker process, the master owns the database
+        await ledger.register_client(client_account)
+        return
+
+    await db.update_account(client_account, AsyncDB.ROLE_CLIENT)
+    async with ledger.pay_lock:
+        await ledger.load_bills([client_account])
+        ledger.update_total_pay(client_account, await db.get_total_pay(client_account))
+
+
+def create_resolver(conf):
+    return Resolver(
+        max_size=int(conf.get('dns_cache_size', 4096)),
+        ttl=float(conf.get('dns_cache_ttl', 300)),
+        negative_ttl=float(conf.get('dns_negative_ttl', 30)),
+        connect=open_relay_connection,
+    )
 
+
+def create_sessions(conf):
+    """
+    Return None if `resume_grace` is 0, and sessions are not resumable.
+    """
+    grace = float(conf.get('resume_grace', RESUME_GRACE))
+    if not grace:
+        return None
+
+    return SessionTable(grace, int(conf.get('resume_buffer', REPLAY_SIZE)))
+
+
+def create_app(water_marks, cryptocoin, db, ledger, resolver=None, max_connecting=MAX_CONNECTING, max_streams=MAX_STREAMS, deflate=None, sessions=None, udp_timeout=UDP_TIMEOUT, write_limits=None):
     app = web.Application()
     app.router.add_get('/', http_server_handler)
     app.router.add_get('/{tail:.*}', http_server_handler)
 
+    app['water_marks'] = water_marks
+    app['cryptocoin'] = cryptocoin
+    app['db'] = db
+    app['ledger'] = ledger
+    app['resolver'] = resolver
+    app['max_connecting'] = max_connecting
+    app['max_streams'] = max_streams
+    app['deflate'] = deflate
+    app['sessions'] = sessions
+    app['udp_timeout'] = udp_timeout
+    app['write_limits'] = write_limits
+
+    return app
+
+
+def start_proxy_workers(conf, workers, water_marks, write_limits, cryptocoin_dict, account):
+    """
+    Fork worker processes to serve the websockets, they share the listen socket.
+    The master process owns the database, and syncs with Nano.
+    """
+    server_host = conf.get('server_host')
+    server_port = conf.get('server_port')
+    unix_path = conf.get('unix_path')
+    max_connecting = int(conf.get('max_connecting', MAX_CONNECTING))
+    max_streams = int(conf.get('max_streams', MAX_STREAMS))
+    udp_timeout = float(conf.get('udp_timeout', UDP_TIMEOUT))
+    deflate = deflate_conf(conf)
+
+    if unix_path:
+        listen_sock = create_unix_socket(unix_path)
+    else:
+        listen_sock = None
+
+    def worker_main(index, ipc_sock):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        if cryptocoin_dict:
+            ledger = RemoteLedger(ipc_sock, on_prices=set_prices)
+            loop.run_until_complete(ledger.connect())
+        else:
+            ledger = None
+
+        sock = listen_sock or create_reuse_port_socket(server_host, server_port)
+        app = create_app(water_marks, cryptocoin_dict, None, ledger, create_resolver(conf), max_connecting, max_streams, deflate, create_sessions(conf), udp_timeout,
+                         write_limits)
+        if ledger:
+            app.on_cleanup.append(lambda app: app['ledger'].close())
+        print_log('worker {} is serving'.format(index))
+        web.run_app(app, loop=loop, sock=sock, print=None)
+
+    worker_list = fork_workers(workers, worker_main)
+    if listen_sock:
+        listen_sock.close()
+
+    loop = asyncio.get_event_loop()
+
+    if cryptocoin_dict:
+        db = AsyncDB(conf.get('database', '/tmp/proxy.db'))
+        ledger = Ledger(
+            db,
+            flush_interval=float(conf.get('bill_flush_interval', 10)),
+            flush_bytes=int(conf.get('bill_flush_bytes', 10*1024*1024)),
+        )
+        aggregator = Aggregator(
+            ledger,
+            lambda client_account: register_client(db, ledger, client_account),
+            get_prices,
+        )
+        serve_tasks = [loop.create_task(aggregator.serve(ipc_sock)) for _pid, ipc_sock in worker_list]
+        loop.create_task(update_db_periodically(db, ledger, account))
+        loop.create_task(ledger.flush_periodically())
+
+    def stop_master(_signum, _frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, stop_master)
+
+    try:
+        loop.run_until_complete(watch_workers(worker_list))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(stop_workers(worker_list))
+        if cryptocoin_dict:
+            # the charges the workers sent on exit, before the bills are flushed
+            loop.run_until_complete(asyncio.wait(serve_tasks, timeout=5))
+            loop.run_until_complete(close_ledger(ledger, db))
+
+
+def start_proxy_server(conf):
+    print_log(conf)
+
     server_host = conf.get('server_host')
     server_port = conf.get('server_port')
     unix_path = conf.get('unix_path')
+    workers = int(conf.get('workers', 1))
+    max_connecting = int(conf.get('max_connecting', MAX_CONNECTING))
+    max_streams = int(conf.get('max_streams', MAX_STREAMS))
+    udp_timeout = float(conf.get('udp_timeout', UDP_TIMEOUT))
+    deflate = deflate_conf(conf)
 
     cryptocoin = conf.get('cryptocoin')
     database = conf.get('database', '/tmp/proxy.db')
+    bill_flush_interval = float(conf.get('bill_flush_interval', 10))
+    bill_flush_bytes = int(conf.get('bill_flush_bytes', 10*1024*1024))
     nano_seed = conf.get('nano_seed')
     price_kilo_requests = conf.get('price_kilo_requests', 0.01)
     price_gigabytes = conf.get('price_gigabytes', 0.01)
 
+    buffer_high_water = int(conf.get('buffer_high_water', BUFFER_HIGH_WATER))
+    buffer_low_water = int(conf.get('buffer_low_water', BUFFER_LOW_WATER))
+    if buffer_low_water > buffer_high_water:
+        raise ValueError('buffer_low_water must not be greater than buffer_high_water')
+    water_marks = (buffer_high_water, buffer_low_water)
+    write_limits = (int(conf.get('write_buffer', WRITE_BUFFER)), float(conf.get('write_timeout', WRITE_TIMEOUT)))
+
     cost_per_request = float(price_kilo_requests) / 1000
     cost_per_byte = float(price_gigabytes) / 10**9
 
@@ -366,11 +921,7 @@ def start_proxy_server(conf):
         account = Account(seed=nano_seed)
         print_log('Your Nano account is: {}'.format(account.xrb_account))
 
-        db = DB(database)
-        asyncio.ensure_future(update_db_periodically(db, account))
-
-        app['db'] = db
-        app['cryptocoin'] = {
+        cryptocoin_dict = {
             'coin': cryptocoin,
             'server_account': account.xrb_account,
             'price_gigabytes': price_gigabytes,
@@ -378,16 +929,32 @@ def start_proxy_server(conf):
         }
 
     else:
-        app['cryptocoin'] = {}
-        app['db'] = None
+        account = None
+        cryptocoin_dict = {}
 
-    if unix_path:
-        web.run_app(app, path=unix_path)
-    else:
-        web.run_app(app, host=server_host, port=server_port)
+    if workers > 1:
+        start_proxy_workers(conf, workers, water_marks, write_limits, cryptocoin_dict, account)
+        return
 
     loop = asyncio.get_event_loop()
-    loop.run_forever()
+
+    if cryptocoin:
+        db = AsyncDB(database)
+        ledger = Ledger(db, flush_interval=bill_flush_interval, flush_bytes=bill_flush_bytes)
+        loop.create_task(update_db_periodically(db, ledger, account))
+        loop.create_task(ledger.flush_periodically())
+    else:
+        db, ledger = None, None
+
+    app = create_app(water_marks, cryptocoin_dict, db, ledger, create_resolver(conf), max_connecting, max_streams, deflate, create_sessions(conf), udp_timeout,
+                     write_limits)
+    if ledger:
+        app.on_cleanup.append(lambda app: close_ledger(app['ledger'], app['db']))
+
+    if unix_path:
+        web.run_app(app, loop=loop, path=unix_path)
+    else:
+        web.run_app(app, loop=loop, host=server_host, port=server_port)
 
 
 def _test_main():
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+# Read sockets into preallocated arenas, and hand out the data as memoryviews without copying.
+
+# Author: twitter.com/alpacatunnel
+
+
+import asyncio
+
+
+# an arena is shared by the reads until less than MIN_READ bytes are left
+ARENA_SIZE = 64 * 1024
+MIN_READ = 8 * 1024
+# bytes read and not consumed before the socket is paused
+MAX_BUFFERED = 256 * 1024
+
+
+class RelayProtocol(asyncio.BufferedProtocol):
+    """
+    The transport receives right into the free tail of the current arena, and each
+    read is kept as a memoryview of it. An arena is never written twice, a new one is
+    allocated when it's full, and the old one is freed with its last memoryview. So
+    the data can be queued and packed without a copy.
+
+    A memoryview pins its whole arena, so a read shorter than MIN_READ is returned
+    as bytes, and the ReplayBuffer copies the slices it keeps until they are acked.
+
+    It's the reader and the drain helper of a RelayWriter, like StreamReaderProtocol.
+    """
+
+    def __init__(self, arena_size=ARENA_SIZE, max_buffered=MAX_BUFFERED):
+        self.arena_size = arena_size
+        self.max_buffered = max_buffered
+        self.transport = None
+
+        self._arena = None
+        self._offset = 0
+        self._chunks = []
+        self._size = 0
+        self._eof = False
+        self._exc = None
+
+        self._read_paused = False
+        self._write_paused = False
+        self._waiter = None
+        self._drain_waiters = []
+
+        self.arenas = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        if self._arena is None or len(self._arena) - self._offset < MIN_READ:
+            self._arena = memoryview(bytearray(self.arena_size))
+            self._offset = 0
+            self.arenas += 1
+        return self._arena[self._offset:]
+
+    def buffer_updated(self, nbytes):
+        self._chunks.append(self._arena[self._offset:self._offset + nbytes])
+        self._offset += nbytes
+        self._size += nbytes
+
+        if self._size > self.max_buffered and not self._read_paused:
+            self._read_paused = True
+            self.transport.pause_reading()
+        self._wake_up()
+
+    def eof_received(self):
+        self._eof = True
+        self._wake_up()
+        # keep the writing side open, the peer may still read
+        return True
+
+    def connection_lost(self, exc):
+        self._eof = True
+        self._exc = exc
+        self._wake_up()
+
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                if exc is None:
+                    waiter.set_result(None)
+                else:
+                    waiter.set_exception(exc)
+        self._drain_waiters = []
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._drain_waiters = []
+
+    def _wake_up(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def read(self, n):
+        """
+        Return up to n bytes as a memoryview, b'' on EOF.
+        """
+        while not self._chunks:
+            if self._exc is not None:
+                raise self._exc
+            if self._eof:
+                return b''
+            self._waiter = asyncio.get_event_loop().create_future()
+            await self._waiter
+
+        chunk = self._chunks[0]
+        if len(chunk) > n:
+            self._chunks[0] = chunk[n:]
+            chunk = chunk[:n]
+        else:
+            self._chunks.pop(0)
+
+        self._size -= len(chunk)
+        if len(chunk) < MIN_READ:
+            # a small read of an idle connection would pin an arena while queued
+            chunk = bytes(chunk)
+        if self._read_paused and self._size <= self.max_buffered // 2:
+            self._read_paused = False
+            self.transport.resume_reading()
+        return chunk
+
+    async def drain(self):
+        if self.transport.is_closing():
+            # let the loop run, so a closed connection raises
+            await asyncio.sleep(0)
+        if self._exc is not None:
+            raise self._exc
+        if not self._write_paused:
+            return
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._drain_waiters.append(waiter)
+        await waiter
+
+
+class RelayWriter():
+    """
+    The part of asyncio.StreamWriter used by the relays.
+    """
+
+    def __init__(self, transport, protocol):
+        self.transport = transport
+        self._protocol = protocol
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def can_write_eof(self):
+        return self.transport.can_write_eof()
+
+    def write_eof(self):
+        return self.transport.write_eof()
+
+    def close(self):
+        return self.transport.close()
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    async def drain(self):
+        await self._protocol.drain()
+
+
+async def open_relay_connection(host, port):
+    """
+    Same as asyncio.open_connection(), the reader is a RelayProtocol.
+    """
+    loop = asyncio.get_event_loop()
+    transport, protocol = await loop.create_connection(RelayProtocol, host, port)
+    return protocol, RelayWriter(transport, protocol)
+
+
+async def start_relay_server(client_connected_cb, host, port):
+    """
+    Same as asyncio.start_server(), the reader is a RelayProtocol.
+    """
+    loop = asyncio.get_event_loop()
+
+    def factory():
+        protocol = RelayProtocol()
+
+        def connection_made(transport):
+            RelayProtocol.connection_made(protocol, transport)
+            loop.create_task(client_connected_cb(protocol, RelayWriter(transport, protocol)))
+
+        protocol.connection_made = connection_made
+        return protocol
+
+    return await loop.create_server(factory, host, port)
+
+
+async def _relay_bench(connect, size, chunk=8192):
+    """
+    Read `size` bytes sent by a thread, queue every read like s5_to_ws() does, and
+    pack it into a multiplexing record. Return the seconds spent, and the traced
+    memory allocated per MB relayed, summed over the sampled reads.
+    """
+    import time
+    import socket
+    import threading
+    import tracemalloc
+    from .multiplexing import Multiplexing
+
+    listen_sock = socket.create_server(('127.0.0.1', 0))
+    port = listen_sock.getsockname()[1]
+    payload = b'x' * (1024 * 1024)
+
+    def send():
+        sock, _addr = listen_sock.accept()
+        for _x in range(size // len(payload)):
+            sock.sendall(payload)
+        sock.close()
+
+    thread = threading.Thread(target=send)
+    thread.start()
+
+    mp_session = Multiplexing(version=Multiplexing.VERSION_3)
+    send_q = asyncio.Queue(maxsize=32)
+    reader, writer = await connect('127.0.0.1', port)
+
+    tracemalloc.start()
+    start = time.time()
+    allocated = 0
+    while True:
+        before = tracemalloc.get_traced_memory()[0]
+        data = await reader.read(chunk)
+        send_q.put_nowait(data)
+        allocated += max(tracemalloc.get_traced_memory()[0] - before, 0)
+        if not data:
+            break
+        if send_q.full():
+            while not send_q.empty():
+                mp_session.pack([(1, send_q.get_nowait())])
+    seconds = time.time() - start
+    tracemalloc.stop()
+
+    writer.close()
+    thread.join()
+    listen_sock.close()
+    return seconds, allocated / (size / 2**20)
+
+
+def _test_main():
+    loop = asyncio.get_event_loop()
+    size = 64 * 1024 * 1024
+
+    for name, connect in (('StreamReader', asyncio.open_connection), ('RelayProtocol', open_relay_connection)):
+        seconds, allocated = loop.run_until_complete(_relay_bench(connect, size))
+        print('{:14} {:.0f} MB/s, {:.0f} KB allocated per MB read'.format(
+            name, size / seconds / 2**20, allocated / 1024))
+
+
+if __name__ == '__main__':
+    _test_main()
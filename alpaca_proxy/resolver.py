@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+# Cache DNS lookups and race connects to the resolved addresses (RFC 8305).
+
+# Author: twitter.com/alpacatunnel
+
+
+import time
+import socket
+import asyncio
+import ipaddress
+from collections import OrderedDict
+
+
+# getaddrinfo errors of a name that doesn't exist, or has no address. The other
+# errors, e.g. EAI_AGAIN for a timeout or a SERVFAIL, may be gone on the next try.
+NXDOMAIN_ERRORS = {socket.EAI_NONAME}
+NODATA_ERRORS = {getattr(socket, name) for name in ('EAI_NODATA', 'EAI_ADDRFAMILY') if hasattr(socket, name)}
+
+
+def is_nodata(error):
+    """
+    True if the name exists, without an address.
+    """
+    return isinstance(error, socket.gaierror) and error.errno in NODATA_ERRORS
+
+
+def is_name_error(error):
+    """
+    True if the lookup failed for the name itself, not for the resolver, the
+    failure is cached then.
+    """
+    if isinstance(error, UnicodeError):
+        # not a valid domain name
+        return True
+    return isinstance(error, socket.gaierror) and error.errno in NXDOMAIN_ERRORS | NODATA_ERRORS
+
+
+async def getaddrinfo_lookup(host):
+    """
+    The default lookup, return a list of (family, address) in the order of getaddrinfo.
+    getaddrinfo doesn't return the TTL of the records, the Resolver uses its own.
+    """
+    loop = asyncio.get_event_loop()
+    infos = await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+
+    addrs = []
+    for family, _type, _proto, _canonname, sockaddr in infos:
+        if (family, sockaddr[0]) not in addrs:
+            addrs.append((family, sockaddr[0]))
+    return addrs
+
+
+def interleave_families(addrs):
+    """
+    Alternate the address families, start with the family of the first address.
+    """
+    if not addrs:
+        return []
+
+    first_family = addrs[0][0]
+    first = [a for a in addrs if a[0] == first_family]
+    other = [a for a in addrs if a[0] != first_family]
+
+    result = []
+    while first or other:
+        if first:
+            result.append(first.pop(0))
+        if other:
+            result.append(other.pop(0))
+    return result
+
+
+class _Failure():
+    """
+    A failed lookup in the cache. Each hit raises a new exception, a cached one
+    would gather the traceback of every raise, and keep its frames alive.
+    """
+
+    def __init__(self, error):
+        self.error_type = type(error)
+        self.args = error.args
+
+    def error(self):
+        return self.error_type(*self.args)
+
+
+class Resolver():
+    """
+    A LRU cache of DNS lookups. Concurrent lookups of the same name share one query,
+    and the names that don't exist, or have no address, are cached for `negative_ttl`
+    seconds. The other failures are not cached.
+
+    `lookup` is a coroutine function, lookup(host) returns a list of (family, address).
+    Replace it to resolve names without the system resolver, e.g. in tests.
+    `connect` is asyncio.open_connection or a function of the same signature.
+    """
+
+    def __init__(self, lookup=None, max_size=4096, ttl=300, negative_ttl=30, attempt_delay=0.25, connect=None):
+        self.lookup = lookup or getaddrinfo_lookup
+        self.connect = connect or asyncio.open_connection
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.attempt_delay = attempt_delay
+
+        # host: (expire_time, addrs or _Failure)
+        self._cache = OrderedDict()
+        self._pending = {}
+
+    def _cache_get(self, host):
+        entry = self._cache.get(host)
+        if entry is None:
+            return None
+
+        expire_time, result = entry
+        if expire_time < time.time():
+            del self._cache[host]
+            return None
+
+        self._cache.move_to_end(host)
+        return result
+
+    def _cache_set(self, host, result, ttl):
+        self._cache[host] = (time.time() + ttl, result)
+        self._cache.move_to_end(host)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    async def _lookup(self, host):
+        try:
+            addrs = await self.lookup(host)
+            if not addrs:
+                raise socket.gaierror(socket.EAI_NONAME, 'no address for {}'.format(host))
+        except (OSError, UnicodeError) as e:
+            if is_name_error(e):
+                self._cache_set(host, _Failure(e), self.negative_ttl)
+            raise
+
+        self._cache_set(host, addrs, self.ttl)
+        return addrs
+
+    async def resolve(self, host):
+        """
+        Return a list of (family, address). IP literals are returned without lookup.
+        """
+        try:
+            ip = ipaddress.ip_address(host)
+            family = socket.AF_INET if ip.version == 4 else socket.AF_INET6
+            return [(family, str(ip))]
+        except ValueError:
+            pass
+
+        result = self._cache_get(host)
+        if isinstance(result, _Failure):
+            raise result.error()
+        if result is not None:
+            return result
+
+        future = self._pending.get(host)
+        if future is None:
+            future = self._pending[host] = asyncio.ensure_future(self._lookup(host))
+            future.add_done_callback(lambda _f: self._pending.pop(host, None))
+
+        # one waiter cancelled should not cancel the shared lookup
+        return await asyncio.shield(future)
+
+    def ttl_of(self, host):
+        """
+        Return the seconds before the cached result of host expires, `ttl` if not cached.
+        """
+        entry = self._cache.get(host)
+        if entry is None:
+            return self.ttl
+        return max(int(entry[0] - time.time()), 0)
+
+    async def _race(self, addrs, port):
+        """
+        Start a connect attempt every `attempt_delay` seconds, or as soon as the
+        previous one failed. The first one connected wins, the others are closed.
+        """
+        addrs = list(addrs)
+        pending = set()
+        last_error = None
+        winner = None
+
+        try:
+            while addrs or pending:
+                if addrs:
+                    _family, address = addrs.pop(0)
+                    pending.add(asyncio.ensure_future(self.connect(address, port)))
+
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=self.attempt_delay if addrs else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+
+                for task in done:
+                    if task.exception():
+                        last_error = task.exception()
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        task.result()[1].close()
+
+                if winner:
+                    return winner
+
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(_close_connected)
+
+        raise last_error or OSError('no address to connect')
+
+    async def open_connection(self, host, port):
+        """
+        Same as asyncio.open_connection(host, port), with the cached lookup.
+        """
+        addrs = await self.resolve(host)
+        return await self._race(interleave_families(addrs), port)
+
+
+def _close_connected(task):
+    if task.cancelled() or task.exception():
+        return
+    task.result()[1].close()
+
+
+async def _test_main():
+    import traceback
+
+    lookups = []
+
+    async def lookup(host):
+        lookups.append(host)
+        raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+
+    # a failed lookup is cached, and raised anew each time
+    resolver = Resolver(lookup=lookup)
+    errors = []
+    for _x in range(3):
+        try:
+            await resolver.resolve('nonexistent.example')
+        except socket.gaierror as e:
+            errors.append(e)
+    assert lookups == ['nonexistent.example']
+    assert len({id(e) for e in errors}) == 3 and errors[2].args == errors[0].args
+    assert len(traceback.extract_tb(errors[1].__traceback__)) == len(traceback.extract_tb(errors[2].__traceback__))
+
+    async def lookup_again(host):
+        lookups.append(host)
+        raise socket.gaierror(socket.EAI_AGAIN, 'Temporary failure in name resolution')
+
+    # a temporary failure is looked up again
+    resolver = Resolver(lookup=lookup_again)
+    for _x in range(2):
+        try:
+            await resolver.resolve('example.com')
+            assert False
+        except socket.gaierror as e:
+            assert not is_name_error(e)
+    assert lookups[1:] == ['example.com', 'example.com']
+
+    resolver = Resolver()
+    for _x in range(2):
+        start = time.time()
+        reader, writer = await resolver.open_connection('example.com', 80)
+        print('connected to', writer.get_extra_info('peername'), time.time() - start)
+        writer.close()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(_test_main())
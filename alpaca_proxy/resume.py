@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+# Resume a multiplexing session on a new websocket, without losing the frames sent on the old one.
+
+# Author: twitter.com/alpacatunnel
+
+
+import time
+import asyncio
+import secrets
+from collections import deque
+from aiohttp import WSMsgType
+
+from .log import print_log
+from .ctrl_msg import CtrlMsg
+from .ws_helper import ws_send, encode_ctrl
+
+
+# sent by the client to open or resume a session
+SESSION_HEADER = 'X-Alpaca-Session'
+RECEIVED_HEADER = 'X-Alpaca-Received'
+
+# bytes of unacknowledged frames kept for replay
+REPLAY_SIZE = 4 * 1024 * 1024
+# bytes received before an ack is sent
+ACK_SIZE = 256 * 1024
+# seconds a detached session waits to be resumed
+RESUME_GRACE = 30
+# bytes counted for a control message, about the size of its json
+CTRL_SIZE = 128
+
+
+def new_token():
+    return secrets.token_urlsafe(24)
+
+
+def item_size(item):
+    msg_type, ws_data = item
+    if msg_type == WSMsgType.TEXT:
+        return CTRL_SIZE
+    return len(ws_data[1] or b'')
+
+
+class ReplayBuffer():
+    """
+    No io involved. Every frame of a session is numbered in the order it's sent,
+    TEXT messages and the records of BINARY messages alike, except the resume and
+    ack messages. Each side counts the frames it received, and acks the count every
+    `ack_size` bytes. The frames sent and not acked yet are kept for replay.
+
+    If more than `max_size` bytes are unacked, the oldest frames are dropped, and
+    the session can't be resumed by a peer that missed them.
+    """
+
+    def __init__(self, max_size=REPLAY_SIZE, ack_size=ACK_SIZE):
+        self.max_size = max_size
+        self.ack_size = ack_size
+        self.reset()
+
+    def reset(self):
+        # (item, size) of the frames first_seq, first_seq + 1, ...
+        self._frames = deque()
+        self._size = 0
+        self.first_seq = 0
+        self.sent_count = 0
+
+        self.received_count = 0
+        self._unacked_received = 0
+
+        self.dropped = 0
+        self.replayed = 0
+
+    def sent(self, item):
+        msg_type, ws_data = item
+        if msg_type == WSMsgType.BINARY and isinstance(ws_data[1], memoryview):
+            # a slice of a relay arena would pin the whole arena until acked
+            item = msg_type, (ws_data[0], bytes(ws_data[1]))
+        size = item_size(item)
+        self._frames.append((item, size))
+        self._size += size
+        self.sent_count += 1
+
+        while self._size > self.max_size and self._frames:
+            _item, size = self._frames.popleft()
+            self._size -= size
+            self.first_seq += 1
+            self.dropped += 1
+
+    def ack(self, count):
+        """
+        The peer received the first `count` frames.
+        """
+        while self.first_seq < count and self._frames:
+            _item, size = self._frames.popleft()
+            self._size -= size
+            self.first_seq += 1
+
+    def received(self, size):
+        """
+        Count a frame received, return True if an ack is due.
+        """
+        self.received_count += 1
+        self._unacked_received += size
+        if self._unacked_received >= self.ack_size:
+            self._unacked_received = 0
+            return True
+        return False
+
+    def replay_from(self, count):
+        """
+        Return the frames the peer missed, or None if some of them were dropped.
+        """
+        if count < self.first_seq or count > self.sent_count:
+            return None
+
+        self.ack(count)
+        items = [item for item, _size in self._frames]
+        self.replayed += len(items)
+        return items
+
+    def stats(self):
+        return {
+            'sent': self.sent_count,
+            'received': self.received_count,
+            'unacked': len(self._frames),
+            'unacked_bytes': self._size,
+            'dropped': self.dropped,
+            'replayed': self.replayed,
+        }
+
+
+class SessionTable():
+    """
+    The sessions whose websocket was lost, by token. A session not resumed
+    in `grace` seconds is closed with `close()`.
+    """
+
+    def __init__(self, grace=RESUME_GRACE, replay_size=REPLAY_SIZE):
+        self.grace = grace
+        self.replay_size = replay_size
+        # token: (session, timer)
+        self._sessions = {}
+        # token: ws, of the sessions being served
+        self._live = {}
+
+    def serve(self, token, ws):
+        self._live[token] = ws
+
+    def unserve(self, token, ws):
+        if self._live.get(token) is ws:
+            del self._live[token]
+
+    async def take_over(self, token, timeout=10):
+        """
+        Return the session of the token, or None. If the old ws of the session is
+        still open, e.g. the server didn't notice the client is gone, close it and
+        wait for the session to be detached.
+        """
+        ws = self._live.get(token)
+        if ws is not None:
+            asyncio.ensure_future(ws.close())
+            deadline = time.time() + timeout
+            while token not in self._sessions and time.time() < deadline:
+                await asyncio.sleep(0.1)
+
+        return self.attach(token)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def detach(self, token, session):
+        loop = asyncio.get_event_loop()
+        timer = loop.call_later(self.grace, self._expire, token)
+        self._sessions[token] = (session, timer)
+
+    def attach(self, token):
+        """
+        Return the detached session of the token, or None.
+        """
+        entry = self._sessions.pop(token, None)
+        if entry is None:
+            return None
+
+        session, timer = entry
+        timer.cancel()
+        return session
+
+    def _expire(self, token):
+        session, _timer = self._sessions.pop(token)
+        print_log('session not resumed in {} seconds, closed'.format(self.grace))
+        session.close()
+
+    def close_all(self):
+        for token in list(self._sessions):
+            session, timer = self._sessions.pop(token)
+            timer.cancel()
+            session.close()
+
+
+async def ws_send_ack(ws, mp_session, replay):
+    ctrl = CtrlMsg(
+        msg_type=CtrlMsg.TYPE_ACK,
+        stream_id=mp_session.new_stream(),
+        received=replay.received_count,
+    )
+    ctrl_str = ctrl.to_str()
+    mp_session.del_stream(ctrl.stream_id)
+    await ws_send(ws, ctrl_str, WSMsgType.TEXT)
+
+
+async def ws_send_resume(ws, mp_session, replay, result):
+    ctrl = CtrlMsg(
+        msg_type=CtrlMsg.TYPE_RESUME,
+        stream_id=mp_session.new_stream(),
+        result=result,
+        received=replay.received_count,
+    )
+    ctrl_str = ctrl.to_str()
+    mp_session.del_stream(ctrl.stream_id)
+    print_log(ctrl_str)
+    await ws_send(ws, ctrl_str, WSMsgType.TEXT)
+
+
+async def ws_replay(ws, mp_session, items):
+    """
+    Send the frames the peer missed on the new ws, before anything else.
+    """
+    for msg_type, ws_data in items:
+        if msg_type == WSMsgType.TEXT:
+            ws_data = encode_ctrl(mp_session, ws_data)
+            if isinstance(ws_data, str):
+                await ws_send(ws, ws_data, msg_type)
+                continue
+        for message in mp_session.pack([ws_data]):
+            await ws_send(ws, message, WSMsgType.BINARY)
+
+
+def _test_main():
+    sender, receiver = ReplayBuffer(max_size=100, ack_size=10), ReplayBuffer()
+
+    frames = [(WSMsgType.TEXT, 'request'), (WSMsgType.BINARY, (1, b'a' * 8)), (WSMsgType.BINARY, (1, b''))]
+    for item in frames:
+        sender.sent(item)
+
+    # the peer got the first frame only
+    receiver.received(item_size(frames[0]))
+    assert sender.replay_from(receiver.received_count) == frames[1:]
+
+    sender.ack(3)
+    assert sender.replay_from(3) == []
+
+    arena = memoryview(bytearray(1024))
+    sender.sent((WSMsgType.BINARY, (1, arena[:8])))
+    replayed = sender.replay_from(3)[0][1][1]
+    assert replayed == bytes(8) and not isinstance(replayed, memoryview)
+    sender.ack(4)
+
+    for _x in range(20):
+        sender.sent((WSMsgType.BINARY, (1, b'a' * 8)))
+    assert sender.replay_from(3) is None
+    print(sender.stats())
+
+
+if __name__ == '__main__':
+    _test_main()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+# Route each request of the proxy client directly, through the tunnel, or reject it, by domain and CIDR rules.
+
+# Author: twitter.com/alpacatunnel
+
+
+import bisect
+import socket
+import asyncio
+import ipaddress
+
+from .log import print_log
+
+
+ROUTE_DIRECT = 'direct'
+ROUTE_TUNNEL = 'tunnel'
+ROUTE_REJECT = 'reject'
+ROUTES = (ROUTE_DIRECT, ROUTE_TUNNEL, ROUTE_REJECT)
+
+
+class RouteError(Exception):
+    pass
+
+
+class DomainTrie():
+    """
+    A trie of domain labels, from the TLD down. A rule for example.com matches
+    example.com and all its subdomains, the longest matching rule wins.
+    """
+
+    # the key of the action in a node, no label is empty
+    ACTION = ''
+
+    def __init__(self):
+        self._root = {}
+        self.size = 0
+
+    def add(self, domain, action):
+        node = self._root
+        for label in reversed(domain.lower().strip('.').split('.')):
+            node = node.setdefault(label, {})
+        if self.ACTION not in node:
+            self.size += 1
+        node[self.ACTION] = action
+
+    def lookup(self, domain):
+        """
+        Return the action of the longest rule matching domain, or None.
+        """
+        node = self._root
+        action = None
+        for label in reversed(domain.lower().rstrip('.').split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            action = node.get(self.ACTION, action)
+        return action
+
+
+class CidrTable():
+    """
+    The CIDR rules are compiled into sorted ranges that don't overlap, the
+    longest matching prefix decides the action of each range. A lookup is a
+    binary search, the same result as walking a radix tree, in fewer steps.
+    """
+
+    def __init__(self):
+        # version: [(first, last, action)]
+        self._networks = {4: [], 6: []}
+        # version: (firsts, lasts, actions)
+        self._ranges = {4: ([], [], []), 6: ([], [], [])}
+        self.size = 0
+
+    def add(self, network, action):
+        network = ipaddress.ip_network(network, strict=False)
+        self._networks[network.version].append(
+            (int(network.network_address), int(network.broadcast_address), action))
+        self.size += 1
+
+    def compile(self):
+        for version, networks in self._networks.items():
+            self._ranges[version] = self._flatten(networks)
+        self._networks = {4: [], 6: []}
+
+    @staticmethod
+    def _flatten(networks):
+        """
+        CIDR networks are nested or disjoint. Sorted by first address, larger
+        first, each network splits the one enclosing it, like brackets.
+        Of equal networks, the one added last wins.
+        """
+        firsts, lasts, actions = [], [], []
+
+        def emit(first, last, action):
+            if first > last:
+                return
+            if actions and actions[-1] == action and lasts[-1] + 1 == first:
+                lasts[-1] = last
+                return
+            firsts.append(first)
+            lasts.append(last)
+            actions.append(action)
+
+        # enclosing networks, (last, action)
+        stack = []
+        cursor = 0
+        for first, last, action in sorted(networks, key=lambda n: (n[0], -n[1])):
+            while stack and stack[-1][0] < first:
+                end, end_action = stack.pop()
+                emit(cursor, end, end_action)
+                cursor = end + 1
+            if stack:
+                emit(cursor, first - 1, stack[-1][1])
+            stack.append((last, action))
+            cursor = first
+
+        while stack:
+            end, end_action = stack.pop()
+            emit(cursor, end, end_action)
+            cursor = end + 1
+
+        return firsts, lasts, actions
+
+    def lookup(self, version, value):
+        """
+        Return the action of the longest prefix matching the IP of version and int value, or None.
+        """
+        firsts, lasts, actions = self._ranges[version]
+        index = bisect.bisect_right(firsts, value) - 1
+        if index >= 0 and value <= lasts[index]:
+            return actions[index]
+        return None
+
+
+def parse_ip(host):
+    """
+    Return (version, int value) of an IP literal, or None for a domain.
+    Faster than ipaddress.ip_address(), which raises for every domain.
+    """
+    try:
+        if ':' in host:
+            return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, host), 'big')
+        if host[-1:].isdigit():
+            return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, host), 'big')
+    except OSError:
+        pass
+    return None
+
+
+def parse_rules(lines):
+    """
+    Return a list of (action, pattern). A line is `action pattern`, where the
+    pattern is a domain, an IP or a CIDR network. '#' starts a comment.
+    """
+    rules = []
+    for number, line in enumerate(lines, 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+
+        fields = line.split()
+        if len(fields) != 2 or fields[0] not in ROUTES:
+            raise RouteError('line {}: expected `{} pattern`: {}'.format(number, '|'.join(ROUTES), line))
+        rules.append((fields[0], fields[1]))
+    return rules
+
+
+class RouteTable():
+    """
+    No io involved. Compiled from a list of (action, pattern), read only after that,
+    so a reload builds a new table and swaps it.
+
+    An IP request is routed by the CIDR rules, a domain request by the domain
+    rules, the domain isn't resolved. Requests no rule matches get `default`.
+    """
+
+    def __init__(self, rules=(), default=ROUTE_TUNNEL):
+        if default not in ROUTES:
+            raise RouteError('default route must be one of {}'.format(ROUTES))
+
+        self.default = default
+        self.domains = DomainTrie()
+        self.cidrs = CidrTable()
+
+        for action, pattern in rules:
+            if '/' in pattern or parse_ip(pattern):
+                try:
+                    self.cidrs.add(pattern, action)
+                except ValueError as e:
+                    raise RouteError(str(e))
+            else:
+                self.domains.add(pattern, action)
+        self.cidrs.compile()
+
+    def route(self, host):
+        ip = parse_ip(host)
+        if ip is None:
+            action = self.domains.lookup(host)
+        else:
+            action = self.cidrs.lookup(*ip)
+        return action or self.default
+
+
+class Router():
+    """
+    The rules of the `path` file, after the `local_routes` routed directly.
+    reload() reads the file again, a file that fails to load keeps the old rules.
+    """
+
+    def __init__(self, path=None, local_routes=(), default=ROUTE_TUNNEL):
+        self.path = path
+        self.local_routes = list(local_routes)
+        self.default = default
+        self.table = self._load()
+        self._reloads = 0
+
+    def _load(self):
+        rules = [(ROUTE_DIRECT, network) for network in self.local_routes]
+        if self.path:
+            with open(self.path) as rules_file:
+                rules += parse_rules(rules_file)
+        table = RouteTable(rules, self.default)
+        print_log('route rules loaded, domains: {}, networks: {}'.format(table.domains.size, table.cidrs.size))
+        return table
+
+    async def reload(self):
+        """
+        Build the new table in a thread, the requests are routed by the old one
+        until it's swapped in. Of overlapping reloads, only the last one is kept.
+        """
+        self._reloads += 1
+        reload_id = self._reloads
+        loop = asyncio.get_event_loop()
+        try:
+            table = await loop.run_in_executor(None, self._load)
+        except (OSError, RouteError) as e:
+            print_log('failed to reload route rules, keep the old ones: {}'.format(e))
+            return
+
+        if reload_id == self._reloads:
+            self.table = table
+
+    def route(self, host):
+        return self.table.route(host)
+
+
+def _test_main():
+    import time
+    import random
+
+    table = RouteTable(parse_rules('''
+        direct 10.0.0.0/8
+        tunnel 10.1.0.0/16   # nested in 10/8
+        reject 10.1.2.3
+        direct 2001:db8::/32
+        direct example.com
+        tunnel cdn.example.com
+        reject ads.example.net
+    '''.splitlines()))
+
+    expected = {
+        '10.9.9.9': ROUTE_DIRECT, '10.1.9.9': ROUTE_TUNNEL, '10.1.2.3': ROUTE_REJECT,
+        '10.2.0.0': ROUTE_DIRECT, '11.0.0.0': ROUTE_TUNNEL, '2001:db8::1': ROUTE_DIRECT,
+        'example.com': ROUTE_DIRECT, 'www.example.com': ROUTE_DIRECT, 'cdn.example.com': ROUTE_TUNNEL,
+        'a.cdn.example.com': ROUTE_TUNNEL, 'ads.example.net': ROUTE_REJECT, 'example.net': ROUTE_TUNNEL,
+        'notexample.com': ROUTE_TUNNEL,
+    }
+    for host, action in expected.items():
+        assert table.route(host) == action, (host, table.route(host))
+
+    # tens of thousands of rules, like a country IP list and a domain list
+    random.seed(1)
+    rules = []
+    for _x in range(50000):
+        prefix = random.randint(8, 24)
+        address = ipaddress.ip_address(random.getrandbits(32))
+        rules.append((ROUTE_DIRECT, '{}/{}'.format(address, prefix)))
+    for x in range(50000):
+        rules.append((ROUTE_DIRECT, 'domain{}.example{}.com'.format(x, x % 100)))
+
+    start = time.time()
+    table = RouteTable(rules)
+    compile_time = time.time() - start
+
+    hosts = [str(ipaddress.ip_address(random.getrandbits(32))) for _x in range(50000)]
+    hosts += ['www.domain{}.example{}.com'.format(x, x % 100) for x in range(50000)]
+    start = time.time()
+    for host in hosts:
+        table.route(host)
+    lookup_time = time.time() - start
+    print('compiled 100000 rules in {:.2f} s, {:.2f} us per lookup'.format(compile_time, lookup_time / len(hosts) * 1e6))
+
+    # a reload routes by the old rules until the new ones are built, off the event loop
+    import os
+    import tempfile
+
+    rules_file = tempfile.NamedTemporaryFile('w', suffix='.rules', delete=False)
+    rules_file.write('direct example.com\n')
+    rules_file.close()
+    router = Router(rules_file.name)
+
+    with open(rules_file.name, 'w') as new_rules:
+        new_rules.writelines('{} {}\n'.format(action, network) for action, network in rules)
+        new_rules.write('reject example.com\n')
+
+    async def reload():
+        task = asyncio.ensure_future(router.reload())
+        max_lag = 0
+        while not task.done():
+            assert router.route('example.com') == ROUTE_DIRECT
+            start = time.time()
+            await asyncio.sleep(0.001)
+            max_lag = max(max_lag, time.time() - start)
+        assert router.route('example.com') == ROUTE_REJECT
+
+        with open(rules_file.name, 'w') as bad_rules:
+            bad_rules.write('allow example.com\n')
+        await router.reload()
+        assert router.route('example.com') == ROUTE_REJECT
+        return max_lag
+
+    print('reloaded 100000 rules, max event loop lag {:.1f} ms'.format(asyncio.run(reload()) * 1000))
+    os.remove(rules_file.name)
+
+
+if __name__ == '__main__':
+    _test_main()
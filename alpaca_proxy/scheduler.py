@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+# Schedule the frames to send on a ws session: control frames first, then the streams in deficit round-robin.
+
+# Author: twitter.com/alpacatunnel
+
+
+import asyncio
+from collections import deque
+from aiohttp import WSMsgType
+
+
+# bytes a stream may send in its turn
+QUANTUM = 16 * 1024
+# bytes queued per stream, and per session, before put() waits
+STREAM_BUDGET = 256 * 1024
+TOTAL_BUDGET = 4 * 1024 * 1024
+
+
+class SendScheduler():
+    """
+    A drop-in for the asyncio.Queue of ws_send_frames(), items are (WSMsgType.TEXT, str)
+    or (WSMsgType.BINARY, (stream_id, data)).
+
+    TEXT frames, RST, and FIN of streams with nothing queued go first, in FIFO order.
+    The data of each stream is queued on its own, and the streams take turns to send
+    up to `quantum` bytes, so a bulk upload doesn't delay the other streams.
+
+    put() waits while the stream has `stream_budget` bytes queued, or the session
+    has `total_budget`, which pauses the reading of the socks5 client.
+    put_nowait() never waits, it's for control frames.
+
+    The data of a paused stream stays queued until it's resumed, the server pauses
+    the streams its destinations are slow to take.
+    """
+
+    def __init__(self, quantum=QUANTUM, stream_budget=STREAM_BUDGET, total_budget=TOTAL_BUDGET):
+        self.quantum = quantum
+        self.stream_budget = stream_budget
+        self.total_budget = total_budget
+
+        self._control = deque()
+        # stream_id: deque of items
+        self._queues = {}
+        self._deficits = {}
+        # stream_ids with data queued, the first one has the turn
+        self._active = deque()
+        self._paused = set()
+
+        self._stream_bytes = {}
+        self._bytes = 0
+
+        self._getters = []
+        self._putters = []
+
+    def __len__(self):
+        return len(self._control) + sum(len(q) for q in self._queues.values())
+
+    def empty(self):
+        return not self._control and not self._active
+
+    def qsize(self):
+        return len(self)
+
+    def full(self, stream_id=None):
+        """
+        True if put() would wait, for datagrams that are dropped rather than queued.
+        """
+        if stream_id is None:
+            return self._bytes >= self.total_budget
+        return not self._has_room(stream_id)
+
+    def _wake_up(self, waiters):
+        while waiters:
+            waiter = waiters.pop()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _has_room(self, stream_id):
+        return self._stream_bytes.get(stream_id, 0) < self.stream_budget and self._bytes < self.total_budget
+
+    async def put(self, item):
+        msg_type, ws_data = item
+        while msg_type == WSMsgType.BINARY and not self._has_room(ws_data[0]):
+            putter = asyncio.get_event_loop().create_future()
+            self._putters.append(putter)
+            await putter
+
+        self.put_nowait(item)
+
+    def put_nowait(self, item):
+        msg_type, ws_data = item
+        if msg_type == WSMsgType.TEXT:
+            self._control.append(item)
+
+        else:
+            stream_id, data = ws_data
+            if data is None:
+                # RST, the queued data is dropped
+                self.forget(stream_id)
+                self._control.append(item)
+            elif not data and stream_id not in self._queues:
+                # FIN, nothing to wait for
+                self._control.append(item)
+            else:
+                self._enqueue(stream_id, item, len(data))
+
+        self._wake_up(self._getters)
+
+    def _enqueue(self, stream_id, item, size):
+        queue = self._queues.get(stream_id)
+        if queue is None:
+            queue = self._queues[stream_id] = deque()
+            # the first stream takes its turn right away, the others wait for theirs
+            self._deficits[stream_id] = self.quantum if not self._active else 0
+            if stream_id not in self._paused:
+                self._active.append(stream_id)
+
+        queue.append(item)
+        self._stream_bytes[stream_id] = self._stream_bytes.get(stream_id, 0) + size
+        self._bytes += size
+
+    def _release(self, stream_id, size):
+        self._bytes -= size
+        remain = self._stream_bytes.get(stream_id, 0) - size
+        if remain:
+            self._stream_bytes[stream_id] = remain
+        else:
+            self._stream_bytes.pop(stream_id, None)
+        self._wake_up(self._putters)
+
+    def _remove(self, stream_id):
+        del self._queues[stream_id]
+        del self._deficits[stream_id]
+        if stream_id in self._paused:
+            pass
+        elif self._active[0] == stream_id:
+            self._active.popleft()
+        else:
+            self._active.remove(stream_id)
+
+    def _discard(self, stream_id):
+        queue = self._queues.get(stream_id)
+        if queue is None:
+            return
+
+        self._remove(stream_id)
+        self._release(stream_id, sum(len(ws_data[1]) for _msg_type, ws_data in queue))
+
+    def pause(self, stream_id):
+        """
+        Hold the data of the stream, put() waits once its budget is queued.
+        """
+        if stream_id in self._paused:
+            return
+
+        self._paused.add(stream_id)
+        if stream_id in self._queues:
+            self._active.remove(stream_id)
+
+    def resume(self, stream_id):
+        if stream_id not in self._paused:
+            return
+
+        self._paused.discard(stream_id)
+        if stream_id in self._queues:
+            self._active.append(stream_id)
+            self._wake_up(self._getters)
+
+    def forget(self, stream_id):
+        """
+        Drop the queued data of a reset stream.
+        """
+        self._discard(stream_id)
+        self._paused.discard(stream_id)
+
+    def get_nowait(self):
+        if self._control:
+            return self._control.popleft()
+
+        if not self._active:
+            raise asyncio.QueueEmpty()
+
+        while True:
+            stream_id = self._active[0]
+            queue = self._queues[stream_id]
+            size = len(queue[0][1][1])
+
+            if size <= self._deficits[stream_id]:
+                self._deficits[stream_id] -= size
+                item = queue.popleft()
+                if not queue:
+                    self._remove(stream_id)
+                self._release(stream_id, size)
+                return item
+
+            # the turn is over, the next stream gets its quantum
+            self._active.rotate(-1)
+            self._deficits[self._active[0]] += self.quantum
+
+    async def get(self):
+        while self.empty():
+            getter = asyncio.get_event_loop().create_future()
+            self._getters.append(getter)
+            await getter
+
+        return self.get_nowait()
+
+    def clear(self):
+        """
+        Drop everything queued, when the ws session is lost.
+        """
+        self._control.clear()
+        self._queues.clear()
+        self._deficits.clear()
+        self._active.clear()
+        self._paused.clear()
+        self._stream_bytes.clear()
+        self._bytes = 0
+        self._wake_up(self._putters)
+
+    def stats(self):
+        return {
+            'control': len(self._control),
+            'streams': len(self._queues),
+            'paused': len(self._paused),
+            'bytes': self._bytes,
+        }
+
+
+def _test_main():
+    scheduler = SendScheduler(quantum=8)
+
+    scheduler.put_nowait((WSMsgType.BINARY, (1, b'a' * 8)))
+    scheduler.put_nowait((WSMsgType.BINARY, (1, b'a' * 8)))
+    scheduler.put_nowait((WSMsgType.BINARY, (1, b'')))
+    scheduler.put_nowait((WSMsgType.BINARY, (3, b'b' * 8)))
+    scheduler.put_nowait((WSMsgType.TEXT, 'request'))
+    scheduler.put_nowait((WSMsgType.BINARY, (5, b'')))
+
+    order = []
+    while not scheduler.empty():
+        _msg_type, ws_data = scheduler.get_nowait()
+        order.append(ws_data if isinstance(ws_data, str) else (ws_data[0], len(ws_data[1])))
+
+    # control first, FIN of stream 1 after its data, stream 3 in between
+    assert order == ['request', (5, 0), (1, 8), (3, 8), (1, 8), (1, 0)], order
+    assert scheduler.stats()['bytes'] == 0
+
+    scheduler.put_nowait((WSMsgType.BINARY, (1, b'a' * 8)))
+    scheduler.put_nowait((WSMsgType.BINARY, (1, None)))
+    assert scheduler.get_nowait() == (WSMsgType.BINARY, (1, None))
+    assert scheduler.empty() and scheduler.stats()['bytes'] == 0
+
+    # a paused stream keeps its data, and its FIN after it, the others go on
+    scheduler.pause(1)
+    scheduler.put_nowait((WSMsgType.BINARY, (1, b'a' * 8)))
+    scheduler.put_nowait((WSMsgType.BINARY, (1, b'')))
+    scheduler.put_nowait((WSMsgType.BINARY, (3, b'b' * 8)))
+    assert scheduler.get_nowait() == (WSMsgType.BINARY, (3, b'b' * 8))
+    assert scheduler.empty() and scheduler.full(1) is False and scheduler.stats()['bytes'] == 8
+    scheduler.resume(1)
+    assert scheduler.get_nowait() == (WSMsgType.BINARY, (1, b'a' * 8))
+    assert scheduler.get_nowait() == (WSMsgType.BINARY, (1, b''))
+
+    # a reset drops the data of a paused stream
+    scheduler.pause(3)
+    scheduler.put_nowait((WSMsgType.BINARY, (3, b'b' * 8)))
+    scheduler.put_nowait((WSMsgType.BINARY, (3, None)))
+    assert scheduler.get_nowait() == (WSMsgType.BINARY, (3, None))
+    assert scheduler.empty() and scheduler.stats() == {'control': 0, 'streams': 0, 'paused': 0, 'bytes': 0}
+    print(order)
+
+
+if __name__ == '__main__':
+    _test_main()
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 
-# Parse socks5 protocol, only support NO AUTHENTICATION and CONNECT CMD.
+# Parse socks5 protocol, only support NO AUTHENTICATION, USERNAME/PASSWORD, and CONNECT and UDP ASSOCIATE CMD.
 
 # Author: twitter.com/alpacatunnel
 
 
+import socket
 import struct
 
 
@@ -20,16 +21,36 @@ def socks5_request_decode(data):
     return address_type, dst_port, dst_addr
 
 
+class Socks5Error(Exception):
+    """
+    `reply` is sent to the client before closing, if not empty.
+    """
+
+    def __init__(self, msg, reply=b''):
+        super().__init__(msg)
+        self.reply = reply
+
+
 class Socks5Parser():
     """
     No io involved. Only parse binary data.
+
+    A resumable state machine: feed() it with whatever was read from the client,
+    it parses the complete messages and reports how many bytes it consumed,
+    so partial messages and any data after the request are kept by the caller.
+
+    If username is set, the client must authenticate with it (RFC 1929).
+    Otherwise NO AUTHENTICATION is preferred, but a client only offering
+    USERNAME/PASSWORD is accepted with any credentials.
     """
 
     SOCKS_VERSION = 5
+    AUTH_VERSION = 1
 
     AUTH_METHOD_NO_AUTH = 0
     AUTH_METHOD_GSSAPI = 1
     AUTH_METHOD_USERNAME_PASSWORD = 2
+    AUTH_METHOD_NO_ACCEPTABLE = 0xFF
 
     CMD_CONNECT = 1
     CMD_BIND = 2
@@ -39,94 +60,207 @@ class Socks5Parser():
     ADDRESS_TYPE_IPV6 = 4
     ADDRESS_TYPE_DOMAIN = 3
 
-    IncompleteReadError = 0
-    PARSE_DONE = 1
+    REPLY_NOT_ALLOWED = 2
+    REPLY_COMMAND_NOT_SUPPORTED = 7
+    REPLY_ADDRESS_TYPE_NOT_SUPPORTED = 8
+
+    STATE_GREETING = 0
+    STATE_AUTH = 1
+    STATE_REQUEST = 2
+    STATE_DONE = 3
+
+    def __init__(self, username=None, password=None):
+        self.username = username
+        self.password = password
 
-    def __init__(self):
+        self.state = self.STATE_GREETING
         self.auth_methods = None
+        self.auth_username = None
+        self.cmd = None
         self.address_type = None
         self.dst_addr = None
         self.dst_port = None
 
+    def feed(self, data):
+        """
+        Return (consumed, reply): the number of bytes parsed in data,
+        and the bytes to send to the client.
+        Raise Socks5Error if the client can't be served.
+        """
+        consumed = 0
+        reply = b''
+
+        while self.state != self.STATE_DONE:
+            if self.state == self.STATE_GREETING:
+                length, step_reply = self.receive_greeting(data[consumed:])
+            elif self.state == self.STATE_AUTH:
+                length, step_reply = self.receive_auth(data[consumed:])
+            else:
+                length, step_reply = self.receive_request(data[consumed:])
+
+            if not length:
+                break
+
+            consumed += length
+            reply += step_reply
+
+        return consumed, reply
+
     def receive_greeting(self, data):
         if len(data) < 2:
-            return self.IncompleteReadError
+            return 0, b''
 
         version, nmethods = data[0], data[1]
+        if version != self.SOCKS_VERSION or nmethods == 0:
+            raise Socks5Error('wrong socks5 greeting message')
+
+        if len(data) < 2 + nmethods:
+            return 0, b''
+
+        self.auth_methods = list(data[2:2+nmethods])
+
+        if self.username is None and self.AUTH_METHOD_NO_AUTH in self.auth_methods:
+            method = self.AUTH_METHOD_NO_AUTH
+            self.state = self.STATE_REQUEST
+        elif self.AUTH_METHOD_USERNAME_PASSWORD in self.auth_methods:
+            method = self.AUTH_METHOD_USERNAME_PASSWORD
+            self.state = self.STATE_AUTH
+        else:
+            raise Socks5Error('auth methods not supported: {}'.format(self.auth_methods),
+                struct.pack("!BB", self.SOCKS_VERSION, self.AUTH_METHOD_NO_ACCEPTABLE))
 
-        assert version == self.SOCKS_VERSION
-        assert nmethods > 0
+        return 2 + nmethods, struct.pack("!BB", self.SOCKS_VERSION, method)
 
-        if nmethods + 2 != len(data):
-            return self.IncompleteReadError
+    def receive_auth(self, data):
+        if len(data) < 2:
+            return 0, b''
+
+        version, username_length = data[0], data[1]
+        if version != self.AUTH_VERSION:
+            raise Socks5Error('wrong socks5 auth version: {}'.format(version))
 
-        auth_methods = []
-        for i in range(nmethods):
-            auth_methods.append(data[2+i])
+        if len(data) < 2 + username_length + 1:
+            return 0, b''
 
-        self.auth_methods = auth_methods
+        password_length = data[2+username_length]
+        length = 2 + username_length + 1 + password_length
+        if len(data) < length:
+            return 0, b''
 
-        if (self.AUTH_METHOD_NO_AUTH not in auth_methods and
-            self.AUTH_METHOD_USERNAME_PASSWORD not in auth_methods):
-            raise Exception('auth methods not supported')
+        username = bytes(data[2:2+username_length]).decode(errors='replace')
+        password = bytes(data[3+username_length:length]).decode(errors='replace')
 
-        return self.PARSE_DONE
+        if self.username is not None and (username, password) != (self.username, self.password):
+            raise Socks5Error('socks5 auth failed for user: {}'.format(username),
+                struct.pack("!BB", self.AUTH_VERSION, 1))
 
-    def send_greeting(self):
-        return struct.pack("!BB", self.SOCKS_VERSION, self.AUTH_METHOD_NO_AUTH)
+        self.auth_username = username
+        self.state = self.STATE_REQUEST
+        return length, struct.pack("!BB", self.AUTH_VERSION, 0)
 
     def receive_request(self, data):
         if len(data) < 4:
-            return self.IncompleteReadError
+            return 0, b''
 
         version, cmd, _reserved, address_type = struct.unpack("!BBBB", data[0:4])
-        assert version == self.SOCKS_VERSION
-        assert cmd == self.CMD_CONNECT
+        if version != self.SOCKS_VERSION:
+            raise Socks5Error('wrong socks5 request message')
+
+        if cmd not in (self.CMD_CONNECT, self.CMD_UDP_ASSOCIATE):
+            raise Socks5Error('cmd not supported: {}'.format(cmd),
+                self.send_failed_response(self.REPLY_COMMAND_NOT_SUPPORTED))
 
         if address_type == self.ADDRESS_TYPE_IPV4:
-            if len(data) < 4+4+2:
-                return self.IncompleteReadError
+            length = 4+4+2
+            if len(data) < length:
+                return 0, b''
 
             dst_addr = data[4:8]
             dst_port = data[8:10]
 
         elif address_type == self.ADDRESS_TYPE_IPV6:
-            if len(data) < 4+16+2:
-                return self.IncompleteReadError
+            length = 4+16+2
+            if len(data) < length:
+                return 0, b''
 
             dst_addr = data[4:20]
             dst_port = data[20:22]
 
         elif address_type == self.ADDRESS_TYPE_DOMAIN:
             if len(data) < 4+1:
-                return self.IncompleteReadError
+                return 0, b''
 
             domain_length = data[4]
-            if len(data) < 4+1+domain_length+2:
-                return self.IncompleteReadError
+            length = 4+1+domain_length+2
+            if len(data) < length:
+                return 0, b''
 
             dst_addr = data[4+1:4+1+domain_length]
             dst_port = data[4+1+domain_length:4+1+domain_length+2]
 
         else:
-            raise Exception('address_type not supported')
+            raise Socks5Error('address_type not supported: {}'.format(address_type),
+                self.send_failed_response(self.REPLY_ADDRESS_TYPE_NOT_SUPPORTED))
 
-        # print(address_type, dst_addr, dst_port)
+        self.cmd = cmd
         self.address_type = struct.pack("!B", address_type)
-        self.dst_addr = dst_addr
-        self.dst_port = dst_port
-
-        return self.PARSE_DONE
-
-    def send_success_response(self):
-        return struct.pack("!BBBBIH", self.SOCKS_VERSION, 0, 0, self.ADDRESS_TYPE_IPV4, 0, 0)
+        self.dst_addr = bytes(dst_addr)
+        self.dst_port = bytes(dst_port)
+        self.state = self.STATE_DONE
+
+        # the reply is sent after the tunnel connected
+        return length, b''
+
+    def send_success_response(self, bind=None):
+        """
+        `bind` is the (ip, port) of the UDP relay for a UDP ASSOCIATE.
+        """
+        if bind is None:
+            return struct.pack("!BBBBIH", self.SOCKS_VERSION, 0, 0, self.ADDRESS_TYPE_IPV4, 0, 0)
+
+        ip, port = bind
+        if ':' in ip:
+            address_type, family = self.ADDRESS_TYPE_IPV6, socket.AF_INET6
+        else:
+            address_type, family = self.ADDRESS_TYPE_IPV4, socket.AF_INET
+        return struct.pack("!BBBB", self.SOCKS_VERSION, 0, 0, address_type) + socket.inet_pton(family, ip) + struct.pack("!H", port)
 
     def send_failed_response(self, error_number=9):
         return struct.pack("!BBBBIH", self.SOCKS_VERSION, error_number, 0, self.ADDRESS_TYPE_IPV4, 0, 0)
 
 
 def _test_main():
-    pass
+    import time
+
+    greeting = b'\x05\x01\x00'
+    request = b'\x05\x01\x00\x03\x0bexample.com\x01\xbb'
+    data = greeting + request + b'GET / HTTP/1.1\r\n'
+
+    # fed byte by byte, or all at once
+    s5_conn = Socks5Parser()
+    buffer = b''
+    for i in range(len(data)):
+        buffer += data[i:i+1]
+        consumed, _reply = s5_conn.feed(buffer)
+        buffer = buffer[consumed:]
+    assert s5_conn.state == Socks5Parser.STATE_DONE and buffer == b'GET / HTTP/1.1\r\n'
+
+    s5_conn = Socks5Parser(username='user', password='pass')
+    auth = b'\x05\x01\x02' + b'\x01\x04user\x04pass' + request
+    consumed, reply = s5_conn.feed(auth)
+    assert consumed == len(auth) and reply == b'\x05\x02\x01\x00'
+    assert s5_conn.dst_addr == b'example.com'
+
+    s5_conn = Socks5Parser()
+    s5_conn.feed(greeting + b'\x05\x03\x00\x01\x00\x00\x00\x00\x00\x00')
+    assert s5_conn.cmd == Socks5Parser.CMD_UDP_ASSOCIATE
+    assert s5_conn.send_success_response(('127.0.0.1', 1080)) == b'\x05\x00\x00\x01\x7f\x00\x00\x01\x04\x38'
+
+    count = 100000
+    start = time.time()
+    for _x in range(count):
+        Socks5Parser().feed(data)
+    print('{} handshakes per second'.format(int(count / (time.time() - start))))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+
+# Own the state of the streams in a multiplexing session, and reclaim it on close.
+
+# Author: twitter.com/alpacatunnel
+
+
+import asyncio
+
+from .log import print_log
+
+
+# max live streams per session
+MAX_STREAMS = 1024
+
+# The bytes a session may buffer for its destinations above their high-water marks,
+# the frames still in flight after their streams were paused, and the seconds a
+# destination may take no data, before its stream is reset.
+WRITE_BUFFER = 16 * 1024 * 1024
+WRITE_TIMEOUT = 30
+
+# bytes a stream may send before its destination is connected
+PENDING_BUFFER = 1024 * 1024
+
+# sent by the clients that pause and resume their streams on the flow messages
+FLOW_HEADER = 'X-Alpaca-Flow'
+
+
+def _current_task():
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        # not called from a coroutine
+        return None
+
+
+class Stream():
+    """
+    `value` is what the session looks up for incoming frames, e.g. a queue or a writer.
+    `writer` and `tasks` are closed and cancelled when the stream is closed.
+    """
+
+    def __init__(self, stream_id, value=None, writer=None):
+        self.stream_id = stream_id
+        self.value = value
+        self.writer = writer
+        self.tasks = set()
+
+        # FIN of each direction
+        self.eof_sent = False
+        self.eof_received = False
+
+
+class PendingStream():
+    """
+    Data frames received while the destination is still connecting,
+    written to the destination in order after the connect.
+    With optimistic open, the client sends them right after the request.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.chunks = []
+        self.size = 0
+        self.overflow = False
+
+    def append(self, data):
+        """
+        Return False if the frames go over max_size. They are all dropped then,
+        and the stream must be reset.
+        """
+        if self.overflow or self.size + len(data) > self.max_size:
+            self.overflow = True
+            self.chunks = []
+            self.size = 0
+            return False
+
+        self.chunks.append(data)
+        self.size += len(data)
+        return True
+
+
+class WriteBudget():
+    """
+    The writers of a session above the high-water mark of their sockets, the bytes
+    they buffer are limited to max_size for the whole session.
+    """
+
+    def __init__(self, max_size=WRITE_BUFFER, timeout=WRITE_TIMEOUT):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.writers = set()
+
+    def exceeded(self):
+        return sum(writer.size for writer in self.writers) > self.max_size
+
+
+class StreamWriter():
+    """
+    Writes the frames of a stream to its destination without waiting, the buffer of
+    the socket is the queue of the stream. A task of the stream waits in run() for
+    the destination to take them, so a slow destination doesn't stop the frames of
+    the other streams.
+
+    Above the high-water mark of the socket, the session calls pause(), which calls
+    flow(True) to have the peer pause the stream, and run() calls flow(False) when
+    the buffer drained to the low-water mark. Without flow, the peer can't pause its
+    streams, the data is buffered until the budget of the session is exceeded.
+    """
+
+    def __init__(self, writer, budget=None, flow=None):
+        self.writer = writer
+        self.budget = budget or WriteBudget()
+        self.flow = flow
+        self.eof = False
+        self.paused = False
+
+        self._written = asyncio.Event()
+        # the flow messages are sent in the order of the changes
+        self._flow_lock = asyncio.Lock()
+
+    @property
+    def size(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    @property
+    def high_water(self):
+        return self.writer.transport.get_write_buffer_limits()[1]
+
+    def write(self, data):
+        """
+        b'' is FIN, which shuts down the writing side of the destination, it may
+        still send its response. Return False if the buffer is over the high-water mark.
+        """
+        if data:
+            self.writer.write(data)
+        else:
+            self.eof = True
+            if self.writer.can_write_eof():
+                self.writer.write_eof()
+
+        self._written.set()
+        if self.size > self.high_water:
+            self.budget.writers.add(self)
+            return False
+        return True
+
+    async def _set_paused(self, paused):
+        async with self._flow_lock:
+            if self.paused == paused:
+                return
+            self.paused = paused
+            await self.flow(paused)
+
+    async def pause(self):
+        if self.flow:
+            await self._set_paused(True)
+
+    async def _drain(self):
+        """
+        Raise asyncio.TimeoutError if the destination took no data in budget.timeout seconds.
+        """
+        while True:
+            size = self.size
+            try:
+                return await asyncio.wait_for(self.writer.drain(), self.budget.timeout)
+            except asyncio.TimeoutError:
+                if self.size >= size:
+                    raise
+
+    async def run(self):
+        """
+        Return when the destination took the FIN. Raise the error of the socket, or
+        asyncio.TimeoutError if the destination stalled.
+        """
+        try:
+            while True:
+                await self._written.wait()
+                self._written.clear()
+                await self._drain()
+                self.budget.writers.discard(self)
+                if self.flow:
+                    await self._set_paused(False)
+
+                if self.eof:
+                    return
+        finally:
+            self.budget.writers.discard(self)
+
+
+class StreamRegistry():
+    """
+    Every exit path of a stream must call close(stream_id), which closes the writer,
+    cancels the tasks and gives the stream ID back to mp_session.
+
+    Streams initiated by this side get their IDs from mp_session.new_stream(),
+    streams initiated by the peer are added with the peer's IDs.
+    """
+
+    def __init__(self, mp_session, max_streams=MAX_STREAMS):
+        self.mp_session = mp_session
+        self.max_streams = max_streams
+
+        self._streams = {}
+        self.opened = 0
+        self.closed = 0
+        self.rejected = 0
+
+    def __contains__(self, stream_id):
+        return stream_id in self._streams
+
+    def __len__(self):
+        return len(self._streams)
+
+    def _full(self):
+        if len(self._streams) >= self.max_streams:
+            self.rejected += 1
+            print_log('too many streams: {}'.format(len(self._streams)))
+            return True
+        return False
+
+    def new_stream(self, value=None, writer=None):
+        """
+        Return the new stream ID, or None if there are too many streams.
+        """
+        if self._full():
+            return None
+
+        stream_id = self.mp_session.new_stream()
+        self._streams[stream_id] = Stream(stream_id, value, writer)
+        self.opened += 1
+        return stream_id
+
+    def add(self, stream_id, value=None, writer=None):
+        """
+        Add a stream initiated by the peer. Return False if the ID is in use,
+        or there are too many streams.
+        """
+        if stream_id in self._streams:
+            print_log('conflict stream_id: {}'.format(stream_id))
+            return False
+
+        if self._full():
+            return False
+
+        self._streams[stream_id] = Stream(stream_id, value, writer)
+        self.opened += 1
+        return True
+
+    def get(self, stream_id):
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            return None
+        return stream.value
+
+    def set(self, stream_id, value, writer=None):
+        stream = self._streams[stream_id]
+        stream.value = value
+        if writer is not None:
+            stream.writer = writer
+
+    def add_task(self, stream_id, task):
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            # closed before the task started
+            task.cancel()
+            return
+
+        stream.tasks.add(task)
+        task.add_done_callback(stream.tasks.discard)
+
+    def shutdown(self, stream_id, sent=False, received=False):
+        """
+        Record a FIN sent to or received from the peer, the stream is closed
+        after both. Return True if the stream is closed.
+        """
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            return True
+
+        stream.eof_sent = stream.eof_sent or sent
+        stream.eof_received = stream.eof_received or received
+        if stream.eof_sent and stream.eof_received:
+            self.close(stream_id)
+            return True
+
+        return False
+
+    def close(self, stream_id, abort=False):
+        """
+        With abort, the socket is reset and its buffered data is dropped.
+        """
+        stream = self._streams.pop(stream_id, None)
+        if stream is None:
+            return
+
+        self.closed += 1
+        self.mp_session.del_stream(stream_id)
+
+        if stream.writer:
+            try:
+                if abort:
+                    stream.writer.transport.abort()
+                else:
+                    stream.writer.close()
+            except Exception as _e:
+                pass
+
+        current_task = _current_task()
+        for task in list(stream.tasks):
+            if task is not current_task:
+                task.cancel()
+
+    def close_all(self, abort=False):
+        for stream_id in list(self._streams):
+            self.close(stream_id, abort)
+
+    def stats(self):
+        return {
+            'live': len(self._streams),
+            'opened': self.opened,
+            'closed': self.closed,
+            'rejected': self.rejected,
+            'tasks': sum(len(stream.tasks) for stream in self._streams.values()),
+        }
+
+
+def _test_main():
+    pending = PendingStream(max_size=1000)
+    assert pending.append(b'x' * 600)
+    assert pending.append(b'')
+    assert not pending.append(b'x' * 600)
+
+    # after the overflow nothing is kept
+    for _ in range(1000):
+        assert not pending.append(b'x' * 100)
+    assert pending.overflow and pending.chunks == [] and pending.size == 0
+
+    class SlowTransport():
+        def __init__(self):
+            self.buffered = 0
+
+        def get_write_buffer_size(self):
+            return self.buffered
+
+        def get_write_buffer_limits(self):
+            return 100, 1000
+
+    class SlowWriter():
+        """
+        Takes `rate` bytes per drain() step, down to the low-water mark.
+        """
+
+        def __init__(self, rate=100):
+            self.transport = SlowTransport()
+            self.rate = rate
+            self.eof = False
+
+        def write(self, data):
+            self.transport.buffered += len(data)
+
+        def can_write_eof(self):
+            return True
+
+        def write_eof(self):
+            self.eof = True
+
+        async def drain(self):
+            if self.transport.buffered <= 1000:
+                return
+            while self.transport.buffered > 100:
+                await asyncio.sleep(0.01)
+                self.transport.buffered = max(self.transport.buffered - self.rate, 0)
+
+    async def slow_destination():
+        flows = []
+
+        async def flow(paused):
+            flows.append(paused)
+
+        budget = WriteBudget(max_size=2000, timeout=1)
+        writer = SlowWriter()
+        stream_writer = StreamWriter(writer, budget, flow)
+        task = asyncio.ensure_future(stream_writer.run())
+        assert stream_writer.write(b'x' * 600)
+        assert not stream_writer.write(b'x' * 600)
+        assert not budget.exceeded()
+        await stream_writer.pause()
+        await stream_writer.pause()
+
+        # frames in flight before the peer paused the stream
+        assert not stream_writer.write(b'x' * 1000)
+        assert budget.exceeded()
+        stream_writer.write(b'')
+        await task
+        assert writer.eof and stream_writer.size <= 100 and not budget.writers
+        assert flows == [True, False], flows
+
+        # a destination taking less than `timeout` to drain goes on
+        stream_writer = StreamWriter(SlowWriter(rate=20), WriteBudget(timeout=0.05))
+        task = asyncio.ensure_future(stream_writer.run())
+        assert not stream_writer.write(b'x' * 1100)
+        stream_writer.write(b'')
+        await task
+
+        # a destination that takes nothing
+        stream_writer = StreamWriter(SlowWriter(rate=0), WriteBudget(timeout=0.05))
+        task = asyncio.ensure_future(stream_writer.run())
+        assert not stream_writer.write(b'x' * 1100)
+        await stream_writer.pause()
+        try:
+            await task
+            assert False
+        except asyncio.TimeoutError:
+            pass
+
+    asyncio.run(slow_destination())
+
+
+if __name__ == '__main__':
+    _test_main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+# Relay socks5 UDP ASSOCIATE datagrams over the multiplexing session.
+
+# Author: twitter.com/alpacatunnel
+
+
+import time
+import socket
+import struct
+import asyncio
+import ipaddress
+from aiohttp import WSMsgType
+
+from .log import print_log
+from .multiplexing import Datagram
+from .resolver import getaddrinfo_lookup
+from .socks5 import Socks5Parser
+
+
+# seconds a NAT socket of an association is kept without traffic
+UDP_TIMEOUT = 60
+# datagrams from the client waiting to be sent by the server
+UDP_QUEUE_SIZE = 256
+
+# RSV and FRAG of the socks5 UDP request header
+SOCKS5_UDP_HEADER = b'\x00\x00\x00'
+
+
+def encode_address(host, port):
+    """
+    Return ATYP + DST.ADDR + DST.PORT, as in a socks5 request.
+    """
+    try:
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        domain = host.encode()
+        return struct.pack('!BB', Socks5Parser.ADDRESS_TYPE_DOMAIN, len(domain)) + domain + struct.pack('!H', port)
+
+    address_type = Socks5Parser.ADDRESS_TYPE_IPV4 if ip.version == 4 else Socks5Parser.ADDRESS_TYPE_IPV6
+    return struct.pack('!B', address_type) + ip.packed + struct.pack('!H', port)
+
+
+def decode_address(data):
+    """
+    Return (host, port, length) of the ATYP + DST.ADDR + DST.PORT at the start of data.
+    """
+    if len(data) < 1:
+        raise ValueError('empty datagram')
+
+    address_type = data[0]
+    if address_type == Socks5Parser.ADDRESS_TYPE_IPV4:
+        length = 1 + 4 + 2
+        host = socket.inet_ntop(socket.AF_INET, bytes(data[1:5])) if len(data) >= length else None
+    elif address_type == Socks5Parser.ADDRESS_TYPE_IPV6:
+        length = 1 + 16 + 2
+        host = socket.inet_ntop(socket.AF_INET6, bytes(data[1:17])) if len(data) >= length else None
+    elif address_type == Socks5Parser.ADDRESS_TYPE_DOMAIN:
+        length = 1 + 1 + (data[1] if len(data) > 1 else 0) + 2
+        host = bytes(data[2:length-2]).decode(errors='replace') if len(data) >= length else None
+    else:
+        raise ValueError('address_type not supported: {}'.format(address_type))
+
+    if host is None:
+        raise ValueError('truncated datagram address')
+
+    port = struct.unpack('!H', data[length-2:length])[0]
+    return host, port, length
+
+
+class UdpEndpoint(asyncio.DatagramProtocol):
+    """
+    Call on_datagram(data, addr) for each datagram received.
+    """
+
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.on_datagram(data, addr)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable, the datagram is lost as it would be anyway
+        pass
+
+
+class UdpAssociation():
+    """
+    Server side, the NAT of an association. The datagrams of the client go out of
+    one UDP socket per address family, and the datagrams received on these
+    sockets go back to the client with their source address. A socket without
+    traffic for `timeout` seconds is closed, a later datagram opens a new one.
+
+    Datagrams are dropped when the send_q or the queue to the destinations is full,
+    and `charge(size)` returning a negative balance drops the replies.
+    """
+
+    def __init__(self, stream_id, send_q, resolver=None, timeout=UDP_TIMEOUT, charge=None):
+        self.stream_id = stream_id
+        self.send_q = send_q
+        self.resolver = resolver
+        self.timeout = timeout
+        self.charge = charge
+
+        # family: transport
+        self._endpoints = {}
+        self._last_active = {}
+        self._queue = asyncio.Queue(maxsize=UDP_QUEUE_SIZE)
+        self._timer = None
+
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    def send(self, data):
+        """
+        Queue a datagram of the client, ATYP + DST.ADDR + DST.PORT + DATA.
+        """
+        if self._queue.full():
+            self.dropped += 1
+            return
+        self._queue.put_nowait(data)
+
+    async def run(self):
+        """
+        Send the queued datagrams until cancelled, the sockets are closed on exit.
+        """
+        try:
+            while True:
+                await self._sendto(await self._queue.get())
+        finally:
+            self.close()
+
+    async def _sendto(self, data):
+        try:
+            host, port, length = decode_address(data)
+            addrs = await (self.resolver.resolve(host) if self.resolver else getaddrinfo_lookup(host))
+        except (OSError, UnicodeError, ValueError) as e:
+            print_log('stream_id: {}, datagram dropped: {}'.format(self.stream_id, e))
+            self.dropped += 1
+            return
+
+        family, ip = addrs[0]
+        transport = self._endpoints.get(family)
+        if transport is None:
+            loop = asyncio.get_event_loop()
+            try:
+                transport, _protocol = await loop.create_datagram_endpoint(
+                    lambda: UdpEndpoint(self._received), family=family)
+            except OSError as e:
+                print_log('stream_id: {}, datagram dropped: {}'.format(self.stream_id, e))
+                self.dropped += 1
+                return
+            self._endpoints[family] = transport
+            if self._timer is None:
+                self._timer = loop.call_later(self.timeout, self._expire)
+
+        transport.sendto(data[length:], (ip, port))
+        self._last_active[family] = time.time()
+        self.sent += 1
+
+    def _received(self, data, addr):
+        if self.charge and self.charge(len(data)) < 0:
+            self.dropped += 1
+            return
+        if self.send_q.full():
+            self.dropped += 1
+            return
+
+        datagram = Datagram(encode_address(addr[0], addr[1]) + data)
+        self.send_q.put_nowait((WSMsgType.BINARY, (self.stream_id, datagram)))
+        self.received += 1
+
+    def _expire(self):
+        self._timer = None
+        deadline = time.time() - self.timeout
+        for family, last_active in list(self._last_active.items()):
+            if last_active < deadline:
+                self._endpoints.pop(family).close()
+                del self._last_active[family]
+
+        if self._endpoints:
+            self._timer = asyncio.get_event_loop().call_later(self.timeout, self._expire)
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        for transport in self._endpoints.values():
+            transport.close()
+        self._endpoints = {}
+        self._last_active = {}
+
+    def stats(self):
+        return {'sent': self.sent, 'received': self.received, 'dropped': self.dropped}
+
+
+class ClientUdpRelay(asyncio.DatagramProtocol):
+    """
+    Client side, the UDP relay address replied to a UDP ASSOCIATE. Datagrams from
+    the host of the socks5 connection are sent on the stream, the replies go back
+    to the address of the last one. Fragments are not supported and dropped.
+    """
+
+    def __init__(self, stream_id, send_q, client_host):
+        self.stream_id = stream_id
+        self.send_q = send_q
+        self.client_host = client_host
+        self.client_addr = None
+        self.transport = None
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if addr[0] != self.client_host or len(data) < 4 or data[:3] != SOCKS5_UDP_HEADER:
+            self.dropped += 1
+            return
+
+        self.client_addr = addr
+        if self.send_q.full(self.stream_id):
+            self.dropped += 1
+            return
+        self.send_q.put_nowait((WSMsgType.BINARY, (self.stream_id, Datagram(memoryview(data)[3:]))))
+
+    def error_received(self, exc):
+        pass
+
+    def reply(self, datagram):
+        if self.client_addr and not self.transport.is_closing():
+            self.transport.sendto(SOCKS5_UDP_HEADER + datagram.data, self.client_addr)
+
+
+def _test_main():
+    for host, port in (('1.2.3.4', 53), ('::1', 443), ('example.com', 80)):
+        data = encode_address(host, port) + b'payload'
+        assert decode_address(data) == (host, port, len(data) - len(b'payload'))
+
+    try:
+        decode_address(b'\x01\x7f\x00')
+        assert False
+    except ValueError:
+        pass
+
+    async def echo():
+        loop = asyncio.get_event_loop()
+        server, _protocol = await loop.create_datagram_endpoint(
+            lambda: UdpEndpoint(lambda data, addr: server.sendto(data, addr)), local_addr=('127.0.0.1', 0))
+        port = server.get_extra_info('sockname')[1]
+
+        send_q = asyncio.Queue()
+        association = UdpAssociation(1, send_q, timeout=0.2)
+        task = asyncio.ensure_future(association.run())
+        association.send(encode_address('127.0.0.1', port) + b'ping')
+
+        _msg_type, (stream_id, datagram) = await asyncio.wait_for(send_q.get(), 1)
+        assert stream_id == 1 and datagram == Datagram(encode_address('127.0.0.1', port) + b'ping')
+
+        # the idle socket is closed, and reopened by the next datagram
+        await asyncio.sleep(0.5)
+        assert not association._endpoints
+        association.send(encode_address('127.0.0.1', port) + b'again')
+        await asyncio.wait_for(send_q.get(), 1)
+
+        task.cancel()
+        server.close()
+        print(association.stats())
+
+    asyncio.get_event_loop().run_until_complete(echo())
+
+
+if __name__ == '__main__':
+    _test_main()
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+
+# Fork worker processes which share the listen socket,
+# and aggregate their bills in the master process.
+
+# Author: twitter.com/alpacatunnel
+
+
+import os
+import json
+import time
+import signal
+import socket
+import asyncio
+import collections
+
+from .log import print_log
+
+
+# how often a worker sends its charges to the master and gets the bills back
+WORKER_SYNC_INTERVAL = 1
+
+
+def _new_bill():
+    return {
+        'total_pay': 0,
+        'total_spend': 0,
+        'balance': 0,
+        'total_bytes': 0,
+        'total_requests': 0,
+    }
+
+
+async def _send_json(writer, msg_dict):
+    writer.write(json.dumps(msg_dict).encode() + b'\n')
+    await writer.drain()
+
+
+async def _recv_json(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+class RemoteLedger():
+    """
+    The Ledger of a worker process. Same interface as Ledger, but the bills
+    are owned by the master process, so only one process writes the database.
+
+    Charges are applied to a local copy of the bills, and the deltas are sent
+    to the master every WORKER_SYNC_INTERVAL seconds. The master replies with
+    the merged bills, which include the charges of other workers and new pays.
+
+    Each batch of deltas has a sequence number, and is kept in the local bills
+    until a reply says the master has applied it.
+    """
+
+    def __init__(self, ipc_sock, on_prices=None, flush_bytes=1024*1024):
+        self.ipc_sock = ipc_sock
+        self.on_prices = on_prices
+        self.flush_bytes = flush_bytes
+
+        self._bills = {}
+        self._deltas = {}
+        self._in_flight = collections.OrderedDict()
+        self._seq = 0
+        self._pending_bytes = 0
+        self._waiters = {}
+        self._reader = None
+        self._writer = None
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(sock=self.ipc_sock)
+        asyncio.ensure_future(self._recv_bills())
+        asyncio.ensure_future(self._sync_periodically())
+
+    def get_bill(self, account):
+        bill = self._bills.get(account)
+        if bill is None:
+            bill = self._bills[account] = _new_bill()
+        return bill
+
+    def get_balance(self, account):
+        return self.get_bill(account)['balance']
+
+    def charge(self, account, spend, size=0, requests=0):
+        """
+        Return the balance before this charge.
+        """
+        bill = self.get_bill(account)
+        balance = bill['balance']
+
+        bill['total_spend'] += spend
+        bill['total_bytes'] += size
+        bill['total_requests'] += requests
+        bill['balance'] = balance - spend
+
+        delta = self._deltas.setdefault(account, [0, 0, 0])
+        delta[0] += spend
+        delta[1] += size
+        delta[2] += requests
+
+        self._pending_bytes += size
+        if self._pending_bytes >= self.flush_bytes:
+            self.flush()
+
+        return balance
+
+    def flush(self):
+        self._pending_bytes = 0
+        if not self._deltas or not self._writer:
+            return
+
+        self._seq += 1
+        msg_dict = {'op': 'charge', 'seq': self._seq, 'deltas': self._deltas}
+        self._writer.write(json.dumps(msg_dict).encode() + b'\n')
+        self._in_flight[self._seq] = self._deltas
+        self._deltas = {}
+
+    async def close(self):
+        """
+        Send the charges not synced yet before the worker exits.
+        """
+        self.flush()
+        if self._writer:
+            await self._writer.drain()
+
+    async def register_client(self, account):
+        """
+        Ask the master to add the client to the database and compute its pay.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.setdefault(account, []).append(future)
+        await _send_json(self._writer, {'op': 'register', 'account': account})
+        await future
+
+    async def _recv_bills(self):
+        while True:
+            msg_dict = await _recv_json(self._reader)
+            if msg_dict is None:
+                print_log('lost connection to the master process, exit.')
+                os._exit(1)
+
+            if self.on_prices and msg_dict.get('prices'):
+                self.on_prices(msg_dict['prices'])
+
+            # the master handles the messages in order, so the batches up to
+            # the last applied one are in its bills now
+            applied = msg_dict.get('applied', 0)
+            while self._in_flight and next(iter(self._in_flight)) <= applied:
+                self._in_flight.popitem(last=False)
+
+            for account, bill in msg_dict.get('bills', {}).items():
+                # charges not applied by the master yet are kept on top of its bill
+                for deltas in list(self._in_flight.values()) + [self._deltas]:
+                    spend, size, requests = deltas.get(account, [0, 0, 0])
+                    bill['total_spend'] += spend
+                    bill['total_bytes'] += size
+                    bill['total_requests'] += requests
+                    bill['balance'] -= spend
+                self._bills[account] = bill
+
+                for future in self._waiters.pop(account, []):
+                    if not future.done():
+                        future.set_result(None)
+
+    async def _sync_periodically(self):
+        while True:
+            await asyncio.sleep(WORKER_SYNC_INTERVAL)
+            self.flush()
+
+
+class Aggregator():
+    """
+    Runs in the master process, applies the charges from all workers to the
+    only Ledger, which is the only writer of the database.
+    """
+
+    def __init__(self, ledger, register_client, get_prices):
+        self.ledger = ledger
+        self.register_client = register_client
+        self.get_prices = get_prices
+
+    def _bills_of(self, accounts):
+        bills = {}
+        for account in accounts:
+            bills[account] = dict(self.ledger.get_bill(account))
+        return bills
+
+    async def serve(self, ipc_sock):
+        reader, writer = await asyncio.open_connection(sock=ipc_sock)
+        # the seq of the last charges applied, so the worker can drop them
+        applied = 0
+
+        while True:
+            try:
+                msg_dict = await _recv_json(reader)
+            except ConnectionError:
+                # the worker exited before the reply to its last charges
+                msg_dict = None
+            if msg_dict is None:
+                break
+
+            try:
+                if msg_dict['op'] == 'charge':
+                    await self.ledger.load_bills(msg_dict['deltas'])
+                    for account, (spend, size, requests) in msg_dict['deltas'].items():
+                        self.ledger.charge(account, spend, size=size, requests=requests)
+                    accounts = msg_dict['deltas'].keys()
+                    applied = msg_dict.get('seq', applied)
+
+                elif msg_dict['op'] == 'register':
+                    await self.register_client(msg_dict['account'])
+                    accounts = [msg_dict['account']]
+
+                else:
+                    print_log('unknown op from worker: {}'.format(msg_dict))
+                    continue
+
+                reply = {'bills': self._bills_of(accounts), 'prices': self.get_prices(), 'applied': applied}
+                await _send_json(writer, reply)
+
+            except Exception as e:
+                print_log('Error handle worker message: {}'.format(e))
+
+        print_log('worker disconnected')
+
+
+def create_reuse_port_socket(host, port):
+    """
+    Each worker binds its own socket to the same address, and the kernel
+    balances new connections among them.
+    """
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)
+    family, sock_type, proto, _canonname, sockaddr = infos[0]
+
+    sock = socket.socket(family, sock_type, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(sockaddr)
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+
+def create_unix_socket(path):
+    """
+    Bound once in the master, the workers inherit the fd.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+
+def fork_workers(count, worker_main):
+    """
+    Fork `count` processes, each runs worker_main(index, ipc_sock) and never returns.
+    Return a list of (pid, ipc_sock) for the master.
+    """
+    workers = []
+    for index in range(count):
+        master_sock, worker_sock = socket.socketpair()
+
+        pid = os.fork()
+        if pid == 0:
+            master_sock.close()
+            for _pid, sock in workers:
+                sock.close()
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                worker_main(index, worker_sock)
+            finally:
+                os._exit(0)
+
+        worker_sock.close()
+        workers.append((pid, master_sock))
+        print_log('started worker {}, pid {}'.format(index, pid))
+
+    return workers
+
+
+async def watch_workers(workers):
+    """
+    Exit the master if all workers are gone.
+    """
+    alive = {pid for pid, _sock in workers}
+    while alive:
+        await asyncio.sleep(1)
+        for pid in list(alive):
+            try:
+                waited_pid, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                # reaped by stop_workers()
+                alive.discard(pid)
+                continue
+            if waited_pid:
+                print_log('worker pid {} exited with status {}'.format(pid, status))
+                alive.discard(pid)
+
+
+async def stop_workers(workers, timeout=5):
+    """
+    Terminate the workers and wait for them on the loop, so the master keeps
+    serving the charges they send on exit.
+    """
+    for pid, _sock in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    deadline = time.time() + timeout
+    for pid, _sock in workers:
+        while time.time() < deadline:
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    break
+            except ChildProcessError:
+                break
+            await asyncio.sleep(0.1)
+
+
+def _test_main():
+    """
+    The charges a worker sends on exit are in the bills the master writes.
+    """
+    import tempfile
+
+    from .ledger import Ledger
+    from .async_db import AsyncDB
+
+    async def in_flight():
+        # the charges sent but not applied by the master yet stay in the balance
+        master_sock, worker_sock = socket.socketpair()
+        reader, writer = await asyncio.open_connection(sock=master_sock)
+        ledger = RemoteLedger(worker_sock)
+        await ledger.connect()
+
+        ledger.charge('xrb_client', 100)
+        ledger.flush()
+        assert (await _recv_json(reader))['seq'] == 1
+        ledger.charge('xrb_client', 10)
+
+        # a reply to an earlier message, before the charges arrived
+        bill = _new_bill()
+        await _send_json(writer, {'bills': {'xrb_client': bill}, 'applied': 0})
+        await asyncio.sleep(0.1)
+        assert ledger.get_balance('xrb_client') == -110, ledger.get_bill('xrb_client')
+
+        bill = dict(_new_bill(), total_spend=100, balance=-100)
+        await _send_json(writer, {'bills': {'xrb_client': bill}, 'applied': 1})
+        await asyncio.sleep(0.1)
+        assert ledger.get_balance('xrb_client') == -110, ledger.get_bill('xrb_client')
+        assert not ledger._in_flight
+
+        writer.close()
+
+    asyncio.run(in_flight())
+    print('in-flight charges kept until the master applied them')
+
+    accounts = ['xrb_client{}'.format(x) for x in range(3)]
+
+    def worker_main(_index, ipc_sock):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        ledger = RemoteLedger(ipc_sock, flush_bytes=10**9)
+        loop.run_until_complete(ledger.connect())
+
+        # charged right before the master stops the workers, like the last requests
+        stopped = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stopped.set)
+        for account in accounts:
+            ledger.charge(account, 1000, size=100, requests=1)
+        os.write(ready_w, b'1')
+
+        loop.run_until_complete(stopped.wait())
+        loop.run_until_complete(ledger.close())
+
+    async def master():
+        db = AsyncDB(tempfile.mktemp(suffix='.db'))
+        for account in accounts:
+            await db.update_account(account, AsyncDB.ROLE_CLIENT)
+        ledger = Ledger(db)
+        aggregator = Aggregator(ledger, None, lambda: None)
+        serve_tasks = [asyncio.ensure_future(aggregator.serve(ipc_sock)) for _pid, ipc_sock in workers]
+
+        for _worker in workers:
+            os.read(ready_r, 1)
+        await stop_workers(workers)
+        await asyncio.wait(serve_tasks, timeout=5)
+        await ledger.close()
+        await db.close()
+
+        bills = await AsyncDB(db.file_name).get_bills(accounts)
+        for account in accounts:
+            assert int(bills[account]['total_spend']) == 1000 * len(workers), bills[account]
+            assert int(bills[account]['total_requests']) == len(workers)
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db.file_name + suffix):
+                os.remove(db.file_name + suffix)
+
+    ready_r, ready_w = os.pipe()
+    workers = fork_workers(2, worker_main)
+    asyncio.run(master())
+    print('charges of {} workers survived shutdown'.format(len(workers)))
+
+
+if __name__ == '__main__':
+    _test_main()
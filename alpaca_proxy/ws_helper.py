@@ -8,11 +8,20 @@ from aiohttp import WSMsgType
 import traceback
 
 from .log import print_log
+from .ctrl_msg import CtrlMsg, CtrlMsgError
+from .multiplexing import CtrlRecord
 
 
-async def ws_connect(url, username=None, password=None, verify_ssl=True, headers=None):
+# Frames queued within COALESCE_DELAY seconds, up to COALESCE_SIZE bytes,
+# are packed into one websocks message, if the peer supports it.
+COALESCE_DELAY = 0.001
+COALESCE_SIZE = 64 * 1024
+
+
+async def ws_connect(url, username=None, password=None, verify_ssl=True, headers=None, protocols=(), autoping=True):
     """
     Connect to the url, return the ws session.
+    Without autoping, ws_recv() answers the pings, and passes the pongs to on_pong.
     """
 
     retry_timeout = 2
@@ -27,7 +36,7 @@ async def ws_connect(url, username=None, password=None, verify_ssl=True, headers
 
             connector = aiohttp.TCPConnector(verify_ssl=verify_ssl, force_close=True)
             session = aiohttp.ClientSession(connector=connector)
-            future = session.ws_connect(url, auth=auth, heartbeat=30, headers=headers)
+            future = session.ws_connect(url, auth=auth, heartbeat=30, headers=headers, protocols=protocols, autoping=autoping)
             ws = await asyncio.wait_for(future, timeout=retry_timeout)
             print_log('connected to %s' % url)
             # must return the session, otherwise the session will be deleted/closed.
@@ -54,7 +63,7 @@ async def ws_connect(url, username=None, password=None, verify_ssl=True, headers
     return None, None
 
 
-async def ws_recv(ws):
+async def ws_recv(ws, on_pong=None):
     """
     Read from the ws session and return a BINARY/TEXT msg.
     Return None if ws is closed.
@@ -73,11 +82,35 @@ async def ws_recv(ws):
             print_log('error: {}'.format(msg))
             continue
 
+        # only returned without autoping
+        elif msg.type == WSMsgType.PING:
+            await ws.pong(msg.data)
+            continue
+
+        elif msg.type == WSMsgType.PONG:
+            if on_pong:
+                on_pong(msg.data)
+            continue
+
         else:
             print_log('unexpected message type: {}'.format(msg.type))
             continue
 
 
+def ws_decode(mp_session, ws_msg):
+    """
+    Return the (stream_id, data) records of a BINARY/TEXT msg, a TEXT msg is one CtrlMsg.
+    Raise ValueError or CtrlMsgError if the msg is malformed, the session can't go on.
+    """
+    if ws_msg.type == WSMsgType.TEXT:
+        ctrl = CtrlMsg()
+        ctrl.from_str(ws_msg.data)
+        return [(ctrl.stream_id, ctrl)]
+
+    # with framing version 4, the control messages are records too
+    return mp_session.unpack(ws_msg.data)
+
+
 async def ws_send(ws, data, msg_type=WSMsgType.BINARY):
     """
     Send data to the ws session.
@@ -92,3 +125,88 @@ async def ws_send(ws, data, msg_type=WSMsgType.BINARY):
 
     elif msg_type == WSMsgType.TEXT:
         return await ws.send_str(data)
+
+
+async def ws_send_ctrl(ws, mp_session, ctrl):
+    """
+    Send a control message right away, as a record with framing version 4, else as json.
+    """
+    if mp_session.version < mp_session.VERSION_4:
+        return await ws_send(ws, ctrl.to_str(), WSMsgType.TEXT)
+
+    for message in mp_session.pack([(ctrl.stream_id, ctrl)]):
+        await ws_send(ws, message, WSMsgType.BINARY)
+
+
+def encode_ctrl(mp_session, ctrl):
+    """
+    Return the json str of a control message, or with framing version 4 its record.
+    A message that can't be encoded resets its stream instead, the RST record
+    is returned, so the sender of the session goes on.
+    """
+    try:
+        if mp_session.version < mp_session.VERSION_4:
+            return ctrl.to_str()
+        return ctrl.stream_id, CtrlRecord(ctrl.to_bytes())
+    except CtrlMsgError as e:
+        print_log('reset stream_id {}, can not encode {}: {}'.format(ctrl.stream_id, ctrl.msg_type, e))
+        return ctrl.stream_id, mp_session.RST
+
+
+def _encode_item(mp_session, item):
+    """
+    Return the item with its control message encoded, (WSMsgType.TEXT, str) or
+    (WSMsgType.BINARY, record).
+    """
+    msg_type, ws_data = item
+    if msg_type != WSMsgType.TEXT:
+        return item
+
+    ws_data = encode_ctrl(mp_session, ws_data)
+    if isinstance(ws_data, str):
+        return WSMsgType.TEXT, ws_data
+    return WSMsgType.BINARY, ws_data
+
+
+async def ws_send_frames(send_q, ws, mp_session, delay=COALESCE_DELAY, max_size=COALESCE_SIZE, replay=None):
+    """
+    The only sender of the ws session. Items in send_q are (WSMsgType.TEXT, CtrlMsg),
+    or (WSMsgType.BINARY, (stream_id, data)), which are encoded by mp_session.
+    With framing version 2, binary frames queued together are sent in one message.
+    With framing version 4, so are the control messages, before that they are
+    sent as json TEXT messages.
+    With replay, the items are kept until the peer acks them.
+    """
+    while True:
+        item = await send_q.get()
+        if replay:
+            replay.sent(item)
+        msg_type, ws_data = _encode_item(mp_session, item)
+        if msg_type == WSMsgType.TEXT:
+            await ws_send(ws, ws_data, msg_type)
+            continue
+        size = len(ws_data[1] or b'')
+
+        records = [ws_data]
+        text = None
+
+        if mp_session.version != mp_session.VERSION_1:
+            if send_q.empty() and delay:
+                await asyncio.sleep(delay)
+
+            while size < max_size and not send_q.empty():
+                item = send_q.get_nowait()
+                if replay:
+                    replay.sent(item)
+                msg_type, ws_data = _encode_item(mp_session, item)
+                if msg_type == WSMsgType.TEXT:
+                    text = ws_data
+                    break
+                records.append(ws_data)
+                size += len(ws_data[1] or b'')
+
+        for message in mp_session.pack(records):
+            await ws_send(ws, message, WSMsgType.BINARY)
+
+        if text is not None:
+            await ws_send(ws, text, WSMsgType.TEXT)